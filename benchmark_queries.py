@@ -0,0 +1,266 @@
+"""Compare rows read / elapsed time of the legacy and pushed-down report queries.
+
+Runs against the ClickHouse server configured for demo.py (same environment / .env):
+
+    python benchmark_queries.py [--window-days N]
+"""
+import argparse
+import time
+import uuid
+
+import pandas as pd
+
+import demo
+
+# Pre-pushdown versions of both report queries: their CTEs rank the full Studies /
+# StudyStatuses history. Kept only as the baseline for benchmark_queries.
+LEGACY_QUERY_TEMPLATE = """
+WITH ranked_studies AS (
+    SELECT 
+        s.id AS study_id,
+        s.client_fk,
+        sd.is_demo,
+        row_number() OVER (
+            PARTITION BY s.client_fk, sd.is_demo
+            ORDER BY s.created_at
+        ) AS rank_within_type
+    FROM Studies s
+    JOIN StudyDetails sd ON s.id = sd.study_fk
+),
+latest_status AS (
+    SELECT 
+        ss.study_fk,
+        ss.status,
+        row_number() OVER (
+            PARTITION BY ss.study_fk
+            ORDER BY ss.created_at DESC
+        ) AS rn
+    FROM StudyStatuses ss
+),
+merged_parent AS (
+    SELECT 
+        s.id AS study_id,
+        s.parent_fk,
+        ps.status AS parent_status,
+        ctm_parent.tat_min AS parent_tat_min
+    FROM Studies s
+    LEFT JOIN Studies ps ON s.parent_fk = ps.id
+    LEFT JOIN metrics.client_tat_metrics ctm_parent ON ps.id = ctm_parent.study_id
+    WHERE s.status = 'MERGED'
+),
+correct_rad AS (
+    SELECT
+        r.study_fk,
+        r.by_user_fk AS rad_fk
+    FROM StudyStatuses r
+    INNER JOIN (
+        SELECT study_fk, MIN(created_at) AS first_completed_time
+        FROM StudyStatuses
+        WHERE status = 'COMPLETED'
+        GROUP BY study_fk
+    ) AS f ON r.study_fk = f.study_fk
+    WHERE r.status = 'REPORTED' AND r.created_at <= f.first_completed_time
+),
+preread_agent AS (
+    SELECT study_fk, status, iqca_fk
+    FROM StudyIqcs
+    WHERE status = 'REPORTABLE'
+),
+studies_with_qc AS (
+    SELECT DISTINCT study_fk
+    FROM StudyQcs
+)
+SELECT 
+    sd.study_fk AS Study_Id,
+    s.client_fk AS Client_Id,
+    c.client_name AS Client_Name,
+    s.created_at AS Study_Created_Time,
+    sd.created_at AS Activated_Time,
+    1 AS Activated_DemoCases,
+    -- This column is no longer used for active case logic, but kept for summary stats
+    CASE WHEN s.status NOT IN ('COMPLETED','DELETED') THEN 1 ELSE 0 END AS Active_DemoCases,
+    CASE WHEN s.status = 'COMPLETED' THEN 1 ELSE 0 END AS Completed_DemoCases,
+    -- THIS IS THE CRITICAL COLUMN FOR DETERMINING THE TRUE STATUS
+    CASE
+        WHEN s.status = 'MERGED' THEN 
+            CASE
+                WHEN r.study_fk IS NOT NULL AND r.status = 'COMPLETED' THEN 'Rework Completed'
+                WHEN mp.parent_status = 'COMPLETED' THEN 'Completed'
+                WHEN mp.parent_status NOT IN ('COMPLETED','DELETED') THEN 'Pending'
+                ELSE mp.parent_status
+            END
+        ELSE
+            CASE
+                WHEN  r.study_fk IS NOT NULL AND r.status = 'COMPLETED' THEN 'Rework Completed'
+                WHEN s.status = 'COMPLETED' THEN 'Completed'
+                WHEN s.status NOT IN ('COMPLETED','DELETED') THEN 'Pending'
+                ELSE s.status
+            END
+    END AS Final_Status,
+    CASE
+        WHEN s.status = 'MERGED' AND cr.rad_fk IN (2231, 1506, 1505, 2318, 1504, 2484, 2715, 2785) THEN 'HIL'
+        WHEN s.status = 'MERGED' AND cr.rad_fk NOT IN (2231, 1506, 1505, 2318, 1504, 2484, 2715, 2785) THEN 'Radiologist'
+        WHEN ls.status IN ('IQC_REVIEW','IQC_COMPLETED') THEN 'Preread'
+        WHEN cr.rad_fk IN (2231, 1506, 1505, 2318, 1504, 2484, 2715, 2785) THEN 'HIL'
+        WHEN cr.rad_fk NOT IN (2231, 1506, 1505, 2318, 1504, 2484, 2715, 2785) THEN 'Radiologist'
+        ELSE NULL
+    END AS Current_Bucket,
+    concat('https://admin.5cnetwork.com/cases/', toString(sd.study_fk)) AS Study_Link,
+    tokens(simpleJSONExtractRaw(assumeNotNull(REPLACE(s.rules, '\\\\', '')), 'list'))[1] AS modality,
+    CASE WHEN s.status = 'MERGED' THEN mp.parent_tat_min ELSE ctm.tat_min END AS tat_min,
+    CASE
+        WHEN modality = 'XRAY' AND (CASE WHEN s.status = 'MERGED' THEN mp.parent_tat_min ELSE ctm.tat_min END) <= 60 THEN 'Green'
+        WHEN modality = 'CT' AND (CASE WHEN s.status = 'MERGED' THEN mp.parent_tat_min ELSE ctm.tat_min END) <= 120 THEN 'Green'
+        WHEN modality = 'MRI' AND (CASE WHEN s.status = 'MERGED' THEN mp.parent_tat_min ELSE ctm.tat_min END) <= 180 THEN 'Green'
+        WHEN modality = 'NM' AND (CASE WHEN s.status = 'MERGED' THEN mp.parent_tat_min ELSE ctm.tat_min END) <= 1440 THEN 'Green'
+        ELSE 'Red'
+    END AS TAT_Flag,
+    cd.client_source as Clinet_source,
+    cg.assigned_to as assigned_to,
+    pods.pod_name as pod_name,
+    CASE
+        WHEN rs.is_demo = 1 THEN concat('Demo Case #', toString(rs.rank_within_type))
+    END AS Case_Tag,
+    CASE
+        WHEN cr.rad_fk IN (2231,1506,1505,2318,1504,2484,2715,2785) THEN 'Keerthana R'
+        WHEN ls.status IN ('IQC_REVIEW','IQC_COMPLETED') AND pa.iqca_fk IS NOT NULL AND 
+             pa.iqca_fk NOT IN (SELECT DISTINCT qc_fk FROM QcRoster) THEN 'Bhuvaneswaran'
+        WHEN ls.status IN ('IQC_REVIEW','IQC_COMPLETED') AND pa.iqca_fk IS NOT NULL AND 
+             pa.iqca_fk IN (SELECT DISTINCT qc_fk FROM QcRoster) THEN 'Santosh Kumar'
+        WHEN cr.rad_fk NOT IN (1505,2484,2715,2785,2231,2765) THEN 'Ruksana'
+        ELSE NULL
+    END AS category_manager
+
+FROM Studies AS s
+INNER JOIN StudyDetails AS sd ON sd.study_fk = s.id
+LEFT JOIN Clients AS c ON s.client_fk = c.id
+LEFT JOIN Reworks AS r ON sd.study_fk = r.study_fk
+LEFT JOIN metrics.client_tat_metrics AS ctm ON sd.study_fk = ctm.study_id
+LEFT JOIN ClientDetails AS cd ON s.client_fk = cd.client_fk
+LEFT JOIN metrics.client_group AS cg ON s.client_fk = cg.client_fk
+LEFT JOIN market_analysis_tables.pods AS pods ON cg.pod_id = pods.id
+LEFT JOIN ranked_studies AS rs ON sd.study_fk = rs.study_id
+LEFT JOIN latest_status AS ls ON sd.study_fk = ls.study_fk AND ls.rn = 1
+LEFT JOIN merged_parent AS mp ON s.id = mp.study_id
+LEFT JOIN correct_rad AS cr ON sd.study_fk = cr.study_fk
+LEFT JOIN preread_agent AS pa ON sd.study_fk = pa.study_fk
+LEFT JOIN studies_with_qc AS swq ON sd.study_fk = swq.study_fk
+WHERE sd.is_demo = 1
+  AND sd.created_at BETWEEN {window_end} - INTERVAL {window_days} DAY AND {window_end}
+ORDER BY Final_Status, sd.created_at ASC
+"""
+
+LEGACY_NON_DEMO_QUERY_TEMPLATE = """
+WITH ranked_studies AS (
+    SELECT 
+        s.id AS study_id,
+        s.client_fk,
+        sd.is_demo,
+        row_number() OVER (
+            PARTITION BY s.client_fk
+            ORDER BY s.created_at
+        ) AS rank_within_type
+    FROM Studies s
+    JOIN StudyDetails sd ON s.id = sd.study_fk
+),
+demo_clients AS (
+    SELECT DISTINCT
+        s.client_fk
+    FROM Studies AS s
+    INNER JOIN StudyDetails AS sd ON sd.study_fk = s.id
+    WHERE sd.is_demo = 1
+      AND sd.created_at BETWEEN {window_end} - INTERVAL {window_days} DAY AND {window_end}
+)
+SELECT 
+    s.id AS Study_Id,
+    s.client_fk AS Client_Id,
+    c.client_name AS Client_Name,
+    s.created_at AS Study_Created_Time,
+    s.status AS Final_Status,
+    tokens(simpleJSONExtractRaw(assumeNotNull(REPLACE(s.rules, '\\\\', '')), 'list'))[1] AS modality,
+    ctm.tat_min AS tat_min,
+    CASE
+        WHEN modality = 'XRAY' AND ctm.tat_min <= 60 THEN 'Green'
+        WHEN modality = 'CT' AND ctm.tat_min <= 120 THEN 'Green'
+        WHEN modality = 'MRI' AND ctm.tat_min <= 180 THEN 'Green'
+        WHEN modality = 'NM' AND ctm.tat_min <= 1440 THEN 'Green'
+        ELSE 'Red'
+    END AS TAT_Flag,
+    concat('https://admin.5cnetwork.com/cases/', toString(s.id)) AS Study_Link,
+    cg.assigned_to AS assigned_to,
+    pods.pod_name AS pod_name,
+    CASE
+        WHEN rs.is_demo = 0 AND rs.rank_within_type <= 5 THEN
+            CASE
+                WHEN rs.rank_within_type = 1 THEN '1st Real Case'
+                WHEN rs.rank_within_type = 2 THEN '2nd Real Case'
+                WHEN rs.rank_within_type = 3 THEN '3rd Real Case'
+                ELSE concat(toString(rs.rank_within_type), 'th Real Case')
+            END
+        ELSE concat(toString(rs.rank_within_type), 'th Real Case')
+    END AS Tag
+FROM Studies AS s
+INNER JOIN StudyDetails AS sd ON sd.study_fk = s.id
+LEFT JOIN Clients AS c ON s.client_fk = c.id
+LEFT JOIN ranked_studies AS rs ON sd.study_fk = rs.study_id
+LEFT JOIN metrics.client_tat_metrics AS ctm ON sd.study_fk = ctm.study_id
+LEFT JOIN metrics.client_group AS cg ON s.client_fk = cg.client_fk
+LEFT JOIN market_analysis_tables.pods AS pods ON cg.pod_id = pods.id
+WHERE sd.is_demo = 0 
+  AND s.created_at BETWEEN {window_end} - INTERVAL {window_days} DAY AND {window_end} -- New condition to filter by last 24 hours
+  AND rs.rank_within_type <= 5
+  AND s.client_fk IN (SELECT client_fk FROM demo_clients)
+ORDER BY s.client_fk ASC, s.created_at ASC
+"""
+
+
+def benchmark_queries():
+    """Compare the legacy (full-history) queries against the pushed-down ones.
+
+    Each query runs once, sequentially, on one connection and is tagged with a query_id so
+    its rows/bytes read, elapsed time and memory can be read back from system.query_log.
+    Also reports whether both versions returned the same rows.
+    """
+    run_tag = uuid.uuid4().hex[:8]
+    pairs = {
+        'demo': (demo.render_query(LEGACY_QUERY_TEMPLATE), demo.QUERY),
+        'non_demo': (demo.render_query(LEGACY_NON_DEMO_QUERY_TEMPLATE), demo.NON_DEMO_QUERY),
+    }
+    runs = []
+
+    with demo.pooled_client() as client:
+        for name, (before_sql, after_sql) in pairs.items():
+            frames = {}
+            for version, sql in (('before', before_sql), ('after', after_sql)):
+                query_id = f"demo-report-bench-{run_tag}-{name}-{version}"
+                print(f"Running {name} query ({version})...")
+                start = time.perf_counter()
+                frames[version] = client.query_df(sql, settings={'query_id': query_id})
+                if demo.DIMENSION_CACHE and version == 'after':
+                    frames[version] = demo.enrich_frame(frames[version], demo.load_dimensions())
+                runs.append({'query': name, 'version': version, 'query_id': query_id,
+                             'rows_returned': len(frames[version]), 'wall_s': time.perf_counter() - start})
+
+            # Row order inside equal sort keys isn't guaranteed, so compare as sorted multisets.
+            before_rows = sorted(map(tuple, frames['before'].astype(str).values.tolist()))
+            after_rows = sorted(map(tuple, frames['after'].astype(str).values.tolist()))
+            if before_rows == after_rows:
+                print(f"✅ {name}: both versions returned identical rows")
+            else:
+                print(f"⚠️  {name}: results differ ({len(before_rows)} vs {len(after_rows)} rows); "
+                      "data may have changed between runs")
+
+        stats = demo.fetch_query_log_stats(client, [run['query_id'] for run in runs])
+
+    report = pd.DataFrame(runs).join(stats, on='query_id').drop(columns='query_id')
+    print(report.to_string(index=False))
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--window-days', type=int, help="report window in days (default REPORT_WINDOW_DAYS)")
+    args = parser.parse_args()
+    if args.window_days:
+        demo.set_report_window(args.window_days)
+    benchmark_queries()
@@ -1,14 +1,43 @@
-import pandas as pd
-from datetime import datetime
-from clickhouse_connect import get_client
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
-import ssl
-import urllib
+from __future__ import annotations
+
+from datetime import datetime, timedelta
+import importlib
 import os
-import certifi
+import json
+import argparse
+import queue
+import time
+import hashlib
+import threading
+import signal
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack, contextmanager
+import tempfile
 from dotenv import load_dotenv
 
+
+class LazyModule:
+    """Stand-in for a heavy module that is imported on first attribute access.
+
+    Most runs end with "no active cases" after a cheap probe; they should not pay for
+    importing pandas/numpy. Annotations are strings (`from __future__ import annotations`),
+    so `pd.DataFrame` in a signature does not trigger the import either.
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+np = LazyModule('numpy')
+pd = LazyModule('pandas')
+
 # Load environment variables from a .env file
 load_dotenv()
 
@@ -35,9 +64,209 @@ except (ValueError, TypeError) as e:
     print("Please make sure all required environment variables are set in your .env file.")
     exit(1)
 
+# Result transport: 'pandas' (query_df, object-dtype strings) or 'arrow' (query_arrow,
+# Arrow-backed strings and dictionary-encoded low-cardinality columns; needs pyarrow).
+FETCH_FORMAT = os.getenv('FETCH_FORMAT', 'pandas')
+
+# Rows per ClickHouse block in --stream mode; bounds the memory used while rendering.
+STREAM_BLOCK_ROWS = int(os.getenv('STREAM_BLOCK_ROWS', '50000'))
+
+# Incremental mode keeps a local snapshot of the last result set plus a high-water mark.
+STATE_DIR = os.getenv('REPORT_STATE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.report_state'))
+REPORT_WINDOW_DAYS = int(os.getenv('REPORT_WINDOW_DAYS', '20'))
+# Upper bound of the window as a ClickHouse expression; pinned to a rounded timestamp when
+# the result cache is on so reruns produce the same query text.
+REPORT_WINDOW_END = 'now()'
+# Number of ClickHouse queries allowed in flight at once (each on its own connection).
+QUERY_CONCURRENCY = int(os.getenv('QUERY_CONCURRENCY', '2'))
+# Re-read rows changed slightly before the watermark to absorb late inserts / replication lag.
+INCREMENTAL_OVERLAP_SECONDS = int(os.getenv('INCREMENTAL_OVERLAP_SECONDS', '900'))
+# Force a full re-scan periodically so the snapshot cannot drift from the source tables.
+INCREMENTAL_FULL_REFRESH_HOURS = float(os.getenv('INCREMENTAL_FULL_REFRESH_HOURS', '24'))
+# Last-write timestamp (column or expression) of metrics.client_tat_metrics and Reworks, read by
+# the change detection of --incremental / --refresh-state. If it doesn't exist on the server the
+# incremental queries fail and the run falls back to a full scan; 'toDateTime(0)' leaves a table
+# to the periodic full refresh.
+TAT_METRICS_CHANGE_COLUMN = os.getenv('TAT_METRICS_CHANGE_COLUMN', 'updated_at')
+REWORKS_CHANGE_COLUMN = os.getenv('REWORKS_CHANGE_COLUMN', 'updated_at')
+
+# Local result cache (--cache): query results stored as compressed Arrow IPC files, keyed by
+# database + query text (which carries the window bounds, rounded to the granularity).
+RESULT_CACHE_ENABLED = False
+RESULT_CACHE_DIR = os.getenv('RESULT_CACHE_DIR', os.path.join(STATE_DIR, 'cache'))
+RESULT_CACHE_TTL_SECONDS = int(os.getenv('RESULT_CACHE_TTL_SECONDS', '900'))
+RESULT_CACHE_GRANULARITY_SECONDS = int(os.getenv('RESULT_CACHE_GRANULARITY_SECONDS', '300'))
+RESULT_CACHE_MAX_BYTES = int(os.getenv('RESULT_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+
+# --fanout: per-pod / per-owner reports. ROUTING_FILE maps a ROUTING_FIELDS column to
+# {value: [emails]}, e.g. {"pod_name": {"Pod North": ["north-lead@example.com"]}}.
+ROUTING_FILE = os.getenv('ROUTING_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'routing.json'))
+ROUTING_FIELDS = ('pod_name', 'assigned_to', 'category_manager')
+# Emails rendered and sent at once in fan-out mode.
+SEND_CONCURRENCY = int(os.getenv('SEND_CONCURRENCY', '4'))
+
+# Change detection: skip rendering / sending when the classified sections match the last email
+# (fingerprints in STATE_DIR/report_digests.json). DELTA_MODE sends only the new cases.
+DELTA_MODE = os.getenv('DELTA_MODE', '0') == '1'
+CHANGE_DETECTION = os.getenv('CHANGE_DETECTION', '0') == '1' or DELTA_MODE
+
+# Per-run metrics export: a Prometheus textfile-collector file (rewritten every run) and/or a
+# JSON line appended per run ('-' prints it to stdout).
+METRICS_TEXTFILE = os.getenv('METRICS_TEXTFILE')
+METRICS_LOG = os.getenv('METRICS_LOG')
+
+# Store each query's server-side cost (rows/bytes read, duration, memory) with the run metrics.
+# Opt-in (QUERY_STATS=1, --query-stats or --profile). The pandas path reads it from the summary
+# ClickHouse returns with the result (the server then buffers each result until the query ends);
+# with FETCH_FORMAT=arrow it comes from system.query_log after the run, which issues SYSTEM
+# FLUSH LOGS and can wait up to ~20s for the log to be flushed.
+QUERY_STATS = os.getenv('QUERY_STATS', '0') == '1'
+# --profile: save EXPLAIN PIPELINE / EXPLAIN indexes = 1 of every report query under PROFILE_DIR.
+PROFILE_QUERIES = False
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(STATE_DIR, 'profiles'))
+
+# Run PROBE_QUERY_TEMPLATE first and skip the report queries when it finds no candidates.
+# Not run when the report is served from fresh cache entries or from the state table.
+FAST_PATH_PROBE = os.getenv('FAST_PATH_PROBE', '1') != '0'
+
+# Dimension cache (--dimension-cache): client attributes and the QC roster are fetched on their
+# own, slower TTL and looked up locally; the report queries then skip those joins.
+DIMENSION_CACHE = os.getenv('DIMENSION_CACHE', '0') == '1'
+DIMENSION_CACHE_DIR = os.getenv('DIMENSION_CACHE_DIR', os.path.join(STATE_DIR, 'dimensions'))
+DIMENSION_TTL_SECONDS = int(os.getenv('DIMENSION_TTL_SECONDS', str(6 * 3600)))
+
+# Email outbox (--outbox): rendered emails are spooled under OUTBOX_DIR as gzipped JSON and
+# delivered by a background sender with retries, so a SendGrid failure never costs a re-query.
+OUTBOX_ENABLED = os.getenv('OUTBOX', '0') == '1'
+OUTBOX_DIR = os.getenv('OUTBOX_DIR', os.path.join(STATE_DIR, 'outbox'))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '8'))
+# Retry delay doubles per failed attempt, from OUTBOX_BACKOFF_SECONDS up to OUTBOX_MAX_BACKOFF_SECONDS
+OUTBOX_BACKOFF_SECONDS = float(os.getenv('OUTBOX_BACKOFF_SECONDS', '30'))
+OUTBOX_MAX_BACKOFF_SECONDS = float(os.getenv('OUTBOX_MAX_BACKOFF_SECONDS', '3600'))
+OUTBOX_RATE_PER_SECOND = float(os.getenv('OUTBOX_RATE_PER_SECOND', '5'))
+OUTBOX_POLL_SECONDS = float(os.getenv('OUTBOX_POLL_SECONDS', '5'))
+# Backpressure: report runs are skipped while this many emails wait for delivery
+OUTBOX_MAX_PENDING = int(os.getenv('OUTBOX_MAX_PENDING', '50'))
+SENDGRID_HOST = os.getenv('SENDGRID_HOST', 'https://api.sendgrid.com')
+SENDGRID_TIMEOUT_SECONDS = float(os.getenv('SENDGRID_TIMEOUT_SECONDS', '30'))
+
+# Email size budget: a section renders inline up to INLINE_ROW_LIMIT rows and INLINE_BYTE_LIMIT
+# bytes of table HTML; longer ones show their first rows and are attached in full as gzip CSV
+# or Parquet (ATTACHMENT_FORMAT). EMAIL_MAX_BYTES caps HTML plus base64 attachments.
+INLINE_ROW_LIMIT = int(os.getenv('INLINE_ROW_LIMIT', '200'))
+INLINE_BYTE_LIMIT = int(os.getenv('INLINE_BYTE_LIMIT', str(256 * 1024)))
+ATTACHMENT_FORMAT = os.getenv('ATTACHMENT_FORMAT', 'csv')
+EMAIL_MAX_BYTES = int(os.getenv('EMAIL_MAX_BYTES', str(10 * 1024 * 1024)))
+
+# Run history (--history): every run's classified section rows are appended to a Parquet dataset
+# under HISTORY_DIR partitioned by run date, for trend / diff queries without ClickHouse.
+HISTORY_ENABLED = os.getenv('RUN_HISTORY', '0') == '1'
+HISTORY_DIR = os.getenv('HISTORY_DIR', os.path.join(STATE_DIR, 'history'))
+
+# Name of a precomputed LowCardinality modality column on Studies (created by
+# --add-modality-column); unset, the queries parse modality from Studies.rules on every run.
+MODALITY_COLUMN = os.getenv('MODALITY_COLUMN')
+
+# Pre-aggregated demo case state table maintained by --refresh-state. DEMO_SOURCE=state makes
+# the report read it instead of running the 12-table demo query.
+DEMO_STATE_TABLE = os.getenv('DEMO_STATE_TABLE', 'demo_case_state')
+DEMO_STATE_RETENTION_DAYS = int(os.getenv('DEMO_STATE_RETENTION_DAYS', '180'))
+DEMO_SOURCE = os.getenv('DEMO_SOURCE', 'query')
+# Recompute the whole table periodically, so rows whose change was missed cannot stay stale
+# until their TTL expires.
+DEMO_STATE_FULL_REFRESH_HOURS = float(os.getenv('DEMO_STATE_FULL_REFRESH_HOURS', '24'))
+
 # ---------------- SQL QUERIES ----------------
-QUERY = """
-WITH ranked_studies AS (
+# Modality as parsed from the Studies.rules JSON. With MODALITY_COLUMN set, the queries read
+# that precomputed column of Studies instead (see --add-modality-column).
+STUDY_MODALITY_SQL = "tokens(simpleJSONExtractRaw(assumeNotNull(REPLACE({rules}, '\\\\', '')), 'list'))[1]"
+MODALITY_SQL = f"s.{MODALITY_COLUMN}" if MODALITY_COLUMN else STUDY_MODALITY_SQL.format(rules='s.rules')
+
+# Green-TAT limit in minutes per modality; any other modality is always Red. The TAT_Flag
+# expression of every query is generated from this table.
+TAT_LIMITS_MIN = {'XRAY': 60, 'CT': 120, 'MRI': 180, 'NM': 1440}
+TAT_FLAG_SQL = (
+    "CASE WHEN has([{modalities}], modality) AND tat_min <= transform(modality, [{modalities}], [{limits}], 0) "
+    "THEN 'Green' ELSE 'Red' END"
+).format(modalities=', '.join(f"'{m}'" for m in TAT_LIMITS_MIN), limits=', '.join(map(str, TAT_LIMITS_MIN.values())))
+
+# Radiologist ids the demo query treats as HIL (Current_Bucket and category_manager)
+HIL_RADIOLOGIST_IDS = (2231, 1506, 1505, 2318, 1504, 2484, 2715, 2785)
+# Radiologists whose cases are not assigned to Ruksana in category_manager
+RUKSANA_EXCLUDED_RAD_IDS = (1505, 2484, 2715, 2785, 2231, 2765)
+PREREAD_STATUSES = ('IQC_REVIEW', 'IQC_COMPLETED')
+
+# Current_Bucket and category_manager of the full demo query, generated from the lists above
+# (enrich_frame derives both from the same lists when the dimension cache is on). The QC
+# roster is read once: a preread case with an agent goes to Santosh Kumar if the agent is on
+# the roster and to Bhuvaneswaran otherwise.
+ID_LISTS_SQL = dict(
+    hil=', '.join(map(str, HIL_RADIOLOGIST_IDS)),
+    ruksana_excluded=', '.join(map(str, RUKSANA_EXCLUDED_RAD_IDS)),
+    preread=', '.join(f"'{status}'" for status in PREREAD_STATUSES),
+)
+CURRENT_BUCKET_SQL = """CASE
+        WHEN s.status = 'MERGED' AND sst.rad_fk IN ({hil}) THEN 'HIL'
+        WHEN s.status = 'MERGED' AND sst.rad_fk NOT IN ({hil}) THEN 'Radiologist'
+        WHEN sst.latest_status IN ({preread}) THEN 'Preread'
+        WHEN sst.rad_fk IN ({hil}) THEN 'HIL'
+        WHEN sst.rad_fk NOT IN ({hil}) THEN 'Radiologist'
+        ELSE NULL
+    END""".format(**ID_LISTS_SQL)
+CATEGORY_MANAGER_SQL = """CASE
+        WHEN sst.rad_fk IN ({hil}) THEN 'Keerthana R'
+        WHEN sst.latest_status IN ({preread}) AND pa.iqca_fk IS NOT NULL THEN
+            if(pa.iqca_fk IN (SELECT qc_fk FROM QcRoster), 'Santosh Kumar', 'Bhuvaneswaran')
+        WHEN sst.rad_fk NOT IN ({ruksana_excluded}) THEN 'Ruksana'
+        ELSE NULL
+    END""".format(**ID_LISTS_SQL)
+
+# One pass over StudyStatuses per window study: latest status, first COMPLETED time and the
+# radiologists who REPORTED it up to then. Replaces the row_number() ranking plus the
+# first-completion self-join, which read the table three times (tests/test_demo.py keeps them
+# as the reference). The LEFT ARRAY JOIN keeps their row shape: one row per reporting
+# radiologist, or a single row with a default rad_fk when there is none.
+STUDY_STATUSES_SQL = """
+    SELECT
+        study_fk,
+        latest_status,
+        report.2 AS rad_fk
+    FROM (
+        SELECT
+            study_fk,
+            argMax(status, created_at) AS latest_status,
+            countIf(status = 'COMPLETED') AS completed_count,
+            minIf(created_at, status = 'COMPLETED') AS first_completed_time,
+            groupArrayIf((created_at, by_user_fk), status = 'REPORTED') AS reports
+        FROM StudyStatuses
+        WHERE study_fk IN (SELECT study_id FROM window_demo_studies)
+        GROUP BY study_fk
+    )
+    LEFT ARRAY JOIN arrayFilter(
+        x -> completed_count > 0 AND x.1 <= first_completed_time, reports
+    ) AS report
+"""
+
+# CTEs shared by the demo query and its dimension-free variant (DEMO_FACT_QUERY_TEMPLATE)
+DEMO_QUERY_CTES = """
+WITH window_demo_studies AS (
+    -- The only studies this report is about; every CTE below is restricted to them (or to
+    -- their clients) so window functions never rank the full Studies/StudyStatuses history.
+    SELECT
+        sd.study_fk AS study_id,
+        s.client_fk
+    FROM Studies AS s
+    INNER JOIN StudyDetails AS sd ON sd.study_fk = s.id
+    WHERE sd.is_demo = 1
+      AND sd.created_at BETWEEN {window_end} - INTERVAL {window_days} DAY AND {window_end}
+      {study_filter}
+),
+demo_clients AS (
+    SELECT DISTINCT client_fk
+    FROM window_demo_studies
+),
+ranked_studies AS (
+    -- Ranks need each client's full history, so filter whole partitions (clients), not rows.
     SELECT 
         s.id AS study_id,
         s.client_fk,
@@ -48,17 +277,9 @@ WITH ranked_studies AS (
         ) AS rank_within_type
     FROM Studies s
     JOIN StudyDetails sd ON s.id = sd.study_fk
+    WHERE s.client_fk IN (SELECT client_fk FROM demo_clients)
 ),
-latest_status AS (
-    SELECT 
-        ss.study_fk,
-        ss.status,
-        row_number() OVER (
-            PARTITION BY ss.study_fk
-            ORDER BY ss.created_at DESC
-        ) AS rn
-    FROM StudyStatuses ss
-),
+study_statuses AS (""" + STUDY_STATUSES_SQL + """),
 merged_parent AS (
     SELECT 
         s.id AS study_id,
@@ -69,31 +290,19 @@ merged_parent AS (
     LEFT JOIN Studies ps ON s.parent_fk = ps.id
     LEFT JOIN metrics.client_tat_metrics ctm_parent ON ps.id = ctm_parent.study_id
     WHERE s.status = 'MERGED'
-),
-correct_rad AS (
-    SELECT
-        r.study_fk,
-        r.by_user_fk AS rad_fk
-    FROM StudyStatuses r
-    INNER JOIN (
-        SELECT study_fk, MIN(created_at) AS first_completed_time
-        FROM StudyStatuses
-        WHERE status = 'COMPLETED'
-        GROUP BY study_fk
-    ) AS f ON r.study_fk = f.study_fk
-    WHERE r.status = 'REPORTED' AND r.created_at <= f.first_completed_time
+      AND s.id IN (SELECT study_id FROM window_demo_studies)
 ),
 preread_agent AS (
     SELECT study_fk, status, iqca_fk
     FROM StudyIqcs
     WHERE status = 'REPORTABLE'
-),
-studies_with_qc AS (
-    SELECT DISTINCT study_fk
-    FROM StudyQcs
+      AND study_fk IN (SELECT study_id FROM window_demo_studies)
 )
-SELECT 
-    c.client_name AS Client_Name,
+"""
+
+# SELECT fragments shared by DEMO_QUERY_TEMPLATE and DEMO_FACT_QUERY_TEMPLATE, which only
+# differ in the dimension columns placed around them.
+DEMO_STATUS_COLUMNS_SQL = """
     s.created_at AS Study_Created_Time,
     sd.created_at AS Activated_Time,
     1 AS Activated_DemoCases,
@@ -116,62 +325,72 @@ SELECT
                 WHEN s.status NOT IN ('COMPLETED','DELETED') THEN 'Pending'
                 ELSE s.status
             END
-    END AS Final_Status,
-    CASE
-        WHEN s.status = 'MERGED' AND cr.rad_fk IN (2231, 1506, 1505, 2318, 1504, 2484, 2715, 2785) THEN 'HIL'
-        WHEN s.status = 'MERGED' AND cr.rad_fk NOT IN (2231, 1506, 1505, 2318, 1504, 2484, 2715, 2785) THEN 'Radiologist'
-        WHEN ls.status IN ('IQC_REVIEW','IQC_COMPLETED') THEN 'Preread'
-        WHEN cr.rad_fk IN (2231, 1506, 1505, 2318, 1504, 2484, 2715, 2785) THEN 'HIL'
-        WHEN cr.rad_fk NOT IN (2231, 1506, 1505, 2318, 1504, 2484, 2715, 2785) THEN 'Radiologist'
-        ELSE NULL
-    END AS Current_Bucket,
+    END AS Final_Status,"""
+
+DEMO_TAT_COLUMNS_SQL = """
     concat('https://admin.5cnetwork.com/cases/', toString(sd.study_fk)) AS Study_Link,
-    tokens(simpleJSONExtractRaw(assumeNotNull(REPLACE(s.rules, '\\\\', '')), 'list'))[1] AS modality,
-    CASE WHEN s.status = 'MERGED' THEN mp.parent_tat_min ELSE ctm.tat_min END AS tat_min,
-    CASE
-        WHEN modality = 'XRAY' AND (CASE WHEN s.status = 'MERGED' THEN mp.parent_tat_min ELSE ctm.tat_min END) <= 60 THEN 'Green'
-        WHEN modality = 'CT' AND (CASE WHEN s.status = 'MERGED' THEN mp.parent_tat_min ELSE ctm.tat_min END) <= 120 THEN 'Green'
-        WHEN modality = 'MRI' AND (CASE WHEN s.status = 'MERGED' THEN mp.parent_tat_min ELSE ctm.tat_min END) <= 180 THEN 'Green'
-        WHEN modality = 'NM' AND (CASE WHEN s.status = 'MERGED' THEN mp.parent_tat_min ELSE ctm.tat_min END) <= 1440 THEN 'Green'
-        ELSE 'Red'
-    END AS TAT_Flag,
-    cd.client_source as Clinet_source,
-    cg.assigned_to as assigned_to,
-    pods.pod_name as pod_name,
+    """ + MODALITY_SQL + """ AS modality,
+    if(s.status = 'MERGED', mp.parent_tat_min, ctm.tat_min) AS tat_min,
+    """ + TAT_FLAG_SQL + """ AS TAT_Flag,"""
+
+DEMO_CASE_TAG_SQL = """
     CASE
         WHEN rs.is_demo = 1 THEN concat('Demo Case #', toString(rs.rank_within_type))
-    END AS Case_Tag,
-    CASE
-        WHEN cr.rad_fk IN (2231,1506,1505,2318,1504,2484,2715,2785) THEN 'Keerthana R'
-        WHEN ls.status IN ('IQC_REVIEW','IQC_COMPLETED') AND pa.iqca_fk IS NOT NULL AND 
-             pa.iqca_fk NOT IN (SELECT DISTINCT qc_fk FROM QcRoster) THEN 'Bhuvaneswaran'
-        WHEN ls.status IN ('IQC_REVIEW','IQC_COMPLETED') AND pa.iqca_fk IS NOT NULL AND 
-             pa.iqca_fk IN (SELECT DISTINCT qc_fk FROM QcRoster) THEN 'Santosh Kumar'
-        WHEN cr.rad_fk NOT IN (1505,2484,2715,2785,2231,2765) THEN 'Ruksana'
-        ELSE NULL
-    END AS category_manager
+    END AS Case_Tag,"""
 
+DEMO_FACT_JOINS_SQL = """
 FROM Studies AS s
 INNER JOIN StudyDetails AS sd ON sd.study_fk = s.id
-LEFT JOIN Clients AS c ON s.client_fk = c.id
 LEFT JOIN Reworks AS r ON sd.study_fk = r.study_fk
 LEFT JOIN metrics.client_tat_metrics AS ctm ON sd.study_fk = ctm.study_id
-LEFT JOIN ClientDetails AS cd ON s.client_fk = cd.client_fk
-LEFT JOIN metrics.client_group AS cg ON s.client_fk = cg.client_fk
-LEFT JOIN market_analysis_tables.pods AS pods ON cg.pod_id = pods.id
 LEFT JOIN ranked_studies AS rs ON sd.study_fk = rs.study_id
-LEFT JOIN latest_status AS ls ON sd.study_fk = ls.study_fk AND ls.rn = 1
+LEFT JOIN study_statuses AS sst ON sd.study_fk = sst.study_fk
 LEFT JOIN merged_parent AS mp ON s.id = mp.study_id
-LEFT JOIN correct_rad AS cr ON sd.study_fk = cr.study_fk
-LEFT JOIN preread_agent AS pa ON sd.study_fk = pa.study_fk
-LEFT JOIN studies_with_qc AS swq ON sd.study_fk = swq.study_fk
-WHERE sd.is_demo = 1
-  AND sd.created_at BETWEEN now() - INTERVAL 20 DAY AND now()
+LEFT JOIN preread_agent AS pa ON sd.study_fk = pa.study_fk"""
+
+DEMO_FILTER_SQL = """
+WHERE sd.study_fk IN (SELECT study_id FROM window_demo_studies)
 ORDER BY Final_Status, sd.created_at ASC
 """
 
-NON_DEMO_QUERY = """
-WITH ranked_studies AS (
+DEMO_QUERY_TEMPLATE = DEMO_QUERY_CTES + """SELECT 
+    sd.study_fk AS Study_Id,
+    s.client_fk AS Client_Id,
+    c.client_name AS Client_Name,""" + DEMO_STATUS_COLUMNS_SQL + """
+    """ + CURRENT_BUCKET_SQL + """ AS Current_Bucket,""" + DEMO_TAT_COLUMNS_SQL + """
+    cd.client_source as Clinet_source,
+    cg.assigned_to as assigned_to,
+    pods.pod_name as pod_name,""" + DEMO_CASE_TAG_SQL + """
+    """ + CATEGORY_MANAGER_SQL + """ AS category_manager""" + DEMO_FACT_JOINS_SQL + """
+LEFT JOIN Clients AS c ON s.client_fk = c.id
+LEFT JOIN ClientDetails AS cd ON s.client_fk = cd.client_fk
+LEFT JOIN metrics.client_group AS cg ON s.client_fk = cg.client_fk
+LEFT JOIN market_analysis_tables.pods AS pods ON cg.pod_id = pods.id""" + DEMO_FILTER_SQL
+
+# Same rows without the dimension joins (Clients, ClientDetails, client_group, pods, QcRoster):
+# client-level columns, Current_Bucket and category_manager are filled in from the local
+# dimension cache (see enrich_frame).
+DEMO_FACT_QUERY_TEMPLATE = DEMO_QUERY_CTES + """SELECT
+    sd.study_fk AS Study_Id,
+    s.client_fk AS Client_Id,""" + DEMO_STATUS_COLUMNS_SQL + DEMO_TAT_COLUMNS_SQL + DEMO_CASE_TAG_SQL + """
+    -- Inputs of Current_Bucket / category_manager, which enrich_frame derives locally
+    s.status AS study_status,
+    sst.latest_status AS latest_status,
+    sst.rad_fk AS rad_fk,
+    pa.iqca_fk AS iqca_fk""" + DEMO_FACT_JOINS_SQL + DEMO_FILTER_SQL
+
+# CTEs shared by the non-demo query and NON_DEMO_FACT_QUERY_TEMPLATE
+NON_DEMO_QUERY_CTES = """
+WITH demo_clients AS (
+    SELECT DISTINCT
+        s.client_fk
+    FROM Studies AS s
+    INNER JOIN StudyDetails AS sd ON sd.study_fk = s.id
+    WHERE sd.is_demo = 1
+      AND sd.created_at BETWEEN {window_end} - INTERVAL {window_days} DAY AND {window_end}
+),
+ranked_studies AS (
+    -- Only demo clients are ever reported, so rank just their (complete) study history.
     SELECT 
         s.id AS study_id,
         s.client_fk,
@@ -182,31 +401,20 @@ WITH ranked_studies AS (
         ) AS rank_within_type
     FROM Studies s
     JOIN StudyDetails sd ON s.id = sd.study_fk
-),
-demo_clients AS (
-    SELECT DISTINCT
-        s.client_fk
-    FROM Studies AS s
-    INNER JOIN StudyDetails AS sd ON sd.study_fk = s.id
-    WHERE sd.is_demo = 1
-      AND sd.created_at BETWEEN now() - INTERVAL 20 DAY AND now()
+    WHERE s.client_fk IN (SELECT client_fk FROM demo_clients)
 )
-SELECT 
-    c.client_name AS Client_Name,
+"""
+
+# SELECT fragments shared by NON_DEMO_QUERY_TEMPLATE and NON_DEMO_FACT_QUERY_TEMPLATE
+NON_DEMO_CASE_COLUMNS_SQL = """
     s.created_at AS Study_Created_Time,
     s.status AS Final_Status,
-    tokens(simpleJSONExtractRaw(assumeNotNull(REPLACE(s.rules, '\\\\', '')), 'list'))[1] AS modality,
+    """ + MODALITY_SQL + """ AS modality,
     ctm.tat_min AS tat_min,
-    CASE
-        WHEN modality = 'XRAY' AND ctm.tat_min <= 60 THEN 'Green'
-        WHEN modality = 'CT' AND ctm.tat_min <= 120 THEN 'Green'
-        WHEN modality = 'MRI' AND ctm.tat_min <= 180 THEN 'Green'
-        WHEN modality = 'NM' AND ctm.tat_min <= 1440 THEN 'Green'
-        ELSE 'Red'
-    END AS TAT_Flag,
-    concat('https://admin.5cnetwork.com/cases/', toString(s.id)) AS Study_Link,
-    cg.assigned_to AS assigned_to,
-    pods.pod_name AS pod_name,
+    """ + TAT_FLAG_SQL + """ AS TAT_Flag,
+    concat('https://admin.5cnetwork.com/cases/', toString(s.id)) AS Study_Link,"""
+
+NON_DEMO_TAG_SQL = """
     CASE
         WHEN rs.is_demo = 0 AND rs.rank_within_type <= 5 THEN
             CASE
@@ -216,152 +424,1399 @@ SELECT
                 ELSE concat(toString(rs.rank_within_type), 'th Real Case')
             END
         ELSE concat(toString(rs.rank_within_type), 'th Real Case')
-    END AS Tag
+    END AS Tag"""
+
+NON_DEMO_FACT_JOINS_SQL = """
 FROM Studies AS s
 INNER JOIN StudyDetails AS sd ON sd.study_fk = s.id
-LEFT JOIN Clients AS c ON s.client_fk = c.id
 LEFT JOIN ranked_studies AS rs ON sd.study_fk = rs.study_id
-LEFT JOIN metrics.client_tat_metrics AS ctm ON sd.study_fk = ctm.study_id
-LEFT JOIN metrics.client_group AS cg ON s.client_fk = cg.client_fk
-LEFT JOIN market_analysis_tables.pods AS pods ON cg.pod_id = pods.id
-WHERE sd.is_demo = 0 
-  AND s.created_at BETWEEN now() - INTERVAL 20 DAY AND now() -- New condition to filter by last 24 hours
+LEFT JOIN metrics.client_tat_metrics AS ctm ON sd.study_fk = ctm.study_id"""
+
+NON_DEMO_FILTER_SQL = """
+WHERE sd.is_demo = 0
+  AND s.created_at BETWEEN {window_end} - INTERVAL {window_days} DAY AND {window_end}
   AND rs.rank_within_type <= 5
   AND s.client_fk IN (SELECT client_fk FROM demo_clients)
+  {study_filter}
 ORDER BY s.client_fk ASC, s.created_at ASC
 """
 
+NON_DEMO_QUERY_TEMPLATE = NON_DEMO_QUERY_CTES + """SELECT 
+    s.id AS Study_Id,
+    s.client_fk AS Client_Id,
+    c.client_name AS Client_Name,""" + NON_DEMO_CASE_COLUMNS_SQL + """
+    cg.assigned_to AS assigned_to,
+    pods.pod_name AS pod_name,""" + NON_DEMO_TAG_SQL + NON_DEMO_FACT_JOINS_SQL + """
+LEFT JOIN Clients AS c ON s.client_fk = c.id
+LEFT JOIN metrics.client_group AS cg ON s.client_fk = cg.client_fk
+LEFT JOIN market_analysis_tables.pods AS pods ON cg.pod_id = pods.id""" + NON_DEMO_FILTER_SQL
+
+# NON_DEMO_QUERY without the Clients / client_group / pods joins (see enrich_frame)
+NON_DEMO_FACT_QUERY_TEMPLATE = NON_DEMO_QUERY_CTES + """SELECT
+    s.id AS Study_Id,
+    s.client_fk AS Client_Id,""" + NON_DEMO_CASE_COLUMNS_SQL + NON_DEMO_TAG_SQL + NON_DEMO_FACT_JOINS_SQL + NON_DEMO_FILTER_SQL
 
-# ---------------- FUNCTIONS ----------------
-def execute_query_and_send_email():
-    """Run queries on ClickHouse, format results, and send email"""
+# Full-window queries: every demo / first-5 real case in the window (see set_report_window).
+QUERY = DEMO_QUERY_TEMPLATE.format(study_filter='', window_days=REPORT_WINDOW_DAYS, window_end=REPORT_WINDOW_END)
+NON_DEMO_QUERY = NON_DEMO_QUERY_TEMPLATE.format(study_filter='', window_days=REPORT_WINDOW_DAYS, window_end=REPORT_WINDOW_END)
+
+# One row per client with every client-level column the report shows, joined the same way
+# the report queries join them.
+CLIENT_DIMENSION_QUERY = """
+SELECT
+    c.id AS Client_Id,
+    c.client_name AS Client_Name,
+    cd.client_source AS Clinet_source,
+    cg.assigned_to AS assigned_to,
+    pods.pod_name AS pod_name
+FROM Clients AS c
+LEFT JOIN ClientDetails AS cd ON c.id = cd.client_fk
+LEFT JOIN metrics.client_group AS cg ON c.id = cg.client_fk
+LEFT JOIN market_analysis_tables.pods AS pods ON cg.pod_id = pods.id
+"""
+
+QC_ROSTER_QUERY = """
+SELECT DISTINCT qc_fk
+FROM QcRoster
+"""
+
+# Column order of the report frames, whichever query variant produced them
+DEMO_REPORT_COLUMNS = (
+    'Study_Id', 'Client_Id', 'Client_Name', 'Study_Created_Time', 'Activated_Time', 'Activated_DemoCases',
+    'Active_DemoCases', 'Completed_DemoCases', 'Final_Status', 'Current_Bucket', 'Study_Link', 'modality',
+    'tat_min', 'TAT_Flag', 'Clinet_source', 'assigned_to', 'pod_name', 'Case_Tag', 'category_manager',
+)
+NON_DEMO_REPORT_COLUMNS = (
+    'Study_Id', 'Client_Id', 'Client_Name', 'Study_Created_Time', 'Final_Status', 'modality', 'tat_min',
+    'TAT_Flag', 'Study_Link', 'assigned_to', 'pod_name', 'Tag',
+)
+
+# Fast-path probe: does the window hold any candidate active demo / first-5 real case? Each
+# side is an existence check (LIMIT 1) on Studies/StudyDetails alone, with no ranking: the
+# real-case side looks for any open non-demo study of a demo client. Both over-approximate
+# (a MERGED study whose parent is done, a real case past the first 5) but never miss a case,
+# so 0/0 means the full queries would find no active case and the run can stop early.
+PROBE_QUERY_TEMPLATE = """
+WITH window_demo_studies AS (
+    SELECT study_fk
+    FROM StudyDetails
+    WHERE is_demo = 1
+      AND created_at BETWEEN {window_end} - INTERVAL {window_days} DAY AND {window_end}
+)
+SELECT
+    (SELECT count() FROM (
+        SELECT 1
+        FROM Studies
+        WHERE id IN (SELECT study_fk FROM window_demo_studies)
+          AND ifNull(status, '') NOT IN ('COMPLETED','DELETED')
+        LIMIT 1
+    )) AS candidate_demo,
+    (SELECT count() FROM (
+        SELECT 1
+        FROM Studies
+        WHERE created_at BETWEEN {window_end} - INTERVAL {window_days} DAY AND {window_end}
+          AND ifNull(status, '') NOT IN ('COMPLETED','DELETED')
+          AND client_fk IN (SELECT client_fk FROM Studies WHERE id IN (SELECT study_fk FROM window_demo_studies))
+          AND id NOT IN (SELECT study_fk FROM window_demo_studies)
+        LIMIT 1
+    )) AS candidate_non_demo
+"""
+
+# Summary card counts as conditions on a demo row's status (Final_Status, '' when missing, which
+# counts as active, matching classify_cases) and TAT_Flag.
+DEMO_SUMMARY_CONDITIONS = {
+    'total_demo': "status != 'DELETED'",
+    'active_demo': "status NOT IN ('Completed', 'Rework Completed', 'DELETED')",
+    'completed_demo': "status IN ('Completed', 'Rework Completed')",
+    'within_tat': "status IN ('Completed', 'Rework Completed') AND TAT_Flag = 'Green'",
+}
+# Rows destined for a table: active, rework completed, and completed with a red TAT.
+DEMO_DETAIL_CONDITION = "status != 'DELETED' AND (status != 'Completed' OR TAT_Flag = 'Red')"
+
+# Summary cards computed server-side over every demo case in the window, so only the rows
+# that end up in a table need to be transferred (DEMO_DETAIL_QUERY).
+DEMO_SUMMARY_QUERY = """
+SELECT
+    """ + ',\n    '.join(f"countIf({condition}) AS {name}" for name, condition in DEMO_SUMMARY_CONDITIONS.items()) + """
+FROM (
+    SELECT ifNull(Final_Status, '') AS status, TAT_Flag
+    FROM ({demo_query})
+)
+"""
+
+DEMO_DETAIL_QUERY = """
+SELECT * EXCEPT (status)
+FROM (
+    SELECT *, ifNull(Final_Status, '') AS status
+    FROM ({demo_query})
+)
+WHERE """ + DEMO_DETAIL_CONDITION + """
+ORDER BY Final_Status, Activated_Time ASC
+"""
+
+# Multi-window batch mode (--windows): each report query runs once, over the largest window,
+# and every row is tagged with the smallest window it falls in (Report_Window, in days). Before
+# the demo rows are cut down to the table rows, window functions over all of them add every
+# window's summary counts ({count}_{days} columns, the same on each row) and each client's
+# smallest demo window (Client_Window). A client's first row is kept even if no table shows it
+# (Summary_Only = 1), so neither is lost with the filtered rows; see split_windowed_results.
+WINDOWED_DEMO_QUERY = """
+SELECT * EXCEPT (status, client_row)
+FROM (
+    SELECT
+        *,
+        {window_counts},
+        min(Report_Window) OVER (PARTITION BY Client_Id) AS Client_Window,
+        row_number() OVER (PARTITION BY Client_Id) AS client_row,
+        NOT (""" + DEMO_DETAIL_CONDITION + """) AS Summary_Only
+    FROM (
+        SELECT *, ifNull(Final_Status, '') AS status, {activated_window} AS Report_Window
+        FROM ({demo_query})
+    )
+)
+WHERE NOT Summary_Only OR client_row = 1
+ORDER BY Final_Status, Activated_Time ASC
+"""
+
+WINDOWED_NON_DEMO_QUERY = """
+SELECT *, {created_window} AS Report_Window
+FROM ({non_demo_query})
+ORDER BY Client_Id ASC, Study_Created_Time ASC
+"""
+
+# ---------------- MODALITY COLUMN ----------------
+# Precomputed modality on Studies: filled on insert (MATERIALIZED) and backfilled once by
+# MATERIALIZE COLUMN, so the report reads a LowCardinality column instead of parsing JSON.
+MODALITY_COLUMN_DDL = """
+ALTER TABLE Studies
+ADD COLUMN IF NOT EXISTS {column} LowCardinality(String) MATERIALIZED """ + STUDY_MODALITY_SQL.format(rules='rules')
+MODALITY_COLUMN_BACKFILL = "ALTER TABLE Studies MATERIALIZE COLUMN {column}"
+
+# ---------------- DEMO CASE STATE TABLE ----------------
+# One row per demo query output row, versioned by refreshed_at. The schema is taken from the
+# demo query itself (EMPTY AS SELECT) so the table can never drift from the report's columns.
+# The demo query can return several rows for one study (e.g. several reworks), so rows are
+# keyed by (Study_Id, Row_No) and readers only take each study's latest refresh; rows left
+# over from an older refresh of the same study are thereby ignored until merged away.
+DEMO_STATE_DDL = f"""
+CREATE TABLE IF NOT EXISTS {DEMO_STATE_TABLE}
+ENGINE = ReplacingMergeTree(refreshed_at)
+ORDER BY (Study_Id, Row_No)
+TTL Activated_Time + INTERVAL {DEMO_STATE_RETENTION_DAYS} DAY
+EMPTY AS
+{{state_rows}}
+"""
+
+DEMO_STATE_INSERT = f"""
+INSERT INTO {DEMO_STATE_TABLE}
+{{state_rows}}
+"""
+
+# Demo query output plus the state table's bookkeeping columns
+DEMO_STATE_ROWS = """
+SELECT
+    *,
+    row_number() OVER (PARTITION BY Study_Id) AS Row_No,
+    now() AS refreshed_at
+FROM ({demo_query})
+"""
+
+# Cheap replacement for QUERY: a filtered read over the small state table.
+DEMO_STATE_QUERY_TEMPLATE = f"""
+SELECT * EXCEPT (Row_No, refreshed_at)
+FROM {DEMO_STATE_TABLE} FINAL
+WHERE Activated_Time BETWEEN {{window_end}} - INTERVAL {{window_days}} DAY AND {{window_end}}
+  AND (Study_Id, refreshed_at) IN (
+      SELECT Study_Id, max(refreshed_at)
+      FROM {DEMO_STATE_TABLE}
+      GROUP BY Study_Id
+  )
+ORDER BY Final_Status, Activated_Time ASC
+"""
+
+# Studies touched since the watermark: a new status row, a new activation, a new or updated
+# TAT metric (late tat_min turns a Red flag Green), a new or updated rework, or a status / TAT
+# change on the parent of a MERGED study (the child inherits the parent's status and TAT).
+# Each table is filtered by its own write timestamp (see TAT_METRICS_CHANGE_COLUMN).
+CHANGED_STUDIES_SQL = """
+    SELECT study_fk FROM StudyStatuses WHERE created_at > toDateTime({watermark})
+    UNION DISTINCT
+    SELECT study_fk FROM StudyDetails WHERE created_at > toDateTime({watermark})
+    UNION DISTINCT
+    SELECT study_id AS study_fk FROM metrics.client_tat_metrics
+    WHERE """ + TAT_METRICS_CHANGE_COLUMN + """ > toDateTime({watermark})
+    UNION DISTINCT
+    SELECT study_fk FROM Reworks WHERE """ + REWORKS_CHANGE_COLUMN + """ > toDateTime({watermark})
+    UNION DISTINCT
+    SELECT id AS study_fk FROM Studies
+    WHERE status = 'MERGED'
+      AND parent_fk IN (
+          SELECT study_fk FROM StudyStatuses WHERE created_at > toDateTime({watermark})
+          UNION DISTINCT
+          SELECT study_id FROM metrics.client_tat_metrics
+          WHERE """ + TAT_METRICS_CHANGE_COLUMN + """ > toDateTime({watermark})
+      )
+"""
+
+INCREMENTAL_DEMO_FILTER = """AND sd.study_fk IN (
+{changed_studies}
+  )"""
+
+# A client whose first demo case was activated since the watermark makes its older real
+# cases eligible for the "first 5" table, so those are re-fetched as well.
+INCREMENTAL_NON_DEMO_FILTER = """AND (
+      s.id IN (
+{changed_studies}
+      )
+      OR s.client_fk IN (
+          SELECT s2.client_fk
+          FROM Studies AS s2
+          INNER JOIN StudyDetails AS sd2 ON sd2.study_fk = s2.id
+          WHERE sd2.is_demo = 1 AND sd2.created_at > toDateTime({watermark})
+      )
+  )"""
+
+
+# ---------------- METRICS ----------------
+# Filled in during a run: stage durations (summed when a stage runs several times, e.g. one
+# connect per pooled client or one render per fan-out group), rows per query, HTML bytes
+# rendered and SendGrid response codes.
+run_metrics = {}
+_metrics_lock = threading.Lock()
+
+
+def start_run_metrics():
+    """Reset run_metrics at the start of a report run."""
+    run_metrics.clear()
+    run_metrics.update({'run_id': uuid.uuid4().hex[:12], 'started_at': time.time(), 'stages_s': {}, 'rows': {},
+                        'html_bytes': 0, 'sendgrid_status': {}, 'query_ids': {}, 'query_stats': {}})
+
+
+def query_settings(name: str, record: bool = True) -> dict:
+    """ClickHouse settings that tag a report query in system.query_log.
+
+    log_comment is stable across runs (demo-report:<name>) so a query's cost can be tracked
+    over time; query_id is unique per run. Recorded ids get their stats into the run metrics
+    (see collect_query_stats).
+    """
+    query_id = f"demo-report-{run_metrics.get('run_id') or uuid.uuid4().hex[:12]}-{name}"
+    if record:
+        with _metrics_lock:
+            run_metrics.setdefault('query_ids', {})[name] = query_id
+    return {'query_id': query_id, 'log_comment': f"demo-report:{name}"}
+
+
+def add_metric(name: str, value: float, key: str = None):
+    """Add `value` to run_metrics[name], or to run_metrics[name][key] (thread-safe)."""
+    with _metrics_lock:
+        if key is None:
+            run_metrics[name] = run_metrics.get(name, 0) + value
+        else:
+            bucket = run_metrics.setdefault(name, {})
+            bucket[key] = bucket.get(key, 0) + value
+
+
+@contextmanager
+def timed_stage(name: str):
+    """Time the enclosed block as stage `name` of the current run."""
+    start = time.perf_counter()
     try:
-        # Connect to ClickHouse using environment variables
-        client = get_client(
+        yield
+    finally:
+        add_metric('stages_s', time.perf_counter() - start, name)
+
+
+def peak_rss_bytes():
+    """Peak resident set size of this process so far (None where `resource` is unavailable)."""
+    try:
+        import resource
+        import sys
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # Linux reports KiB
+
+
+def prometheus_metrics(metrics: dict) -> str:
+    """Render a finished run's metrics in the Prometheus text exposition format."""
+    lines = []
+
+    def metric(name, help_text, samples):
+        lines.append(f"# HELP demo_report_{name} {help_text}")
+        lines.append(f"# TYPE demo_report_{name} gauge")
+        for labels, value in samples:
+            label_text = '{' + ','.join(f'{k}="{v}"' for k, v in labels.items()) + '}' if labels else ''
+            lines.append(f"demo_report_{name}{label_text} {value}")
+
+    metric('last_run_timestamp_seconds', 'Start time of the last report run.', [({}, round(metrics['started_at'], 3))])
+    metric('last_run_success', '1 if the last report run finished without error.', [({}, int(metrics['status'] == 'ok'))])
+    metric('run_duration_seconds', 'Wall time of the last report run.', [({}, metrics['duration_s'])])
+    metric('stage_duration_seconds', 'Time spent in each stage of the last run.',
+           [({'stage': stage}, round(seconds, 6)) for stage, seconds in sorted(metrics['stages_s'].items())])
+    metric('query_rows', 'Rows returned by each query in the last run.',
+           [({'query': name}, rows) for name, rows in sorted(metrics['rows'].items())])
+    metric('html_bytes', 'Bytes of HTML rendered in the last run.', [({}, metrics['html_bytes'])])
+    metric('email_bytes', 'Email payload (HTML plus base64 attachments) of the last run.', [({}, metrics.get('email_bytes', 0))])
+    stats = metrics.get('query_stats', {})
+    if stats:
+        for column, name, help_text in (
+                ('read_rows', 'query_read_rows', 'Rows read by each query in the last run.'),
+                ('read_bytes', 'query_read_bytes', 'Bytes read by each query in the last run.'),
+                ('memory_usage', 'query_memory_bytes', 'Peak server memory of each query in the last run.'),
+                ('query_duration_ms', 'query_server_duration_ms', 'Server-side duration of each query in the last run.')):
+            metric(name, help_text, [({'query': query}, values[column])
+                                     for query, values in sorted(stats.items()) if column in values])
+    metric('sendgrid_responses', 'SendGrid responses in the last run by status code.',
+           [({'status': status}, count) for status, count in sorted(metrics['sendgrid_status'].items())])
+    if 'outbox_backlog' in metrics:
+        metric('outbox_backlog', 'Emails waiting in the outbox at the start of the last run.', [({}, metrics['outbox_backlog'])])
+    if metrics['peak_rss_bytes'] is not None:
+        metric('peak_rss_bytes', 'Peak resident set size of the report process.', [({}, metrics['peak_rss_bytes'])])
+    return '\n'.join(lines) + '\n'
+
+
+def export_run_metrics(status: str):
+    """Finish the run's metrics and write them to METRICS_TEXTFILE / METRICS_LOG if configured."""
+    run_metrics.update({
+        'status': status,
+        'duration_s': round(time.time() - run_metrics['started_at'], 3),
+        'peak_rss_bytes': peak_rss_bytes(),
+    })
+    try:
+        if METRICS_TEXTFILE:
+            # The textfile collector may read at any time: write a temp file and rename it
+            with open(METRICS_TEXTFILE + '.tmp', 'w') as f:
+                f.write(prometheus_metrics(run_metrics))
+            os.replace(METRICS_TEXTFILE + '.tmp', METRICS_TEXTFILE)
+        if METRICS_LOG:
+            line = json.dumps({'event': 'demo_report_run', **run_metrics}, default=str)
+            if METRICS_LOG == '-':
+                print(line)
+            else:
+                with open(METRICS_LOG, 'a') as f:
+                    f.write(line + '\n')
+    except OSError as e:
+        print(f"Could not export run metrics: {e}")
+
+
+# ---------------- FUNCTIONS ----------------
+def create_clickhouse_client():
+    """Open a new ClickHouse connection using environment variables"""
+    from clickhouse_connect import get_client
+
+    with timed_stage('connect'):
+        return get_client(
             host=CLICK_PARAMS['host'],
             port=CLICK_PARAMS['port'],
             username=CLICK_PARAMS['username'],
             password=CLICK_PARAMS['password'],
             database=CLICK_PARAMS['database']
         )
+
+
+# A clickhouse_connect client holds one HTTP session and must not run two queries at once,
+# so concurrent queries each borrow their own client. Idle clients are kept for reuse.
+_client_pool = queue.Queue()
+
+
+@contextmanager
+def pooled_client():
+    """Borrow an idle ClickHouse client from the pool, opening a new one if none is free."""
+    try:
+        client = _client_pool.get_nowait()
+    except queue.Empty:
+        client = create_clickhouse_client()
         print("Connected to ClickHouse successfully")
+    try:
+        yield client
+    except Exception:
+        # The connection may be in an unknown state; don't hand it to the next caller.
+        client.close()
+        raise
+    else:
+        _client_pool.put(client)
 
-        # Run demo cases query
-        print("Executing demo cases query...")
-        df_demo = client.query_df(QUERY)
-        print(f"Demo query returned {len(df_demo)} rows")
 
-        # Run non-demo cases query
-        print("Executing non-demo cases query...")
-        df_non_demo = client.query_df(NON_DEMO_QUERY)
-        print(f"Non-demo query returned {len(df_non_demo)} rows")
+def render_query(template: str, study_filter: str = '') -> str:
+    """Fill a query template with the current report window."""
+    return template.format(study_filter=study_filter, window_days=REPORT_WINDOW_DAYS, window_end=REPORT_WINDOW_END)
 
-        if df_demo.empty and df_non_demo.empty:
-            print("No data found.")
-            return
 
-        # A case is active if its Final_Status is not 'Completed', 'Rework Completed', or 'DELETED'.
-        if not df_demo.empty:
-            active_demo_cases = df_demo[~df_demo['Final_Status'].isin(['Completed', 'Rework Completed', 'DELETED'])]
-        else:
-            active_demo_cases = pd.DataFrame()
-        
-        if not df_non_demo.empty:
-            active_non_demo_cases = df_non_demo[~df_non_demo['Final_Status'].isin(['COMPLETED', 'DELETED'])]
-        else:
-            active_non_demo_cases = pd.DataFrame()
-        
-        # Check for TAT breach cases (completed demo cases that exceeded TAT)
-        tat_breach_demo = df_demo[(df_demo['Final_Status'].isin(['Completed', 'Rework Completed'])) & (df_demo['TAT_Flag'] == 'Red')] if not df_demo.empty else pd.DataFrame()
-        
-        # Create a separate DataFrame for 'Rework Completed' cases
-        rework_completed_demo = df_demo[df_demo['Final_Status'] == 'Rework Completed'] if not df_demo.empty else pd.DataFrame()
+def set_report_window(days: int = None, end: str = None):
+    """Point QUERY / NON_DEMO_QUERY (and the report header) at a different window.
 
-        # The email will ONLY be sent if there are active cases.
-        if active_demo_cases.empty and active_non_demo_cases.empty:
-            print("No active cases found. Email will not be sent.")
-            return
+    `end` is a ClickHouse expression for the window's upper bound (default now()).
+    """
+    global REPORT_WINDOW_DAYS, REPORT_WINDOW_END, QUERY, NON_DEMO_QUERY
+    REPORT_WINDOW_DAYS = days or REPORT_WINDOW_DAYS
+    REPORT_WINDOW_END = end or REPORT_WINDOW_END
+    demo_template, non_demo_template = report_templates()
+    QUERY = render_query(DEMO_STATE_QUERY_TEMPLATE if DEMO_SOURCE == 'state' else demo_template)
+    NON_DEMO_QUERY = render_query(non_demo_template)
 
-        print(f"Found {len(active_demo_cases)} active demo cases, {len(active_non_demo_cases)} active non-demo cases")
-        print(f"Found {len(tat_breach_demo)} TAT breach demo cases")
-        print(f"Found {len(rework_completed_demo)} rework completed demo cases")
 
-        # Convert to HTML tables
-        print("Creating HTML table...")
-        html_content = create_html_table(df_demo, df_non_demo, active_demo_cases, active_non_demo_cases, tat_breach_demo, rework_completed_demo)
+def report_templates() -> tuple:
+    """(demo, non-demo) query templates: the dimension-free variants when DIMENSION_CACHE is on."""
+    if DIMENSION_CACHE:
+        return DEMO_FACT_QUERY_TEMPLATE, NON_DEMO_FACT_QUERY_TEMPLATE
+    return DEMO_QUERY_TEMPLATE, NON_DEMO_QUERY_TEMPLATE
 
-        # Send email to multiple recipients
-        print("Sending email...")
-        send_html_email_sendgrid(html_content, RECIPIENT_EMAILS)
-        print("Email sent successfully!")
 
+# Few distinct values per column: dictionary-encoded (pandas Categorical) on the Arrow path.
+ARROW_DICTIONARY_COLUMNS = (
+    'Client_Name', 'Final_Status', 'Current_Bucket', 'TAT_Flag', 'modality', 'Clinet_source',
+    'assigned_to', 'pod_name', 'category_manager', 'Case_Tag', 'Tag',
+)
+# ClickHouse writes DateTime to Arrow as UInt32 epoch seconds.
+ARROW_DATETIME_COLUMNS = ('Study_Created_Time', 'Activated_Time', 'window_start')
+
+
+def arrow_to_frame(table, server_tz) -> pd.DataFrame:
+    """Convert a ClickHouse Arrow result to pandas without going through Python objects.
+
+    Strings stay Arrow-backed, low-cardinality columns become categoricals and DateTime
+    columns become naive timestamps in the server's timezone (what ClickHouse displays).
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    columns = {}
+    for name, column in zip(table.column_names, table.columns):
+        if name in ARROW_DATETIME_COLUMNS and pa.types.is_integer(column.type):
+            column = pc.cast(pc.cast(column, pa.int64()), pa.timestamp('s', tz='UTC'))
+        if name in ARROW_DICTIONARY_COLUMNS and not pa.types.is_dictionary(column.type):
+            column = pc.dictionary_encode(column)
+        columns[name] = column
+
+    df = pa.table(columns).to_pandas(
+        types_mapper=lambda t: pd.ArrowDtype(t) if pa.types.is_string(t) or pa.types.is_large_string(t) else None,
+        self_destruct=True,
+    )
+    for name in ARROW_DATETIME_COLUMNS:
+        if name in df.columns and getattr(df[name].dtype, 'tz', None) is not None:
+            df[name] = df[name].dt.tz_convert(server_tz).dt.tz_localize(None)
+    return df
+
+
+def query_frame(client, sql: str, settings: dict = None) -> pd.DataFrame:
+    """Run a SELECT and return a DataFrame, over Arrow when FETCH_FORMAT is 'arrow'.
+
+    With QUERY_STATS on, a pandas query tagged with a query_id keeps the summary the driver
+    returns with its result in run_metrics['query_summaries'] (query_arrow doesn't expose it).
+    """
+    if FETCH_FORMAT == 'arrow':
+        return arrow_to_frame(client.query_arrow(sql, settings=settings, use_strings=True), client.server_tz)
+    if not (QUERY_STATS and settings and 'query_id' in settings):
+        return client.query_df(sql, settings=settings)
+    # wait_end_of_query: the summary header is sent before the body, so it is only final if the
+    # server holds the response until the query has finished
+    result = client.query(context=client.create_query_context(
+        query=sql, settings={**settings, 'wait_end_of_query': 1}, use_numpy=True, as_pandas=True))
+    with _metrics_lock:
+        run_metrics.setdefault('query_summaries', {})[settings['query_id']] = result.summary
+    return result.df_result
+
+
+# ---------------- RESULT CACHE ----------------
+_cache_lock = threading.Lock()
+
+
+def enable_result_cache():
+    """Turn on the result cache and pin the window end to a rounded timestamp.
+
+    Rounding to RESULT_CACHE_GRANULARITY_SECONDS makes reruns within the same slot produce
+    identical query text, so they hit the cache instead of ClickHouse.
+    """
+    global RESULT_CACHE_ENABLED
+    RESULT_CACHE_ENABLED = True
+    anchor = int(time.time()) // RESULT_CACHE_GRANULARITY_SECONDS * RESULT_CACHE_GRANULARITY_SECONDS
+    set_report_window(end=f"toDateTime({anchor})")
+    print(f"Result cache enabled (window end pinned to {datetime.fromtimestamp(anchor)}, TTL {RESULT_CACHE_TTL_SECONDS}s)")
+
+
+def result_cache_path(sql: str) -> str:
+    key = hashlib.sha256(f"{CLICK_PARAMS['database']}\n{sql}".encode()).hexdigest()
+    return os.path.join(RESULT_CACHE_DIR, f"{key}.arrow")
+
+
+def cache_get(name: str, sql: str):
+    """Return the cached result of `sql`, or None if it is missing or older than the TTL."""
+    path = result_cache_path(sql)
+    try:
+        created = os.path.getmtime(path)
+        if time.time() - created > RESULT_CACHE_TTL_SECONDS:
+            print(f"Cache miss for query '{name}' (expired)")
+            return None
+        df = pd.read_feather(path)
+        # atime records the last use for LRU eviction; mtime keeps the creation time for the TTL
+        os.utime(path, (time.time(), created))
+    except FileNotFoundError:
+        print(f"Cache miss for query '{name}'")
+        return None
     except Exception as e:
-        print(f"An unexpected error occurred: {e}")
-        raise
-# CORRECTED FUNCTION SIGNATURE: Added rework_completed_demo argument
-def create_html_table(df_demo: pd.DataFrame, df_non_demo: pd.DataFrame, active_demo_cases: pd.DataFrame, active_non_demo_cases: pd.DataFrame, tat_breach_demo: pd.DataFrame, rework_completed_demo: pd.DataFrame) -> str:
-    """Convert DataFrames to a professional and compact HTML email with separate boxes and a clean table."""
-    # Summary stats are calculated on ALL demo data from the query
-    
-    # Exclude 'DELETED' cases from the total count
-    completed_and_active_df = df_demo[df_demo['Final_Status'] != 'DELETED']
-    total_cases = len(completed_and_active_df)
-    
-    active_cases = len(active_demo_cases)
-    
-    completed_df = df_demo[df_demo['Final_Status'].isin(['Completed', 'Rework Completed'])]
-    completed_cases = len(completed_df)
-    
-    if len(completed_df) > 0:
-        within_tat_completed = completed_df[completed_df['TAT_Flag'] == 'Green']
-        green_tat = len(within_tat_completed)
-        red_tat = len(completed_df) - green_tat
-    else:
-        green_tat = 0
-        red_tat = 0
-    
-    # Prepare data for HTML tables
-    demo_table_data = active_demo_cases.copy()
-    non_demo_table_data = active_non_demo_cases.copy()
-    tat_breach_demo_data = tat_breach_demo.copy()
-    rework_table_data = rework_completed_demo.copy()
-    
-    # Apply hyperlink formatting to all dataframes
-    for df in [demo_table_data, non_demo_table_data, tat_breach_demo_data, rework_table_data]:
-        if not df.empty and 'Study_Link' in df.columns:
-            df['Client_Name'] = df.apply(
-                lambda row: f'<a href="{row["Study_Link"]}" target="_blank">{row["Client_Name"]}</a>',
-                axis=1
-            )
-            df.drop('Study_Link', axis=1, inplace=True)
+        print(f"Cache miss for query '{name}' (unreadable entry: {e})")
+        return None
+    print(f"Cache hit for query '{name}' ({len(df)} rows, age {time.time() - created:.0f}s)")
+    return df
 
-    # --- HTML Generation ---
-    html = f"""
-    <!DOCTYPE html>
-    <html lang="en">
-    <head>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>Active Cases Report</title>
-        <style>
-            body {{
-                font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, Helvetica, Arial, sans-serif;
-                margin: 0;
-                padding: 15px;
-                background-color: #f7f9fc;
-                color: #333;
-            }}
-            .container {{
-                max-width: 1200px;
-                margin: 0 auto;
-                background-color: #ffffff;
-                border-radius: 8px;
-                box-shadow: 0 4px 12px rgba(0,0,0,0.08);
-                overflow: hidden;
-            }}
-            .header {{
-                background-color: #3f51b5;
-                color: white;
+
+def cache_fresh(sql: str) -> bool:
+    """True if `sql` has a cache entry younger than the TTL (the entry itself is not read)."""
+    try:
+        return time.time() - os.path.getmtime(result_cache_path(sql)) <= RESULT_CACHE_TTL_SECONDS
+    except OSError:
+        return False
+
+
+def cache_put(name: str, sql: str, df: pd.DataFrame):
+    """Store a query result, then evict expired and least recently used entries. Never fails the run."""
+    path = result_cache_path(sql)
+    try:
+        os.makedirs(RESULT_CACHE_DIR, exist_ok=True)
+        df.reset_index(drop=True).to_feather(path + '.tmp', compression='zstd')
+        os.replace(path + '.tmp', path)
+    except Exception as e:
+        print(f"Could not cache result of query '{name}': {e}")
+        return
+    evict_result_cache()
+
+
+def evict_result_cache():
+    """Drop expired entries, then the least recently used ones until under RESULT_CACHE_MAX_BYTES."""
+    with _cache_lock:
+        now = time.time()
+        entries = []
+        for entry in os.scandir(RESULT_CACHE_DIR):
+            if not entry.name.endswith('.arrow'):
+                continue
+            stat = entry.stat()
+            if now - stat.st_mtime > RESULT_CACHE_TTL_SECONDS:
+                os.remove(entry.path)
+            else:
+                entries.append((stat.st_atime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= RESULT_CACHE_MAX_BYTES:
+                break
+            os.remove(path)
+            total -= size
+
+
+# Elapsed seconds of the most recent run of each named query (reported by --daemon)
+last_query_timings = {}
+
+
+def run_queries_concurrently(queries: dict, raise_on_error: bool = True) -> dict:
+    """Run several named queries at once, each on its own pooled client.
+
+    Returns a dict of DataFrames keyed like `queries`. Per-query timings are printed; if any
+    query fails all errors are reported and the first one is re-raised (unless raise_on_error
+    is False, in which case failed queries are simply missing from the result).
+    """
+    def timed_query(name, sql):
+        start = time.perf_counter()
+        df = cache_get(name, sql) if RESULT_CACHE_ENABLED else None
+        if df is None:
+            with pooled_client() as client:
+                df = query_frame(client, sql, settings=query_settings(name))
+            if RESULT_CACHE_ENABLED:
+                cache_put(name, sql, df)
+        return df, time.perf_counter() - start
+
+    results, errors = {}, {}
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=min(QUERY_CONCURRENCY, len(queries)) or 1) as executor:
+        futures = {executor.submit(timed_query, name, sql): name for name, sql in queries.items()}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                results[name], elapsed = future.result()
+                last_query_timings[name] = round(elapsed, 3)
+                add_metric('stages_s', elapsed, f'query_{name}')
+                add_metric('rows', len(results[name]), name)
+                print(f"Query '{name}' finished in {elapsed:.2f}s ({len(results[name])} rows)")
+            except Exception as e:
+                errors[name] = e
+                print(f"❌ Query '{name}' failed: {e}")
+    print(f"All queries finished in {time.perf_counter() - start:.2f}s")
+
+    if errors and raise_on_error:
+        raise next(iter(errors.values()))
+    return results
+
+
+def load_incremental_state() -> dict:
+    """Load the watermark and snapshots saved by the previous incremental run, if any."""
+    state_file = os.path.join(STATE_DIR, 'state.json')
+    demo_file = os.path.join(STATE_DIR, 'demo_snapshot.pkl')
+    non_demo_file = os.path.join(STATE_DIR, 'non_demo_snapshot.pkl')
+    if not all(os.path.exists(path) for path in (state_file, demo_file, non_demo_file)):
+        return {}
+
+    try:
+        with open(state_file) as f:
+            state = json.load(f)
+        state['df_demo'] = pd.read_pickle(demo_file)
+        state['df_non_demo'] = pd.read_pickle(non_demo_file)
+    except Exception as e:
+        print(f"Could not read incremental state, falling back to a full scan: {e}")
+        return {}
+    return state
+
+
+def save_incremental_state(state: dict, df_demo: pd.DataFrame, df_non_demo: pd.DataFrame):
+    """Persist the watermark and snapshots atomically so a crashed run never leaves a half-written state."""
+    os.makedirs(STATE_DIR, exist_ok=True)
+    for name, df in (('demo_snapshot.pkl', df_demo), ('non_demo_snapshot.pkl', df_non_demo)):
+        path = os.path.join(STATE_DIR, name)
+        df.to_pickle(path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+    path = os.path.join(STATE_DIR, 'state.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(path + '.tmp', path)
+
+
+def merge_snapshot(snapshot: pd.DataFrame, changed: pd.DataFrame) -> pd.DataFrame:
+    """Replace every snapshot row of a re-fetched study with its fresh rows."""
+    if snapshot.empty:
+        return changed
+    if changed.empty:
+        return snapshot
+    kept = snapshot[~snapshot['Study_Id'].isin(changed['Study_Id'])]
+    return pd.concat([kept, changed], ignore_index=True)
+
+
+def fetch_incremental() -> tuple:
+    """Fetch only studies changed since the stored watermark and merge them into the local snapshot.
+
+    Falls back to a full scan when there is no usable state, the database changed, the last
+    full scan is older than INCREMENTAL_FULL_REFRESH_HOURS, or the incremental queries fail
+    (e.g. a change-timestamp column missing on this server).
+    """
+    # Server clock for both the next watermark and the window cutoff, so local clock skew
+    # and timezone handling can't open gaps between runs.
+    with pooled_client() as client:
+        clock = query_frame(client, f"""
+            SELECT toUnixTimestamp(now()) AS epoch, now() - INTERVAL {REPORT_WINDOW_DAYS} DAY AS window_start
+        """)
+    server_epoch = int(clock['epoch'].iloc[0])
+    window_start = clock['window_start'].iloc[0]
+
+    state = load_incremental_state()
+    full_refresh_due = (
+        not state
+        or state.get('database') != CLICK_PARAMS['database']
+        or state.get('dimension_cache', False) != DIMENSION_CACHE  # snapshot holds the other query variant
+        or server_epoch - state.get('full_refresh_epoch', 0) > INCREMENTAL_FULL_REFRESH_HOURS * 3600
+    )
+
+    demo_template, non_demo_template = report_templates()
+    if not full_refresh_due:
+        watermark = state['watermark'] - INCREMENTAL_OVERLAP_SECONDS
+        changed_studies = CHANGED_STUDIES_SQL.format(watermark=watermark)
+        print(f"Incremental mode: fetching studies changed since {datetime.fromtimestamp(watermark)}...")
+        try:
+            results = run_queries_concurrently({
+                'demo': render_query(
+                    demo_template,
+                    INCREMENTAL_DEMO_FILTER.format(changed_studies=changed_studies)),
+                'non_demo': render_query(
+                    non_demo_template,
+                    INCREMENTAL_NON_DEMO_FILTER.format(changed_studies=changed_studies, watermark=watermark)),
+            })
+        except Exception as e:
+            print(f"Incremental fetch failed, falling back to a full scan "
+                  f"(check TAT_METRICS_CHANGE_COLUMN / REWORKS_CHANGE_COLUMN): {e}")
+            full_refresh_due = True
+
+    if full_refresh_due:
+        print("Incremental mode: running a full scan...")
+        # The ad-hoc query even with --source state: incremental fetches can't come from the
+        # state table, and one snapshot must not mix the two sources.
+        results = run_queries_concurrently({'demo': render_query(demo_template),
+                                            'non_demo': render_query(non_demo_template)})
+        df_demo, df_non_demo = results['demo'], results['non_demo']
+        print(f"Demo query returned {len(df_demo)} rows, non-demo query returned {len(df_non_demo)} rows")
+        full_refresh_epoch = server_epoch
+    else:
+        changed_demo, changed_non_demo = results['demo'], results['non_demo']
+        print(f"Demo query returned {len(changed_demo)} changed rows, non-demo query returned {len(changed_non_demo)} changed rows")
+
+        df_demo = merge_snapshot(state['df_demo'], changed_demo)
+        df_non_demo = merge_snapshot(state['df_non_demo'], changed_non_demo)
+
+        # Age out rows that have left the window; real cases only stay while their client
+        # still has a demo case in the window (mirrors demo_clients in NON_DEMO_QUERY).
+        if not df_demo.empty:
+            df_demo = df_demo[df_demo['Activated_Time'] >= window_start]
+        if not df_non_demo.empty:
+            df_non_demo = df_non_demo[
+                (df_non_demo['Study_Created_Time'] >= window_start)
+                & df_non_demo['Client_Id'].isin(df_demo['Client_Id'] if not df_demo.empty else [])
+            ]
+
+        # Restore the ordering the full queries return
+        if not df_demo.empty:
+            df_demo = df_demo.sort_values(['Final_Status', 'Activated_Time'], kind='stable', ignore_index=True)
+        if not df_non_demo.empty:
+            df_non_demo = df_non_demo.sort_values(['Client_Id', 'Study_Created_Time'], kind='stable', ignore_index=True)
+        full_refresh_epoch = state['full_refresh_epoch']
+
+        print(f"Snapshot now holds {len(df_demo)} demo rows and {len(df_non_demo)} non-demo rows")
+
+    save_incremental_state({
+        'database': CLICK_PARAMS['database'],
+        'dimension_cache': DIMENSION_CACHE,
+        'watermark': server_epoch,
+        'full_refresh_epoch': full_refresh_epoch,
+    }, df_demo, df_non_demo)
+    return df_demo, df_non_demo
+
+
+def report_queries(server_summary: bool = False, windows: list = None) -> dict:
+    """The named queries of a full (non-incremental) report run; see execute_query_and_send_email."""
+    if windows:
+        return windowed_queries(windows)
+    queries = {'demo': QUERY, 'non_demo': NON_DEMO_QUERY}
+    if server_summary:
+        queries['demo'] = DEMO_DETAIL_QUERY.format(demo_query=QUERY)
+        queries['summary'] = DEMO_SUMMARY_QUERY.format(demo_query=QUERY)
+    return queries
+
+
+def probe_active_cases() -> tuple:
+    """Return (candidate_demo, candidate_non_demo) from the probe query, each 0 or 1.
+
+    Reads a single row through client.query, so a no-op run never imports pandas.
+    """
+    with pooled_client() as client:
+        row = client.query(render_query(PROBE_QUERY_TEMPLATE), settings=query_settings('probe', record=False)).first_row
+    return int(row[0]), int(row[1])
+
+
+def summary_stats(summary: dict) -> dict:
+    """Query-log shaped stats from an X-ClickHouse-Summary dict (memory only on servers that report it)."""
+    stats = {column: int(summary.get(column, 0)) for column in ('read_rows', 'read_bytes')}
+    if 'result_rows' in summary:
+        stats['result_rows'] = int(summary['result_rows'])
+    stats['query_duration_ms'] = int(summary.get('elapsed_ns', 0)) // 1_000_000
+    memory = summary.get('memory_usage', summary.get('peak_memory_usage'))
+    if memory is not None:
+        stats['memory_usage'] = int(memory)
+    return stats
+
+
+def collect_query_stats():
+    """Put the server-side cost of this run's queries into run_metrics['query_stats'].
+
+    Queries run through query_df come with their summary (see query_frame); the rest (the
+    Arrow path) are looked up in system.query_log by query_id. Failures are logged, never
+    raised: stats must not fail a report that was already sent.
+    """
+    query_ids = run_metrics.get('query_ids', {})
+    summaries = run_metrics.pop('query_summaries', {})
+    for name, query_id in query_ids.items():
+        if summaries.get(query_id):
+            run_metrics['query_stats'][name] = summary_stats(summaries[query_id])
+    missing = {name: query_id for name, query_id in query_ids.items() if name not in run_metrics['query_stats']}
+    if missing:
+        try:
+            with timed_stage('query_stats'), pooled_client() as client:
+                stats = fetch_query_log_stats(client, list(missing.values()))
+            for name, query_id in missing.items():
+                if query_id in stats.index:
+                    run_metrics['query_stats'][name] = {column: int(value) for column, value in stats.loc[query_id].items()}
+        except Exception as e:
+            print(f"Could not read query stats from system.query_log: {e}")
+    for name, values in run_metrics['query_stats'].items():
+        memory = f", {values['memory_usage'] / 1e6:,.1f} MB memory" if 'memory_usage' in values else ''
+        print(f"Query '{name}': read {values['read_rows']:,} rows / {values['read_bytes'] / 1e6:,.1f} MB, "
+              f"{values['query_duration_ms']} ms{memory} on the server")
+
+
+def profile_queries(queries: dict) -> str:
+    """Save EXPLAIN PIPELINE and EXPLAIN indexes = 1 of each query; returns the output directory."""
+    out_dir = os.path.join(PROFILE_DIR, f"{datetime.now():%Y%m%d-%H%M%S}-{run_metrics.get('run_id', 'adhoc')}")
+    os.makedirs(out_dir, exist_ok=True)
+    with timed_stage('profile'), pooled_client() as client:
+        for name, sql in queries.items():
+            for kind, explain in (('pipeline', 'EXPLAIN PIPELINE'), ('indexes', 'EXPLAIN indexes = 1')):
+                plan = client.query(f"{explain}\n{sql}", settings=query_settings(f'explain_{kind}_{name}', record=False))
+                with open(os.path.join(out_dir, f"{name}.{kind}.txt"), 'w') as f:
+                    f.write('\n'.join(str(row[0]) for row in plan.result_rows) + '\n')
+    run_metrics['profile_dir'] = out_dir
+    print(f"Query plans saved to {out_dir}")
+    return out_dir
+
+
+def execute_query_and_send_email(incremental: bool = False, server_summary: bool = False, fanout: bool = False,
+                                 windows: list = None):
+    """Run queries on ClickHouse, format results, and send email.
+
+    With incremental=True only studies changed since the last run are fetched and merged
+    into a locally held snapshot (see fetch_incremental). With server_summary=True the summary
+    cards are aggregated in ClickHouse and only demo rows shown in a table are fetched.
+    With fanout=True the same result set is split into one report per routed pod / owner
+    (see fanout_reports) instead of one report to RECIPIENT_EMAILS. With windows (days,
+    ascending, the largest being the current report window) one report shows summary cards
+    for every window and tags each table row with its smallest window (see windowed_queries).
+    """
+    summary = window_summaries = None
+    start_run_metrics()
+    status = 'ok'
+    try:
+        if OUTBOX_ENABLED:
+            backlog = run_metrics['outbox_backlog'] = outbox_backlog()
+            if backlog >= OUTBOX_MAX_PENDING:
+                # Delivery is failing or far behind; more reports would only pile up unsent
+                print(f"Outbox holds {backlog} undelivered emails (OUTBOX_MAX_PENDING={OUTBOX_MAX_PENDING}). "
+                      "Skipping this run.")
+                return
+
+        queries = None if incremental else report_queries(server_summary, windows)
+        # The probe costs a ClickHouse round trip of its own: not worth it when every result is
+        # cached, nor in front of the cheap state-table read.
+        cached = RESULT_CACHE_ENABLED and queries and all(cache_fresh(sql) for sql in queries.values())
+        if FAST_PATH_PROBE and DEMO_SOURCE != 'state' and not cached:
+            started = time.perf_counter()
+            with timed_stage('probe'):
+                candidate_demo, candidate_non_demo = probe_active_cases()
+            print(f"Probe found {'' if candidate_demo else 'no '}candidate demo cases and "
+                  f"{'' if candidate_non_demo else 'no '}candidate non-demo cases in {time.perf_counter() - started:.2f}s")
+            if not candidate_demo and not candidate_non_demo:
+                print("No active cases found. Email will not be sent.")
+                return
+
+        if incremental:
+            with timed_stage('fetch_incremental'):
+                df_demo, df_non_demo = fetch_incremental()
+        else:
+            print("Executing demo and non-demo cases queries...")
+            if PROFILE_QUERIES:
+                profile_queries(queries)
+            results = run_queries_concurrently(queries)
+            df_demo, df_non_demo = results['demo'], results['non_demo']
+            if windows:
+                df_demo, df_non_demo, window_summaries = split_windowed_results(df_demo, df_non_demo, windows)
+                summary = window_summaries[windows[-1]]
+            elif server_summary:
+                summary = summary_from_counts(results['summary'])
+            print(f"Demo query returned {len(df_demo)} rows")
+            print(f"Non-demo query returned {len(df_non_demo)} rows")
+
+        if df_demo.empty and df_non_demo.empty:
+            print("No data found.")
+            return
+        df_demo, df_non_demo = enrich_frames(df_demo, df_non_demo)
+
+        if fanout:
+            with timed_stage('classify'):
+                reports = fanout_reports(df_demo, df_non_demo, load_routing())
+            if HISTORY_ENABLED:
+                with timed_stage('history'):
+                    append_run_history(classify_cases(df_demo, df_non_demo), run_metrics['run_id'])
+            send_fanout(reports)
+            return
+
+        with timed_stage('classify'):
+            report = classify_cases(df_demo, df_non_demo, summary, with_completed=CHANGE_DETECTION and DELTA_MODE)
+        if window_summaries:
+            report['window_summaries'] = window_summaries
+        sections = report['sections']
+        if HISTORY_ENABLED:
+            with timed_stage('history'):
+                append_run_history(report, run_metrics['run_id'])
+
+        # The email will ONLY be sent if there are active cases.
+        if sections['active_demo'].empty and sections['active_non_demo'].empty:
+            print("No active cases found. Email will not be sent.")
+            return
+
+        print(f"Found {len(sections['active_demo'])} active demo cases, {len(sections['active_non_demo'])} active non-demo cases")
+        print(f"Found {len(sections['tat_breach_demo'])} TAT breach demo cases")
+        print(f"Found {len(sections['rework_completed_demo'])} rework completed demo cases")
+
+        if CHANGE_DETECTION:
+            digests = load_digests()
+            report, fingerprint = report_to_send(report, digests.get('report'))
+            if report is None:
+                print("Report unchanged since the last email. Email will not be sent.")
+                return
+
+        # Convert to HTML tables
+        print("Creating HTML table...")
+        with timed_stage('render'):
+            html_content, attachments = render_email(report)
+        add_metric('html_bytes', len(html_content.encode('utf-8')))
+
+        # Send email to multiple recipients
+        print("Sending email...")
+        with timed_stage('send'):
+            deliver_report(html_content, RECIPIENT_EMAILS, scope='New cases' if CHANGE_DETECTION and DELTA_MODE else None,
+                           attachments=attachments)
+        print("Email queued for delivery." if OUTBOX_ENABLED else "Email sent successfully!")
+
+        if CHANGE_DETECTION:
+            digests['report'] = fingerprint
+            save_digests(digests)
+
+    except Exception as e:
+        status = 'error'
+        print(f"An unexpected error occurred: {e}")
+        raise
+    finally:
+        if QUERY_STATS and run_metrics['query_ids']:
+            collect_query_stats()
+        export_run_metrics(status)
+
+
+# ---------------- DIMENSION CACHE ----------------
+# Client attributes and the QC roster as compact lookups: a pd.Index of client ids with one
+# object array per client column, and a sorted array of roster qc ids. Kept in memory (daemon)
+# and pickled under DIMENSION_CACHE_DIR (cron runs).
+_dimensions = {}
+CLIENT_DIMENSION_COLUMNS = ('Client_Name', 'Clinet_source', 'assigned_to', 'pod_name')
+# Columns DEMO_FACT_QUERY_TEMPLATE returns only as inputs of enrich_frame
+FACT_INPUT_COLUMNS = ('study_status', 'latest_status', 'rad_fk', 'iqca_fk')
+
+
+def load_dimensions(force: bool = False) -> dict:
+    """Return the dimension lookups, re-fetching them when older than DIMENSION_TTL_SECONDS."""
+    now = time.time()
+    if not force and _dimensions and now - _dimensions['loaded_at'] <= DIMENSION_TTL_SECONDS:
+        return _dimensions
+
+    path = os.path.join(DIMENSION_CACHE_DIR, 'dimensions.pkl')
+    if not force:
+        try:
+            if now - os.path.getmtime(path) <= DIMENSION_TTL_SECONDS:
+                dims = pd.read_pickle(path)
+                if dims.get('database') == CLICK_PARAMS['database']:
+                    _dimensions.clear()
+                    _dimensions.update(dims)
+                    return _dimensions
+        except Exception as e:
+            if not isinstance(e, FileNotFoundError):
+                print(f"Could not read the dimension cache, re-fetching: {e}")
+
+    print("Refreshing dimension cache...")
+    with timed_stage('dimensions'):
+        results = run_queries_concurrently({'clients': CLIENT_DIMENSION_QUERY, 'qc_roster': QC_ROSTER_QUERY})
+    # ClientDetails / client_group may hold several rows per client; keep one, as dictionaries would
+    clients = results['clients'].drop_duplicates('Client_Id')
+    roster = results['qc_roster']['qc_fk'].dropna()
+    dims = {
+        'database': CLICK_PARAMS['database'],
+        'loaded_at': now,
+        'client_ids': pd.Index(clients['Client_Id'].to_numpy()),
+        'client_columns': {column: clients[column].to_numpy(dtype=object) for column in CLIENT_DIMENSION_COLUMNS},
+        'qc_roster': np.unique(roster.to_numpy(dtype=np.int64)),
+    }
+    try:
+        os.makedirs(DIMENSION_CACHE_DIR, exist_ok=True)
+        pd.to_pickle(dims, path + '.tmp')
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        print(f"Could not write the dimension cache: {e}")
+    print(f"Dimension cache: {len(clients)} clients, {len(dims['qc_roster'])} QC roster ids")
+    _dimensions.clear()
+    _dimensions.update(dims)
+    return _dimensions
+
+
+def enrich_frame(df: pd.DataFrame, dims: dict) -> pd.DataFrame:
+    """Add the dimension columns to a DEMO_FACT / NON_DEMO_FACT query result.
+
+    Client columns are looked up by Client_Id in one vectorized indexer pass; Current_Bucket
+    and category_manager are derived from the rad / preread inputs with the same CASE order
+    as the demo query, including its NULL handling (NULL never matches IN or NOT IN).
+    Frames that already carry the columns (full queries, the state table) are returned as is.
+    """
+    if 'Client_Name' in df.columns:
+        return df
+    is_demo = 'rad_fk' in df.columns
+    columns = DEMO_REPORT_COLUMNS if is_demo else NON_DEMO_REPORT_COLUMNS
+    df = df.copy()
+
+    positions = dims['client_ids'].get_indexer(df['Client_Id'].to_numpy())
+    unknown = positions < 0
+    for column, values in dims['client_columns'].items():
+        if column in columns:
+            looked_up = values.take(positions) if len(values) else np.full(len(df), None, dtype=object)
+            looked_up[unknown] = None
+            df[column] = pd.Series(looked_up, index=df.index, dtype=object)
+
+    if is_demo:
+        rad_fk, iqca_fk = df['rad_fk'], df['iqca_fk']
+        hil = rad_fk.isin(HIL_RADIOLOGIST_IDS).to_numpy()
+        not_hil = (rad_fk.notna() & ~rad_fk.isin(HIL_RADIOLOGIST_IDS)).to_numpy()
+        merged = (df['study_status'] == 'MERGED').fillna(False).to_numpy(dtype=bool)
+        preread = df['latest_status'].isin(PREREAD_STATUSES).to_numpy()
+        preread_agent = preread & iqca_fk.notna().to_numpy()
+        on_roster = iqca_fk.isin(dims['qc_roster']).to_numpy()
+        not_excluded = (rad_fk.notna() & ~rad_fk.isin(RUKSANA_EXCLUDED_RAD_IDS)).to_numpy()
+
+        current_bucket = np.select(
+            [merged & hil, merged & not_hil, preread, hil, not_hil],
+            np.array(['HIL', 'Radiologist', 'Preread', 'HIL', 'Radiologist'], dtype=object), default=None)
+        category_manager = np.select(
+            [hil, preread_agent & ~on_roster, preread_agent & on_roster, not_excluded],
+            np.array(['Keerthana R', 'Bhuvaneswaran', 'Santosh Kumar', 'Ruksana'], dtype=object), default=None)
+        # object dtype with None for NULL, like query_df's string columns
+        df['Current_Bucket'] = pd.Series(current_bucket, index=df.index, dtype=object)
+        df['category_manager'] = pd.Series(category_manager, index=df.index, dtype=object)
+    # Columns added around the report queries (e.g. Report_Window, --windows) are kept at the end
+    extra = [column for column in df.columns if column not in columns and column not in FACT_INPUT_COLUMNS]
+    return df[list(columns) + extra]
+
+
+def enrich_frames(df_demo: pd.DataFrame, df_non_demo: pd.DataFrame) -> tuple:
+    """Enrich both report frames from the dimension cache when DIMENSION_CACHE is on."""
+    if not DIMENSION_CACHE:
+        return df_demo, df_non_demo
+    dims = load_dimensions()
+    with timed_stage('enrich'):
+        return enrich_frame(df_demo, dims), enrich_frame(df_non_demo, dims)
+
+
+# ---------------- CLASSIFICATION ----------------
+# Report class of each Final_Status; any status not listed (Pending, ...) is active.
+ACTIVE, COMPLETED, REWORK_COMPLETED, DELETED = range(4)
+DEMO_STATUS_CLASSES = {'Completed': COMPLETED, 'Rework Completed': REWORK_COMPLETED, 'DELETED': DELETED}
+NON_DEMO_STATUS_CLASSES = {'COMPLETED': COMPLETED, 'DELETED': DELETED}
+
+
+def status_classes(statuses: pd.Series, classes: dict) -> np.ndarray:
+    """Map every row's status to its report class with one categorical encode + array lookup.
+
+    The class is resolved once per distinct status instead of once per row; missing statuses
+    count as active, as they did with the old `~isin(...)` masks.
+    """
+    status = pd.Categorical(statuses)
+    lookup = np.array([classes.get(category, ACTIVE) for category in status.categories] + [ACTIVE], dtype=np.int8)
+    return lookup[status.codes]  # code -1 (missing) picks the trailing ACTIVE
+
+
+def summary_from_counts(counts: pd.DataFrame) -> dict:
+    """Turn the single-row result of DEMO_SUMMARY_QUERY into classify_cases' summary dict."""
+    summary = {name: int(value) for name, value in counts.iloc[0].items()}
+    summary['exceeding_tat'] = summary['completed_demo'] - summary['within_tat']
+    return summary
+
+
+def demo_row_classes(df_demo: pd.DataFrame) -> tuple:
+    """Per-row report class of the demo rows plus their completed / red TAT / green TAT masks."""
+    if df_demo.empty:
+        return np.empty(0, np.int8), np.empty(0, bool), np.empty(0, bool), np.empty(0, bool)
+    demo_class = status_classes(df_demo['Final_Status'], DEMO_STATUS_CLASSES)
+    completed = (demo_class == COMPLETED) | (demo_class == REWORK_COMPLETED)
+    red_tat = (df_demo['TAT_Flag'] == 'Red').fillna(False).to_numpy(dtype=bool)
+    green_tat = (df_demo['TAT_Flag'] == 'Green').fillna(False).to_numpy(dtype=bool)
+    return demo_class, completed, red_tat, green_tat
+
+
+def non_demo_row_classes(df_non_demo: pd.DataFrame) -> np.ndarray:
+    """Per-row report class of the first-5 real case rows."""
+    if df_non_demo.empty:
+        return np.empty(0, np.int8)
+    return status_classes(df_non_demo['Final_Status'], NON_DEMO_STATUS_CLASSES)
+
+
+def classify_demo(df_demo: pd.DataFrame, summary: dict = None, rows: np.ndarray = None, classes: tuple = None,
+                  with_completed: bool = False) -> tuple:
+    """Classify demo rows in a single pass into summary counts and the three demo sections.
+
+    A demo row can be in more than one section (a red-TAT rework is both a rework and a
+    breach), so each section is taken by row positions rather than by a single label.
+    `rows` limits the report to those positions (one fan-out group); `classes` reuses
+    demo_row_classes already computed for the whole frame. with_completed=True adds every
+    Completed row as 'completed_demo', from which DELTA_MODE picks the newly completed cases.
+    """
+    demo_class, completed, red_tat, green_tat = classes or demo_row_classes(df_demo)
+    if rows is None:
+        rows = np.arange(len(demo_class))
+    else:
+        demo_class, completed, red_tat, green_tat = (a[rows] for a in (demo_class, completed, red_tat, green_tat))
+
+    counts = np.bincount(demo_class, minlength=4)
+    completed_demo = int(counts[COMPLETED] + counts[REWORK_COMPLETED])
+    within_tat = int(np.count_nonzero(completed & green_tat))
+
+    summary = summary or {
+        'total_demo': len(demo_class) - int(counts[DELETED]),
+        'active_demo': int(counts[ACTIVE]),
+        'completed_demo': completed_demo,
+        'within_tat': within_tat,
+        # Anything completed but not explicitly Green counts as exceeding TAT
+        'exceeding_tat': completed_demo - within_tat,
+    }
+    sections = {
+        'active_demo': df_demo.take(rows[demo_class == ACTIVE]),
+        'rework_completed_demo': df_demo.take(rows[demo_class == REWORK_COMPLETED]),
+        'tat_breach_demo': df_demo.take(rows[completed & red_tat]),
+    }
+    if with_completed:
+        sections['completed_demo'] = df_demo.take(rows[demo_class == COMPLETED])
+    return summary, sections
+
+
+def classify_non_demo(df_non_demo: pd.DataFrame, rows: np.ndarray = None, classes: np.ndarray = None) -> dict:
+    """Select the active first-5 real cases (optionally only among `rows`, see classify_demo)."""
+    non_demo_class = non_demo_row_classes(df_non_demo) if classes is None else classes
+    if rows is None:
+        rows = np.arange(len(non_demo_class))
+    else:
+        non_demo_class = non_demo_class[rows]
+    return {'active_non_demo': df_non_demo.take(rows[non_demo_class == ACTIVE])}
+
+
+def classify_cases(df_demo: pd.DataFrame, df_non_demo: pd.DataFrame, summary: dict = None,
+                   with_completed: bool = False) -> dict:
+    """Classify both result sets into summary counts and per-section row sets.
+
+    Returns {'summary': {...}, 'sections': {...}} where sections are keyed like TABLE_SPECS
+    (plus 'completed_demo' with with_completed=True, see classify_demo). Pass `summary` when
+    the counts were already aggregated server-side and df_demo only holds detail rows.
+    """
+    summary, sections = classify_demo(df_demo, summary, with_completed=with_completed)
+    sections.update(classify_non_demo(df_non_demo))
+    return {'summary': summary, 'sections': sections}
+
+
+# ---------------- HTML TABLES ----------------
+# A table is a list of column specs. Each spec has a 'header' and either a 'column' to show
+# or a fixed 'text'. Optional keys:
+#   'link'      - column holding a URL; the cell becomes <a href=...>value</a>
+#   'strftime'  - format for datetime columns
+#   'badge'     - CSS class of a status-badge <span> wrapped around the value
+#   'css_class' - fixed CSS class of the <td>
+#   'class_map' - (column, {value: css_class}, default_class) computed per row
+def demo_case_columns(status_badge: str, tat_cell: dict) -> list:
+    """Column layout shared by the three demo case tables; only the status badge and TAT cell differ."""
+    return [
+        {'header': 'Client Name', 'column': 'Client_Name', 'link': 'Study_Link'},
+        {'header': 'Activated', 'column': 'Activated_Time', 'strftime': '%b %d, %H:%M'},
+        {'header': 'Status', 'column': 'Final_Status', 'badge': status_badge},
+        {'header': 'Current Bucket', 'column': 'Current_Bucket'},
+        {'header': 'Modality', 'column': 'modality'},
+        dict(header='TAT (min)', **tat_cell),
+        {'header': 'Client Source', 'column': 'Clinet_source'},
+        {'header': 'Assigned To', 'column': 'assigned_to'},
+        {'header': 'Pod Name', 'column': 'pod_name'},
+        {'header': 'Case Tag', 'column': 'Case_Tag'},
+        {'header': 'Category Manager', 'column': 'category_manager'},
+    ]
+
+
+TABLE_SPECS = {
+    'active_demo': {
+        'title': 'Active Demo Cases',
+        'empty_message': 'No active demo cases found.',
+        'columns': demo_case_columns('status-pending', {'text': 'Pending', 'css_class': 'tat-pending'}),
+    },
+    'active_non_demo': {
+        'title': 'Active First 5 Real Cases',
+        'empty_message': 'No active real cases found.',
+        'columns': [
+            {'header': 'Client Name', 'column': 'Client_Name', 'link': 'Study_Link'},
+            {'header': 'Created', 'column': 'Study_Created_Time', 'strftime': '%b %d, %H:%M'},
+            {'header': 'Modality', 'column': 'modality'},
+            {'header': 'Status', 'column': 'Final_Status', 'badge': 'status-pending'},
+            {'header': 'TAT (min)', 'text': 'Pending', 'css_class': 'tat-pending'},
+            {'header': 'Tag', 'column': 'Tag'},
+            {'header': 'Assigned To', 'column': 'assigned_to'},
+            {'header': 'Pod Name', 'column': 'pod_name'},
+        ],
+    },
+    'rework_completed_demo': {
+        'title': '🔧 Rework Completed Demo Cases',
+        'empty_message': 'No rework completed demo cases found.',
+        'columns': demo_case_columns('status-rework', {
+            'column': 'tat_min', 'class_map': ('TAT_Flag', {'Red': 'tat-red'}, 'tat-green')}),
+    },
+    'tat_breach_demo': {
+        'title': '⚠️ TAT Breach Demo Cases (Completed)',
+        'empty_message': 'No TAT breach demo cases found.',
+        'columns': demo_case_columns('status-completed', {'column': 'tat_min', 'css_class': 'tat-red'}),
+    },
+}
+
+
+# Only in delta emails (DELTA_MODE): Completed cases that weren't in the previous email's report
+COMPLETED_DEMO_SPEC = {
+    'title': '✅ Newly Completed Demo Cases',
+    'empty_message': 'No newly completed demo cases.',
+    'columns': demo_case_columns('status-completed', {
+        'column': 'tat_min', 'class_map': ('TAT_Flag', {'Red': 'tat-red'}, 'tat-green')}),
+}
+
+# Extra last column of every table in a multi-window report (--windows)
+WINDOW_COLUMN = {'header': 'Window (Days)', 'column': 'Report_Window'}
+
+
+def window_table_specs(specs: dict = TABLE_SPECS) -> dict:
+    """`specs` with each row's smallest report window appended as a column."""
+    return {name: dict(spec, columns=spec['columns'] + [WINDOW_COLUMN]) for name, spec in specs.items()}
+
+
+def report_table_specs(report: dict) -> dict:
+    """Table specs of a classified report: TABLE_SPECS, plus newly completed cases in a delta
+    report, with the window column in a multi-window report."""
+    specs = dict(TABLE_SPECS, completed_demo=COMPLETED_DEMO_SPEC) if 'completed_demo' in report['sections'] else TABLE_SPECS
+    return window_table_specs(specs) if report.get('window_summaries') else specs
+
+
+def as_text(values: pd.Series) -> np.ndarray:
+    """Stringify a column in one vectorized call, rendering values exactly as str() would.
+
+    Missing values of categorical / Arrow-backed text columns render as 'None', the same as
+    the object columns query_df returns.
+    """
+    if not pd.api.types.is_numeric_dtype(values.dtype):
+        values = np.where(values.isna().to_numpy(), None, values.to_numpy(dtype=object))
+    return np.asarray(values, dtype=object).astype(str)
+
+
+def render_cells(df: pd.DataFrame, spec: dict) -> np.ndarray:
+    """Build the <td> strings of one column for every row at once."""
+    if 'text' in spec:
+        content = np.full(len(df), spec['text'])
+    elif 'strftime' in spec:
+        content = as_text(df[spec['column']].dt.strftime(spec['strftime']).fillna(''))
+    else:
+        content = as_text(df[spec['column']])
+
+    if 'link' in spec:
+        content = np.char.add(np.char.add(np.char.add(np.char.add(
+            '<a href="', as_text(df[spec['link']])), '" target="_blank">'), content), '</a>')
+    if 'badge' in spec:
+        content = np.char.add(np.char.add(f'<span class="status-badge {spec["badge"]}">', content), '</span>')
+
+    if 'class_map' in spec:
+        column, mapping, default = spec['class_map']
+        classes = as_text(df[column].map(mapping).fillna(default))
+        opening = np.char.add(np.char.add('<td class="', classes), '">')
+    elif 'css_class' in spec:
+        opening = f'<td class="{spec["css_class"]}">'
+    else:
+        opening = '<td>'
+    return np.char.add(np.char.add(opening, content), '</td>')
+
+
+def render_table_rows(df: pd.DataFrame, columns: list) -> str:
+    """Render a DataFrame's <tr> rows one column at a time instead of row by row."""
+    return "".join(render_row_array(df, columns).tolist())
+
+
+def render_row_array(df: pd.DataFrame, columns: list) -> np.ndarray:
+    """One rendered <tr> string per row of `df`."""
+    rows = np.full(len(df), '<tr>')
+    for spec in columns:
+        rows = np.char.add(rows, render_cells(df, spec))
+    return np.char.add(rows, '</tr>')
+
+
+def render_table_open(columns: list) -> str:
+    header = ''.join(f'<th>{spec["header"]}</th>' for spec in columns)
+    return f"""
+                <div class="table-container">
+                    <table>
+                        <thead>
+                            <tr>{header}</tr>
+                        </thead>
+                        <tbody>
+                            """
+
+
+TABLE_CLOSE = """
+                        </tbody>
+                    </table>
+                </div>"""
+
+REPORT_FOOTER = """
+            </div>
+            <div class="footer">
+                <p><strong>5C Network</strong> | Active Cases & TAT Breach Alert System</p>
+                <p>This email is sent when there are active cases or TAT breaches requiring attention</p>
+            </div>
+        </div>
+    </body>
+    </html>
+    """
+
+
+def create_html_table(report: dict) -> str:
+    """Convert a classified report (see classify_cases) to a professional and compact HTML email with separate boxes and a clean table."""
+    window_summaries = report.get('window_summaries')
+    specs = report_table_specs(report)
+    section_rows = {
+        name: [render_table_rows(df, specs[name]['columns'])] if not df.empty else []
+        for name, df in report['sections'].items()
+    }
+    return "".join(iter_html_chunks(report['summary'], section_rows, window_summaries, specs))
+
+
+def iter_html_chunks(summary: dict, section_rows: dict, window_summaries: dict = None, specs: dict = TABLE_SPECS,
+                     notes: dict = None):
+    """Yield the report document piece by piece.
+
+    `section_rows` maps every name in `specs` to an iterable of rendered <tr> chunks; a
+    section with no chunks gets its "no data" message instead of a table. `notes` holds
+    HTML shown after a section's table (e.g. that it was cut short).
+    """
+    notes = notes or {}
+    yield render_report_head(summary, window_summaries)
+    for name, spec in specs.items():
+        yield f'<h2>{spec["title"]}</h2>'
+        chunks = iter(section_rows[name])
+        first = next(chunks, None)
+        if first is None:
+            yield notes.get(name, f'<div class="no-data">{spec["empty_message"]}</div>')
+            continue
+        yield render_table_open(spec['columns'])
+        yield first
+        yield from chunks
+        yield TABLE_CLOSE
+        yield notes.get(name, '')
+    yield REPORT_FOOTER
+
+
+def render_report_head(summary: dict, window_summaries: dict = None) -> str:
+    """Document head, styles, header and summary cards.
+
+    With `window_summaries` ({days: summary}, see --windows) there is one row of cards per window.
+    """
+    cards = window_summaries or {REPORT_WINDOW_DAYS: summary}
+    # --- HTML Generation ---
+    return f"""
+    <!DOCTYPE html>
+    <html lang="en">
+    <head>
+        <meta charset="UTF-8">
+        <meta name="viewport" content="width=device-width, initial-scale=1.0">
+        <title>Active Cases Report</title>
+        <style>
+            body {{
+                font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, Helvetica, Arial, sans-serif;
+                margin: 0;
+                padding: 15px;
+                background-color: #f7f9fc;
+                color: #333;
+            }}
+            .container {{
+                max-width: 1200px;
+                margin: 0 auto;
+                background-color: #ffffff;
+                border-radius: 8px;
+                box-shadow: 0 4px 12px rgba(0,0,0,0.08);
+                overflow: hidden;
+            }}
+            .header {{
+                background-color: #3f51b5;
+                color: white;
                 padding: 8px 20px;
                 text-align: center;
             }}
@@ -496,8 +1951,20 @@ def create_html_table(df_demo: pd.DataFrame, df_non_demo: pd.DataFrame, active_d
                 <h1>🩺 5C Network Cases Report</h1>
                 <p>Generated on {datetime.now().strftime('%B %d, %Y at %I:%M %p')}</p>
             </div>
-            <div class="content">
-                <h2>📊 Summary - All Cases (Last 10 Days)</h2>
+            <div class="content">""" + "".join(render_summary_cards(counts, days) for days, counts in cards.items())
+
+
+def render_summary_cards(summary: dict, days: int) -> str:
+    """Summary card row of one report window."""
+    # Summary stats are calculated on ALL demo data from the query
+    total_cases = summary['total_demo']
+    active_cases = summary['active_demo']
+    completed_cases = summary['completed_demo']
+    green_tat = summary['within_tat']
+    red_tat = summary['exceeding_tat']
+
+    return f"""
+                <h2>📊 Summary - All Cases (Last {days} Day{'' if days == 1 else 's'})</h2>
                 <div class="summary-grid">
                     <div class="summary-card">
                         <h3>TOTAL DEMO</h3>
@@ -519,181 +1986,114 @@ def create_html_table(df_demo: pd.DataFrame, df_non_demo: pd.DataFrame, active_d
                         <h3>EXCEEDING TAT</h3>
                         <div class="number red-number">{red_tat}</div>
                     </div>
-                </div>
-                
-                <h2>Active Demo Cases</h2>"""
-    
-    if not demo_table_data.empty:
-        html += f"""
-                <div class="table-container">
-                    <table>
-                        <thead>
-                            <tr>
-                                <th>Client Name</th>
-                                <th>Activated</th>
-                                <th>Status</th>
-                                <th>Current Bucket</th>
-                                <th>Modality</th>
-                                <th>TAT (min)</th>
-                                <th>Client Source</th>
-                                <th>Assigned To</th>
-                                <th>Pod Name</th>
-                                <th>Case Tag</th>
-                                <th>Category Manager</th>
-                            </tr>
-                        </thead>
-                        <tbody>
-                            {"".join([f'''<tr>
-                                <td>{row["Client_Name"]}</td>
-                                <td>{row["Activated_Time"].strftime("%b %d, %H:%M")}</td>
-                                <td><span class="status-badge status-pending">{row["Final_Status"]}</span></td>
-                                <td>{row["Current_Bucket"]}</td>
-                                <td>{row["modality"]}</td>
-                                <td class="tat-pending">Pending</td>
-                                <td>{row["Clinet_source"]}</td>
-                                <td>{row["assigned_to"]}</td>
-                                <td>{row["pod_name"]}</td>
-                                <td>{row["Case_Tag"]}</td>
-                                <td>{row["category_manager"]}</td>
-                            </tr>''' for _, row in demo_table_data.iterrows()])}
-                        </tbody>
-                    </table>
-                </div>"""
-    else:
-        html += '<div class="no-data">No active demo cases found.</div>'
-    
-    html += '<h2>Active First 5 Real Cases</h2>'
-    
-    if not non_demo_table_data.empty:
-        html += f"""
-                <div class="table-container">
-                    <table>
-                        <thead>
-                            <tr>
-                                <th>Client Name</th>
-                                <th>Created</th>
-                                <th>Modality</th>
-                                <th>Status</th>
-                                <th>TAT (min)</th>
-                                <th>Tag</th>
-                                <th>Assigned To</th>
-                                <th>Pod Name</th>
-                            </tr>
-                        </thead>
-                        <tbody>
-                            {"".join([f'''<tr>
-                                <td>{row["Client_Name"]}</td>
-                                <td>{row["Study_Created_Time"].strftime("%b %d, %H:%M")}</td>
-                                <td>{row["modality"]}</td>
-                                <td><span class="status-badge status-pending">{row["Final_Status"]}</span></td>
-                                <td class="tat-pending">Pending</td>
-                                <td>{row["Tag"]}</td>
-                                <td>{row["assigned_to"]}</td>
-                                <td>{row["pod_name"]}</td>
-                            </tr>''' for _, row in non_demo_table_data.iterrows()])}
-                        </tbody>
-                    </table>
                 </div>"""
-    else:
-        html += '<div class="no-data">No active real cases found.</div>'
 
-    html += '<h2>🔧 Rework Completed Demo Cases</h2>'
-    
-    if not rework_table_data.empty:
-        html += f"""
-                <div class="table-container">
-                    <table>
-                        <thead>
-                            <tr>
-                                <th>Client Name</th>
-                                <th>Activated</th>
-                                <th>Status</th>
-                                <th>Current Bucket</th>
-                                <th>Modality</th>
-                                <th>TAT (min)</th>
-                                <th>Client Source</th>
-                                <th>Assigned To</th>
-                                <th>Pod Name</th>
-                                <th>Case Tag</th>
-                                <th>Category Manager</th>
-                            </tr>
-                        </thead>
-                        <tbody>
-                            {"".join([f'''<tr>
-                                <td>{row["Client_Name"]}</td>
-                                <td>{row["Activated_Time"].strftime("%b %d, %H:%M")}</td>
-                                <td><span class="status-badge status-rework">{row["Final_Status"]}</span></td>
-                                <td>{row["Current_Bucket"]}</td>
-                                <td>{row["modality"]}</td>
-                                <td class="{'tat-red' if row['TAT_Flag'] == 'Red' else 'tat-green'}">{row["tat_min"]}</td>
-                                <td>{row["Clinet_source"]}</td>
-                                <td>{row["assigned_to"]}</td>
-                                <td>{row["pod_name"]}</td>
-                                <td>{row["Case_Tag"]}</td>
-                                <td>{row["category_manager"]}</td>
-                            </tr>''' for _, row in rework_table_data.iterrows()])}
-                        </tbody>
-                    </table>
-                </div>"""
-    else:
-        html += '<div class="no-data">No rework completed demo cases found.</div>'
 
-    html += '<h2>⚠️ TAT Breach Demo Cases (Completed)</h2>'
-    
-    if not tat_breach_demo_data.empty:
-        html += f"""
-                <div class="table-container">
-                    <table>
-                        <thead>
-                            <tr>
-                                <th>Client Name</th>
-                                <th>Activated</th>
-                                <th>Status</th>
-                                <th>Current Bucket</th>
-                                <th>Modality</th>
-                                <th>TAT (min)</th>
-                                <th>Client Source</th>
-                                <th>Assigned To</th>
-                                <th>Pod Name</th>
-                                <th>Case Tag</th>
-                                <th>Category Manager</th>
-                            </tr>
-                        </thead>
-                        <tbody>
-                            {"".join([f'''<tr>
-                                <td>{row["Client_Name"]}</td>
-                                <td>{row["Activated_Time"].strftime("%b %d, %H:%M")}</td>
-                                <td><span class="status-badge status-completed">{row["Final_Status"]}</span></td>
-                                <td>{row["Current_Bucket"]}</td>
-                                <td>{row["modality"]}</td>
-                                <td class="tat-red">{row["tat_min"]}</td>
-                                <td>{row["Clinet_source"]}</td>
-                                <td>{row["assigned_to"]}</td>
-                                <td>{row["pod_name"]}</td>
-                                <td>{row["Case_Tag"]}</td>
-                                <td>{row["category_manager"]}</td>
-                            </tr>''' for _, row in tat_breach_demo_data.iterrows()])}
-                        </tbody>
-                    </table>
-                </div>"""
-    else:
-        html += '<div class="no-data">No TAT breach demo cases found.</div>'
+# ---------------- EMAIL SIZE BUDGET ----------------
+ATTACHMENT_TYPES = {'csv': ('csv.gz', 'application/gzip'), 'parquet': ('parquet', 'application/vnd.apache.parquet')}
 
-    html += f"""
-            </div>
-            <div class="footer">
-                <p><strong>5C Network</strong> | Active Cases & TAT Breach Alert System</p>
-                <p>This email is sent when there are active cases or TAT breaches requiring attention</p>
-            </div>
-        </div>
-    </body>
-    </html>
+
+def section_attachment(name: str, df: pd.DataFrame, columns: list) -> dict:
+    """The full section as a file built straight from the DataFrame (the columns its table shows).
+
+    Parquet needs pyarrow; without it the section is attached as gzip CSV.
     """
-    return html
+    import io
+
+    data = df[list(dict.fromkeys(spec[key] for spec in columns for key in ('column', 'link') if key in spec))]
+    buffer = io.BytesIO()
+    file_format = ATTACHMENT_FORMAT
+    if file_format == 'parquet':
+        try:
+            data.to_parquet(buffer, index=False, compression='zstd')
+        except ImportError as e:
+            print(f"Parquet attachments need pyarrow ({e}); attaching gzip CSV instead")
+            file_format = 'csv'
+    if file_format == 'csv':
+        data.to_csv(buffer, index=False, compression={'method': 'gzip', 'compresslevel': 6, 'mtime': 0})
+    extension, mime_type = ATTACHMENT_TYPES[file_format]
+    return {'section': name, 'filename': f"{name}-{datetime.now():%Y%m%d-%H%M}.{extension}",
+            'type': mime_type, 'content': buffer.getvalue()}
+
+
+def inline_row_count(df: pd.DataFrame, columns: list, row_limit: int) -> tuple:
+    """(rendered <tr> rows, how many of them fit INLINE_BYTE_LIMIT) for the first `row_limit` rows."""
+    rows = render_row_array(df.iloc[:row_limit], columns)
+    sizes = np.cumsum([len(row.encode('utf-8')) for row in rows.tolist()])
+    return rows, int(np.searchsorted(sizes, INLINE_BYTE_LIMIT, side='right'))
+
+
+def render_email(report: dict, row_limit: int = None) -> tuple:
+    """Render a report as email HTML within the size budget; returns (html, attachments).
+
+    Sections over INLINE_ROW_LIMIT rows or INLINE_BYTE_LIMIT bytes of table HTML show their
+    first rows and are attached in full (see section_attachment). While HTML plus base64
+    attachments exceed EMAIL_MAX_BYTES, the previews are halved as long as the HTML alone is
+    over the cap, then the largest attachments are dropped. Attachments are dicts with 'section', 'filename', 'type' and 'content' bytes.
+    """
+    row_limit = INLINE_ROW_LIMIT if row_limit is None else row_limit
+    window_summaries = report.get('window_summaries')
+    specs = report_table_specs(report)
+    files, omitted = {}, set()
+
+    while True:
+        section_rows, notes = {}, {}
+        for name, df in report['sections'].items():
+            if df.empty:
+                section_rows[name] = []
+                continue
+            columns = specs[name]['columns']
+            rows, fits = inline_row_count(df, columns, row_limit)
+            section_rows[name] = ["".join(rows[:fits].tolist())] if fits else []
+            if fits < len(df):
+                if name not in files:
+                    files[name] = section_attachment(name, df, columns)
+                where = ("was too large to attach" if name in omitted
+                         else f"is attached as {files[name]['filename']}")
+                notes[name] = f'<div class="no-data">Showing {fits} of {len(df)} rows; the full section {where}.</div>'
+        html_content = "".join(iter_html_chunks(report['summary'], section_rows, window_summaries, specs, notes))
+        attachments = [files[name] for name in notes if name not in omitted]
+        size = email_payload_bytes(html_content, attachments)
+        if size <= EMAIL_MAX_BYTES:
+            break
+        html_bytes = len(html_content.encode('utf-8'))
+        if html_bytes > EMAIL_MAX_BYTES and row_limit > 0:
+            row_limit //= 2
+        elif attachments:
+            omitted.add(max(attachments, key=lambda a: len(a['content']))['section'])
+        else:
+            print(f"⚠️  Email is {size} bytes even without tables or attachments (EMAIL_MAX_BYTES={EMAIL_MAX_BYTES})")
+            break
+
+    add_metric('email_bytes', size)
+    print(f"Email payload: {size} bytes ({len(html_content.encode('utf-8'))} HTML, "
+          f"{len(attachments)} attachment(s){', ' + ', '.join(sorted(omitted)) + ' too large to attach' if omitted else ''})")
+    return html_content, attachments
+
+
+def email_payload_bytes(html_content: str, attachments: list) -> int:
+    """HTML plus base64-encoded attachment bytes, as sent to SendGrid."""
+    return len(html_content.encode('utf-8')) + sum(4 * ((len(a['content']) + 2) // 3) for a in attachments)
+
+
+_sendgrid_client = None
+
+
+def get_sendgrid_client():
+    """Set up the HTTPS opener once per process and return a shared SendGrid client.
+
+    Loading the certifi bundle into an SSL context is the expensive part of a send, so a
+    long-running process (--daemon) pays for it only on the first email.
+    """
+    global _sendgrid_client
+    if _sendgrid_client is not None:
+        return _sendgrid_client
+
+    import ssl
+    import urllib.request
+    import certifi
+    from sendgrid import SendGridAPIClient
 
-def send_html_email_sendgrid(html_content: str, recipients: list):
-    """Send HTML email with SendGrid to multiple recipients"""
-    
     try:
         os.environ['REQUESTS_CA_BUNDLE'] = certifi.where()
         os.environ['SSL_CERT_FILE'] = certifi.where()
@@ -710,26 +2110,1488 @@ def send_html_email_sendgrid(html_content: str, recipients: list):
         opener = urllib.request.build_opener(urllib.request.HTTPSHandler(context=ssl_context))
         urllib.request.install_opener(opener)
 
+    _sendgrid_client = SendGridAPIClient(SENDGRID_API_KEY, host=SENDGRID_HOST)
+    _sendgrid_client.client.timeout = SENDGRID_TIMEOUT_SECONDS
+    return _sendgrid_client
+
+
+def build_email_message(html_content: str, recipients: list, scope: str = None, attachments: list = None):
+    """Build the SendGrid Mail for a report; `scope` (a fan-out pod / owner) is added to the subject."""
+    import base64
+    from sendgrid.helpers.mail import Attachment, Disposition, FileContent, FileName, FileType, Mail
+
+    scope = f" - {scope}" if scope else ""
     message = Mail(
         from_email=SENDER_EMAIL,
         to_emails=recipients,
-        subject=f"🩺 5C Network Demo Cases Report - {datetime.now().strftime('%Y-%m-%d %H:%M')}",
+        subject=f"🩺 5C Network Demo Cases Report{scope} - {datetime.now().strftime('%Y-%m-%d %H:%M')}",
         html_content=html_content
     )
-    
+    for attachment in attachments or []:
+        message.add_attachment(Attachment(
+            FileContent(base64.b64encode(attachment['content']).decode('ascii')), FileName(attachment['filename']),
+            FileType(attachment['type']), Disposition('attachment')))
+    return message
+
+
+def send_html_email_sendgrid(html_content: str, recipients: list, scope: str = None, attachments: list = None):
+    """Send HTML email with SendGrid to multiple recipients"""
+    message = build_email_message(html_content, recipients, scope, attachments)
+
     try:
-        sg = SendGridAPIClient(SENDGRID_API_KEY)
+        sg = get_sendgrid_client()
         response = sg.send(message)
+        add_metric('sendgrid_status', 1, str(response.status_code))
         print(f"SendGrid Response: {response.status_code}")
         if response.status_code == 202:
             print("✅ Email sent successfully!")
         else:
             print(f"⚠️  Unexpected response code: {response.status_code}")
     except Exception as e:
+        add_metric('sendgrid_status', 1, str(getattr(e, 'status_code', 'error')))
         print(f"❌ Failed to send email: {e}")
         raise e
 
 
+# ---------------- EMAIL OUTBOX ----------------
+# Spooled emails live in OUTBOX_DIR/pending as <next attempt epoch>-<id>.json.gz, so a sorted
+# listing is the delivery order and due messages are found without opening them. A sender
+# claims a message by renaming it into sending/; undeliverable ones end up in failed/.
+OUTBOX_STALE_CLAIM_SECONDS = 600
+_send_slot_lock = threading.Lock()
+_next_send_slot = 0.0
+
+
+def outbox_path(folder: str, name: str = '') -> str:
+    return os.path.join(OUTBOX_DIR, folder, name)
+
+
+def write_outbox_entry(folder: str, entry: dict) -> str:
+    """Atomically write `entry` into an outbox folder under its schedule-ordered file name."""
+    import gzip
+
+    os.makedirs(outbox_path(folder), exist_ok=True)
+    path = outbox_path(folder, f"{int(entry['next_attempt_at']):010d}-{entry['id']}.json.gz")
+    with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as f:
+        json.dump(entry, f)
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def read_outbox_entry(path: str) -> dict:
+    import gzip
+
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def outbox_files(folder: str) -> list:
+    try:
+        return sorted(name for name in os.listdir(outbox_path(folder)) if name.endswith('.json.gz'))
+    except FileNotFoundError:
+        return []
+
+
+def outbox_backlog() -> int:
+    """Emails spooled but not yet delivered (pending or being sent)."""
+    return len(outbox_files('pending')) + len(outbox_files('sending'))
+
+
+def enqueue_email(html_content: str, recipients: list, scope: str = None, attachments: list = None) -> str:
+    """Spool a rendered report for delivery by the outbox sender; returns the message id."""
+    now = time.time()
+    entry = {
+        'id': f"{datetime.fromtimestamp(now):%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:8]}",
+        'created_at': now,
+        'next_attempt_at': now,
+        'attempts': 0,
+        'last_error': None,
+        'scope': scope,
+        'message': build_email_message(html_content, recipients, scope, attachments).get(),
+    }
+    path = write_outbox_entry('pending', entry)
+    add_metric('outbox_enqueued', 1)
+    print(f"📥 Email queued in the outbox ({os.path.getsize(path)} bytes): {entry['id']}")
+    return entry['id']
+
+
+def deliver_report(html_content: str, recipients: list, scope: str = None, attachments: list = None):
+    """Queue the report in the outbox when OUTBOX_ENABLED, otherwise send it right away."""
+    if OUTBOX_ENABLED:
+        enqueue_email(html_content, recipients, scope, attachments)
+    else:
+        send_html_email_sendgrid(html_content, recipients, scope, attachments)
+
+
+def wait_for_send_slot():
+    """Block until the next send is allowed by OUTBOX_RATE_PER_SECOND (shared by all sender threads)."""
+    global _next_send_slot
+    with _send_slot_lock:
+        now = time.monotonic()
+        slot = max(now, _next_send_slot)
+        _next_send_slot = slot + 1 / OUTBOX_RATE_PER_SECOND
+    time.sleep(slot - now)
+
+
+def retry_delay(attempts: int, retry_after: str = None) -> float:
+    """Exponential backoff with jitter; a Retry-After header (429/503) is a lower bound."""
+    import random
+
+    delay = min(OUTBOX_MAX_BACKOFF_SECONDS, OUTBOX_BACKOFF_SECONDS * 2 ** (attempts - 1))
+    delay *= random.uniform(0.5, 1.0)
+    try:
+        return max(delay, float(retry_after)) if retry_after else delay
+    except ValueError:
+        return delay
+
+
+def deliver_outbox_entry(name: str) -> str:
+    """Try to send one pending message. Returns 'sent', 'retry', 'failed' or 'skipped'.
+
+    Responses other than 2xx are retried with backoff, except 4xx ones (bar 429) which
+    can never succeed and, like messages out of attempts, are moved to failed/.
+    """
+    sending = outbox_path('sending', name)
+    os.makedirs(outbox_path('sending'), exist_ok=True)
+    try:
+        # rename keeps the mtime, which release_stale_claims reads as the claim time: touch first
+        os.utime(outbox_path('pending', name))
+        os.replace(outbox_path('pending', name), sending)
+    except FileNotFoundError:
+        return 'skipped'  # claimed by another sender
+    try:
+        entry = read_outbox_entry(sending)
+    except (OSError, EOFError, ValueError) as e:
+        # Unreadable (e.g. truncated by a full disk): park it rather than claim and release it forever
+        os.makedirs(outbox_path('failed'), exist_ok=True)
+        os.replace(sending, outbox_path('failed', name))
+        print(f"❌ Outbox entry {name} is unreadable and was moved to failed/: {e}")
+        return 'failed'
+
+    wait_for_send_slot()
+    status, error, retry_after = None, None, None
+    try:
+        status = get_sendgrid_client().send(entry['message']).status_code
+    except Exception as e:
+        status, error = getattr(e, 'status_code', None), str(e)
+        retry_after = (getattr(e, 'headers', None) or {}).get('Retry-After')
+    add_metric('sendgrid_status', 1, str(status or 'error'))
+
+    if status is not None and 200 <= status < 300:
+        os.remove(sending)
+        print(f"✅ Outbox email {entry['id']} sent (attempt {entry['attempts'] + 1}, status {status})")
+        return 'sent'
+
+    entry['attempts'] += 1
+    entry['last_error'] = error or f"unexpected status {status}"
+    permanent = status is not None and 400 <= status < 500 and status != 429
+    if permanent or entry['attempts'] >= OUTBOX_MAX_ATTEMPTS:
+        write_outbox_entry('failed', entry)
+        os.remove(sending)
+        print(f"❌ Outbox email {entry['id']} failed permanently after {entry['attempts']} attempt(s): {entry['last_error']}")
+        return 'failed'
+    entry['next_attempt_at'] = time.time() + retry_delay(entry['attempts'], retry_after)
+    write_outbox_entry('pending', entry)
+    os.remove(sending)
+    print(f"⚠️  Outbox email {entry['id']} attempt {entry['attempts']} failed ({entry['last_error']}); "
+          f"retrying at {datetime.fromtimestamp(entry['next_attempt_at']):%H:%M:%S}")
+    return 'retry'
+
+
+def release_stale_claims():
+    """Return messages left in sending/ by a sender that died mid-send to pending/."""
+    for name in outbox_files('sending'):
+        path = outbox_path('sending', name)
+        try:
+            if time.time() - os.path.getmtime(path) > OUTBOX_STALE_CLAIM_SECONDS:
+                os.replace(path, outbox_path('pending', name))
+        except FileNotFoundError:
+            pass
+
+
+def drain_outbox() -> dict:
+    """Send every message that is due now, SEND_CONCURRENCY at a time; returns counts by outcome."""
+    release_stale_claims()
+    now = time.time()
+    due = [name for name in outbox_files('pending') if int(name.split('-', 1)[0]) <= now]
+    counts = {}
+    if due:
+        with ThreadPoolExecutor(max_workers=SEND_CONCURRENCY) as pool:
+            for outcome in pool.map(deliver_outbox_entry, due):
+                counts[outcome] = counts.get(outcome, 0) + 1
+    return counts
+
+
+def start_outbox_sender(stop: threading.Event) -> threading.Thread:
+    """Drain the outbox every OUTBOX_POLL_SECONDS in a background thread until `stop` is set."""
+    def run():
+        while not stop.is_set():
+            try:
+                drain_outbox()
+            except Exception as e:
+                print(f"Outbox sender error: {e}")
+            stop.wait(OUTBOX_POLL_SECONDS)
+
+    thread = threading.Thread(target=run, name='outbox-sender', daemon=True)
+    thread.start()
+    return thread
+
+
+# ---------------- CHANGE DETECTION ----------------
+# Columns that make up a row's fingerprint; a section only "changes" when one of these does.
+DIGEST_COLUMNS = ('Study_Id', 'Final_Status', 'Current_Bucket', 'TAT_Flag')
+
+
+def section_fingerprint(df: pd.DataFrame) -> dict:
+    """Order-independent digest of a section's rows plus the study ids it holds."""
+    if df.empty:
+        return {'digest': '', 'ids': []}
+    columns = [column for column in DIGEST_COLUMNS if column in df.columns]
+    row_hashes = np.sort(pd.util.hash_pandas_object(df[columns], index=False).to_numpy())
+    return {
+        'digest': hashlib.sha256(row_hashes.tobytes()).hexdigest(),
+        'ids': sorted(int(study_id) for study_id in df['Study_Id'].unique()),
+    }
+
+
+def load_digests() -> dict:
+    """Fingerprints of the last report sent to each audience ({} on the first run)."""
+    try:
+        with open(os.path.join(STATE_DIR, 'report_digests.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_digests(digests: dict):
+    """Persist the fingerprints atomically."""
+    os.makedirs(STATE_DIR, exist_ok=True)
+    path = os.path.join(STATE_DIR, 'report_digests.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(digests, f)
+    os.replace(path + '.tmp', path)
+
+
+def report_to_send(report: dict, previous: dict) -> tuple:
+    """Compare a classified report with the fingerprints of the last one sent to the same audience.
+
+    Returns (report or None, fingerprint). None means nothing to send: every section is
+    unchanged or, in DELTA_MODE, no case is new to its section. In DELTA_MODE the sections
+    keep only newly active / breached / rework completed cases, and the 'completed_demo'
+    rows (see classify_demo) only those that weren't Completed in the previous report; summary
+    cards stay complete. The fingerprint should be saved once the report has been sent.
+    """
+    fingerprint = {name: section_fingerprint(df) for name, df in report['sections'].items()}
+    if not previous:
+        # First report to this audience: every case is new, "newly completed" has no baseline yet
+        sections = {name: df for name, df in report['sections'].items() if name != 'completed_demo'}
+        return dict(report, sections=sections), fingerprint
+    if all(previous.get(name, {}).get('digest') == fp['digest'] for name, fp in fingerprint.items()):
+        return None, fingerprint
+    if not DELTA_MODE:
+        return report, fingerprint
+
+    sections = {
+        name: df[~df['Study_Id'].isin(previous.get(name, {}).get('ids', []))] if not df.empty else df
+        for name, df in report['sections'].items()
+    }
+    if 'completed_demo' in sections and 'completed_demo' not in previous:
+        # Fingerprint from before completed cases were tracked: start the baseline now
+        sections['completed_demo'] = sections['completed_demo'].iloc[:0]
+    if all(df.empty for df in sections.values()):
+        return None, fingerprint
+    return dict(report, sections=sections), fingerprint
+
+
+# ---------------- RUN HISTORY ----------------
+# HISTORY_DIR/run_date=YYYY-MM-DD/HHMMSS-<run_id>.parquet holds one run's section rows; once a
+# day is over its files are compacted into one (see compact_history). _runs.jsonl indexes every
+# run, including those with no rows. Names starting with '.' or '_' are skipped by pyarrow.dataset.
+HISTORY_INDEX = '_runs.jsonl'
+# Arrow type of each stored column (any other column is stored as a string). Fixed types keep
+# every file readable as one dataset whatever dtypes a run's frames happened to have.
+HISTORY_COLUMN_TYPES = {
+    'run_id': 'dictionary', 'run_at': 'timestamp', 'section': 'dictionary',
+    'Study_Id': 'int64', 'Client_Id': 'int64', 'Report_Window': 'int64', 'tat_min': 'float64',
+    'Activated_DemoCases': 'int8', 'Active_DemoCases': 'int8', 'Completed_DemoCases': 'int8',
+    'Study_Created_Time': 'timestamp', 'Activated_Time': 'timestamp',
+    **{column: 'dictionary' for column in ARROW_DICTIONARY_COLUMNS},
+}
+# Derived from Study_Id, not worth storing
+HISTORY_SKIP_COLUMNS = ('Study_Link',)
+# A study that stays in a section has "changed" (history_diff) when one of these did
+HISTORY_DIFF_COLUMNS = ('Final_Status', 'Current_Bucket', 'TAT_Flag')
+
+
+def history_type(name: str):
+    """Arrow type of a stored history column (see HISTORY_COLUMN_TYPES)."""
+    import pyarrow as pa
+
+    kind = HISTORY_COLUMN_TYPES.get(name, 'string')
+    if kind == 'dictionary':
+        return pa.dictionary(pa.int32(), pa.string())
+    if kind == 'timestamp':
+        return pa.timestamp('ms')
+    return getattr(pa, kind)()
+
+
+def history_schema(columns):
+    """Schema for reading `columns` from the history dataset, plus the run_date partition key."""
+    import pyarrow as pa
+
+    return pa.schema([(name, history_type(name)) for name in columns] + [('run_date', pa.string())])
+
+
+def history_dataset(path: str, columns):
+    """The Parquet files under `path` as one dataset, with run_date partitions parsed from the path."""
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    return ds.dataset(path, schema=history_schema(columns), format='parquet',
+                      partitioning=ds.partitioning(pa.schema([('run_date', pa.string())]), flavor='hive'))
+
+
+def history_table(df: pd.DataFrame, section: str, run_id: str, run_at: datetime):
+    """One section's rows as an Arrow table in the stored types, tagged with run and section."""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    df = df.drop(columns=[column for column in HISTORY_SKIP_COLUMNS if column in df.columns])
+    table = pa.Table.from_pandas(df.assign(run_id=run_id, run_at=run_at, section=section), preserve_index=False)
+    columns = {}
+    for name, column in zip(table.column_names, table.columns):
+        target = history_type(name)
+        if pa.types.is_dictionary(column.type):
+            column = column.cast(column.type.value_type)  # pandas categoricals carry int8/int16 codes
+        if pa.types.is_dictionary(target):
+            columns[name] = pc.dictionary_encode(column.cast(pa.string()))
+        else:
+            # Timestamps may carry sub-millisecond digits from pandas; those are dropped
+            columns[name] = column.cast(target, safe=not pa.types.is_timestamp(target))
+    return pa.table(columns)
+
+
+def append_run_history(report: dict, run_id: str = None) -> str:
+    """Append a classified report's section rows to the history dataset; returns the file written.
+
+    Needs pyarrow; without it (or on any write error) the run is reported and not recorded.
+    Earlier days still holding one file per run are compacted afterwards. History is a side
+    record: nothing here raises, so a failure never stops the email going out.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        print("Run history needs pyarrow (pip install pyarrow); this run is not recorded.")
+        return None
+
+    run_id = run_id or uuid.uuid4().hex[:12]
+    run_at = datetime.now().replace(microsecond=0)
+    run = {'run_id': run_id, 'run_at': run_at.isoformat(), 'run_date': f"{run_at:%Y-%m-%d}",
+           'rows': {name: len(df) for name, df in report['sections'].items()}}
+    folder = os.path.join(HISTORY_DIR, f"run_date={run['run_date']}")
+    path = None
+    try:
+        os.makedirs(folder, exist_ok=True)
+        tables = [history_table(df, name, run_id, run_at) for name, df in report['sections'].items() if not df.empty]
+        if tables:
+            path = os.path.join(folder, f"{run_at:%H%M%S}-{run_id}.parquet")
+            tmp = os.path.join(folder, f".{run_id}.tmp")
+            pq.write_table(pa.concat_tables(tables, promote_options='default'), tmp, compression='zstd')
+            os.replace(tmp, path)
+        with open(os.path.join(HISTORY_DIR, HISTORY_INDEX), 'a') as f:
+            f.write(json.dumps(run) + '\n')
+    except Exception as e:  # OSError, but also ArrowInvalid/ArrowTypeError from an odd column
+        print(f"Could not record run {run_id} in {HISTORY_DIR}: {e}")
+        if path and os.path.exists(tmp):
+            os.remove(tmp)
+        return None
+    try:
+        compact_history(before=run['run_date'])
+    except Exception as e:
+        print(f"Could not compact the history in {HISTORY_DIR} (will retry next run): {e}")
+    print(f"Run {run_id} recorded in the history ({sum(run['rows'].values())} rows)")
+    return path
+
+
+def compact_history(before: str = None) -> int:
+    """Merge each day's per-run files into one file with one row group per run.
+
+    Only days before `before` (YYYY-MM-DD, default today) are touched, so the current day keeps
+    cheap appends. Returns the number of days compacted. A daemon's ~100 runs a day become one
+    file, while per-row-group run_id statistics still let a single run be read on its own.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    before = before or f"{datetime.now():%Y-%m-%d}"
+    compacted = 0
+    try:
+        folders = sorted(name for name in os.listdir(HISTORY_DIR) if name.startswith('run_date='))
+    except FileNotFoundError:
+        return 0
+    for name in folders:
+        if name.split('=', 1)[1] >= before:
+            continue
+        folder = os.path.join(HISTORY_DIR, name)
+        files = sorted(f for f in os.listdir(folder) if f.endswith('.parquet') and f[0] not in '._')
+        if len(files) < 2:
+            continue
+        parts = [pq.ParquetFile(os.path.join(folder, f)).read() for f in files]
+        table = pa.concat_tables(parts, promote_options='default')
+        tmp = os.path.join(folder, '.compacted.tmp')
+        with pq.ParquetWriter(tmp, table.schema, compression='zstd') as writer:
+            offset = 0
+            for part in parts:
+                writer.write_table(table.slice(offset, part.num_rows))
+                offset += part.num_rows
+        path = os.path.join(folder, '000000-compacted.parquet')
+        os.replace(tmp, path)
+        for f in files:
+            if os.path.join(folder, f) != path:
+                os.remove(os.path.join(folder, f))
+        compacted += 1
+    return compacted
+
+
+def load_history_runs(since: str = None) -> list:
+    """Recorded runs, oldest first (optionally only those on or after `since`, YYYY-MM-DD)."""
+    try:
+        with open(os.path.join(HISTORY_DIR, HISTORY_INDEX)) as f:
+            runs = [json.loads(line) for line in f if line.endswith('\n')]  # skip a torn last line
+    except OSError:
+        return []
+    return [run for run in runs if since is None or run['run_date'] >= since]
+
+
+def history_trend(days: int = 30, section: str = None, by: str = None) -> pd.DataFrame:
+    """Rows per run over the last `days` days, one column per section (or per value of `by`).
+
+    history_trend(30, 'tat_breach_demo') gives this month's TAT breach count of every run, and
+    by='Client_Name' splits it per client. Only the run_date partitions in range and the
+    run_id / section / `by` columns are read. Indexed by run_at, with a run_id column.
+    """
+    import pyarrow.dataset as ds
+
+    since = f"{datetime.now() - timedelta(days=days):%Y-%m-%d}"
+    runs = load_history_runs(since)
+    if not runs or not os.path.isdir(HISTORY_DIR):
+        return pd.DataFrame({'run_id': pd.Series(dtype=object)}, index=pd.DatetimeIndex([], name='run_at'))
+    key = by or 'section'
+    columns = list(dict.fromkeys(['run_id', 'section', key]))
+    condition = ds.field('run_date') >= since
+    if section:
+        condition &= ds.field('section') == section
+    table = history_dataset(HISTORY_DIR, columns).to_table(columns=columns, filter=condition)
+    # Each file has its own dictionaries; group_by needs one per column
+    counts = table.unify_dictionaries().group_by(['run_id', key]).aggregate([([], 'count_all')]).to_pandas()
+    trend = counts.astype({'run_id': str, key: str}).pivot_table(
+        index='run_id', columns=key, values='count_all', fill_value=0, aggfunc='sum')
+    trend = trend.reindex([run['run_id'] for run in runs], fill_value=0).astype(int)
+    trend.columns.name = None
+    trend.insert(0, 'run_id', trend.index)
+    trend.index = pd.Index(pd.to_datetime([run['run_at'] for run in runs]), name='run_at')
+    return trend
+
+
+def read_history_run(run: dict, columns: list) -> pd.DataFrame:
+    """One recorded run's `columns`, reading only its run_date partition."""
+    import pyarrow.dataset as ds
+
+    folder = os.path.join(HISTORY_DIR, f"run_date={run['run_date']}")
+    if not os.path.isdir(folder):
+        return pd.DataFrame(columns=columns)
+    table = history_dataset(folder, ['run_id', *columns]).to_table(
+        columns=columns, filter=ds.field('run_id') == run['run_id'])
+    return table.to_pandas().astype({column: object for column in columns if column != 'Study_Id'})
+
+
+def history_diff(run_id: str, against: str = None) -> pd.DataFrame:
+    """What changed from run `run_id` to run `against` (default: the latest recorded run).
+
+    One row per study that entered a section ('added'), left it ('removed') or stayed with a
+    different Final_Status / Current_Bucket / TAT_Flag ('changed'); earlier values are in the
+    *_before columns.
+    """
+    runs = {run['run_id']: run for run in load_history_runs()}
+    against = against or (list(runs)[-1] if runs else None)
+    for run in (run_id, against):
+        if run not in runs:
+            raise ValueError(f"Run {run} is not in {os.path.join(HISTORY_DIR, HISTORY_INDEX)}")
+
+    columns = ['section', 'Study_Id', 'Client_Name', *HISTORY_DIFF_COLUMNS]
+    before, after = read_history_run(runs[run_id], columns), read_history_run(runs[against], columns)
+    diff = after.merge(before, on=['section', 'Study_Id'], how='outer', suffixes=('', '_before'), indicator=True)
+    diff['Client_Name'] = diff['Client_Name'].fillna(diff.pop('Client_Name_before'))
+    changed = np.zeros(len(diff), dtype=bool)
+    for column in HISTORY_DIFF_COLUMNS:
+        changed |= diff[column].fillna('').to_numpy() != diff[f'{column}_before'].fillna('').to_numpy()
+    diff.insert(0, 'change', np.select(
+        [diff['_merge'] == 'left_only', diff['_merge'] == 'right_only', changed], ['added', 'removed', 'changed'], ''))
+    return diff[diff['change'] != ''].drop(columns='_merge').sort_values(['section', 'change', 'Study_Id'], ignore_index=True)
+
+
+# ---------------- MULTI-WINDOW ----------------
+def window_tag_sql(column: str, windows: list) -> str:
+    """SQL for the smallest of `windows` (days, ascending) that `column` falls in; rows are already within the largest."""
+    branches = ''.join(f"{column} >= {REPORT_WINDOW_END} - INTERVAL {days} DAY, {days}, " for days in windows[:-1])
+    return f"multiIf({branches}{windows[-1]})" if branches else str(windows[-1])
+
+
+def windowed_queries(windows: list) -> dict:
+    """Demo and non-demo queries of one multi-window report (see split_windowed_results).
+
+    QUERY / NON_DEMO_QUERY must already be rendered for the largest window (see
+    set_report_window); each is run once whatever the number of windows.
+    """
+    window_counts = ',\n        '.join(
+        f"countIf(({condition}) AND Report_Window <= {days}) OVER () AS {name}_{days}"
+        for days in windows for name, condition in DEMO_SUMMARY_CONDITIONS.items())
+    return {
+        'demo': WINDOWED_DEMO_QUERY.format(demo_query=QUERY, window_counts=window_counts,
+                                           activated_window=window_tag_sql('Activated_Time', windows)),
+        'non_demo': WINDOWED_NON_DEMO_QUERY.format(non_demo_query=NON_DEMO_QUERY,
+                                                   created_window=window_tag_sql('Study_Created_Time', windows)),
+    }
+
+
+def split_windowed_results(df_demo: pd.DataFrame, df_non_demo: pd.DataFrame, windows: list) -> tuple:
+    """Unpack the windowed queries' results into (df_demo, df_non_demo, {days: summary}).
+
+    The window counts are read off the first demo row and the Summary_Only rows dropped. A real
+    case is only reported while its client has a demo case in the window, so its Report_Window
+    is raised to its client's Client_Window (the largest window if the client is missing).
+    """
+    count_columns = [f"{name}_{days}" for days in windows for name in DEMO_SUMMARY_CONDITIONS]
+    first = df_demo.iloc[0] if len(df_demo) else dict.fromkeys(count_columns, 0)
+    window_summaries = {days: summary_from_counts(pd.DataFrame([{name: first[f"{name}_{days}"]
+                                                                 for name in DEMO_SUMMARY_CONDITIONS}]))
+                        for days in windows}
+
+    if not df_non_demo.empty:
+        client_windows = df_demo.drop_duplicates('Client_Id').set_index('Client_Id')['Client_Window']
+        own = df_non_demo['Report_Window'].to_numpy()
+        clients = df_non_demo['Client_Id'].map(client_windows).fillna(windows[-1]).to_numpy()
+        df_non_demo = df_non_demo.assign(Report_Window=np.maximum(own, clients).astype(own.dtype))
+    if 'Summary_Only' in df_demo.columns:
+        df_demo = df_demo[(df_demo['Summary_Only'] == 0).to_numpy(dtype=bool)].drop(
+            columns=[*count_columns, 'Client_Window', 'Summary_Only']).reset_index(drop=True)
+    return df_demo, df_non_demo, window_summaries
+
+
+# ---------------- FAN-OUT ----------------
+def load_routing(path: str = ROUTING_FILE) -> dict:
+    """Read the recipient routing map, {field: {value: [emails]}}; a single address may be a string."""
+    with open(path) as f:
+        routing = json.load(f)
+    unknown = set(routing) - set(ROUTING_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown routing field(s) in {path}: {', '.join(sorted(unknown))}; "
+                         f"expected {', '.join(ROUTING_FIELDS)}")
+    return {
+        field: {value: [recipients] if isinstance(recipients, str) else list(recipients)
+                for value, recipients in routes.items()}
+        for field, routes in routing.items()
+    }
+
+
+def group_positions(df: pd.DataFrame, field: str) -> dict:
+    """Row positions of `df` for every distinct value of `field` ({} if the frame lacks it)."""
+    if df.empty or field not in df.columns:
+        return {}
+    return df.groupby(field, sort=False, observed=True).indices
+
+
+def fanout_reports(df_demo: pd.DataFrame, df_non_demo: pd.DataFrame, routing: dict) -> list:
+    """Cut one classified report per routed pod / owner out of a single result set.
+
+    Rows are classified once for the whole frame; each group's report only slices those
+    classes by its row positions. category_manager exists on demo rows only, so its groups
+    never have real cases. Returns [{'key', 'scope', 'recipients', 'report'}].
+    """
+    demo_classes = demo_row_classes(df_demo)
+    non_demo_classes = non_demo_row_classes(df_non_demo)
+    no_rows = np.empty(0, np.intp)
+
+    reports = []
+    for field, routes in routing.items():
+        demo_rows = group_positions(df_demo, field)
+        non_demo_rows = group_positions(df_non_demo, field)
+        unrouted = (set(demo_rows) | set(non_demo_rows)) - set(routes)
+        if unrouted:
+            print(f"⚠️  {len(unrouted)} {field} value(s) have no recipients: {', '.join(map(str, sorted(unrouted, key=str)))}")
+
+        for value, recipients in routes.items():
+            summary, sections = classify_demo(df_demo, rows=demo_rows.get(value, no_rows), classes=demo_classes,
+                                              with_completed=CHANGE_DETECTION and DELTA_MODE)
+            sections.update(classify_non_demo(df_non_demo, rows=non_demo_rows.get(value, no_rows), classes=non_demo_classes))
+            reports.append({'key': f"{field}:{value}", 'scope': value, 'recipients': recipients,
+                            'report': {'summary': summary, 'sections': sections}})
+    return reports
+
+
+def send_fanout(reports: list):
+    """Render and send the fan-out reports that have active cases, SEND_CONCURRENCY at a time.
+
+    With CHANGE_DETECTION each group is compared with the last report it was sent.
+    """
+    active = [r for r in reports
+              if not (r['report']['sections']['active_demo'].empty and r['report']['sections']['active_non_demo'].empty)]
+    print(f"Fan-out: {len(active)} of {len(reports)} routed groups have active cases")
+
+    digests = load_digests() if CHANGE_DETECTION else {}
+    fingerprints = {}
+    if CHANGE_DETECTION:
+        pending = []
+        for item in active:
+            item['report'], fingerprints[item['key']] = report_to_send(item['report'], digests.get(item['key']))
+            if item['report'] is not None:
+                pending.append(item)
+        print(f"Fan-out: {len(active) - len(pending)} group(s) unchanged since their last email")
+        active = pending
+    if not active:
+        return
+
+    def render_and_send(item):
+        scope = f"{item['scope']} - new cases" if CHANGE_DETECTION and DELTA_MODE else item['scope']
+        with timed_stage('render'):
+            html_content, attachments = render_email(item['report'])
+        add_metric('html_bytes', len(html_content.encode('utf-8')))
+        with timed_stage('send'):
+            deliver_report(html_content, item['recipients'], scope=scope, attachments=attachments)
+
+    if not OUTBOX_ENABLED:
+        get_sendgrid_client()  # set up the shared client (and SSL context) once, before the workers use it
+    failures = []
+    with ThreadPoolExecutor(max_workers=SEND_CONCURRENCY) as pool:
+        futures = {pool.submit(render_and_send, item): item for item in active}
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                failures.append(item['scope'])
+                print(f"❌ Fan-out email for {item['scope']} failed: {e}")
+            else:
+                if CHANGE_DETECTION:
+                    digests[item['key']] = fingerprints[item['key']]
+    if CHANGE_DETECTION:
+        save_digests(digests)  # failed groups keep their old fingerprint and are retried next run
+    if failures:
+        raise RuntimeError(f"{len(failures)} of {len(active)} fan-out emails failed: {', '.join(map(str, failures))}")
+
+
+# ---------------- DAEMON ----------------
+def run_daemon(interval: float, run_kwargs: dict):
+    """Run the report every `interval` seconds in this process until SIGINT/SIGTERM.
+
+    Imports, the ClickHouse connection pool and the SendGrid SSL context are set up once and
+    reused by every run. A failed run is logged and retried on the next tick. Timings of the
+    last run are written to STATE_DIR/last_run.json.
+    """
+    stop = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: stop.set())
+
+    print(f"Daemon mode: running every {interval:.0f}s")
+    if OUTBOX_ENABLED:
+        start_outbox_sender(stop)
+    while not stop.is_set():
+        started = time.time()
+        last_query_timings.clear()
+        if RESULT_CACHE_ENABLED:
+            enable_result_cache()  # re-pin the window end for this run
+
+        status, error = 'ok', None
+        try:
+            execute_query_and_send_email(**run_kwargs)
+        except Exception as e:
+            status, error = 'error', str(e)
+
+        last_run = {
+            'started_at': datetime.fromtimestamp(started).isoformat(timespec='seconds'),
+            'duration_s': round(time.time() - started, 3),
+            'status': status,
+            'error': error,
+            'query_timings_s': dict(last_query_timings),
+            'stages_s': {stage: round(seconds, 3) for stage, seconds in run_metrics.get('stages_s', {}).items()},
+            'peak_rss_bytes': run_metrics.get('peak_rss_bytes'),
+        }
+        print(f"Run finished: {last_run}")
+        try:
+            os.makedirs(STATE_DIR, exist_ok=True)
+            with open(os.path.join(STATE_DIR, 'last_run.json'), 'w') as f:
+                json.dump(last_run, f, indent=2)
+        except OSError as e:
+            print(f"Could not write last_run.json: {e}")
+
+        # Fixed-rate schedule: a slow run shortens the following sleep instead of drifting
+        stop.wait(max(0.0, started + interval - time.time()))
+    print("Daemon stopped")
+
+
+# ---------------- HTTP SERVER ----------------
+# The latest report, rendered once per refresh: {path: (body, gzipped body, content type)} plus
+# a shared ETag. Replaced as a whole by the refresher, so request threads read it without locks.
+_report_snapshot = {}
+_snapshot_status = {'last_error': None, 'last_refresh_s': None}
+
+
+def fetch_report(incremental: bool = False) -> dict:
+    """Fetch, enrich and classify both result sets (see classify_cases)."""
+    if incremental:
+        df_demo, df_non_demo = fetch_incremental()
+    else:
+        results = run_queries_concurrently({'demo': QUERY, 'non_demo': NON_DEMO_QUERY})
+        df_demo, df_non_demo = results['demo'], results['non_demo']
+    df_demo, df_non_demo = enrich_frames(df_demo, df_non_demo)
+    return classify_cases(df_demo, df_non_demo)
+
+
+def build_snapshot(report: dict) -> dict:
+    """Pre-render every endpoint of a classified report.
+
+    The ETag hashes the summary and section JSON rather than the HTML, whose "Generated on"
+    line changes every refresh, so clients get 304s for as long as the data is unchanged.
+    """
+    import gzip
+
+    bodies = {'/summary.json': (json.dumps(report['summary']).encode('utf-8'), 'application/json')}
+    for name, df in report['sections'].items():
+        bodies[f'/sections/{name}.json'] = (df.to_json(orient='records', date_format='iso').encode('utf-8'),
+                                            'application/json')
+    digest = hashlib.sha256()
+    for path in sorted(bodies):
+        digest.update(path.encode('utf-8') + bodies[path][0])
+    html_content = create_html_table(report).encode('utf-8')
+    bodies['/'] = bodies['/report.html'] = (html_content, 'text/html; charset=utf-8')
+    bodies['/sections.json'] = (json.dumps(sorted(report['sections'])).encode('utf-8'), 'application/json')
+
+    return {
+        'generated_at': time.time(),
+        'etag': f'"{digest.hexdigest()[:32]}"',
+        'bodies': {path: (body, gzip.compress(body, compresslevel=6, mtime=0), content_type)
+                   for path, (body, content_type) in bodies.items()},
+    }
+
+
+def refresh_snapshot(incremental: bool = False):
+    """Build a new snapshot and swap it in; on failure the previous one keeps being served."""
+    global _report_snapshot
+    started = time.perf_counter()
+    last_query_timings.clear()
+    if RESULT_CACHE_ENABLED:
+        enable_result_cache()  # re-pin the window end for this refresh
+    try:
+        report = fetch_report(incremental)
+        _report_snapshot = build_snapshot(report)
+        if HISTORY_ENABLED:
+            append_run_history(report)
+        _snapshot_status.update(last_error=None, last_refresh_s=round(time.perf_counter() - started, 3))
+        print(f"Report snapshot refreshed in {_snapshot_status['last_refresh_s']:.2f}s (ETag {_report_snapshot['etag']})")
+    except Exception as e:
+        _snapshot_status['last_error'] = str(e)
+        print(f"Report snapshot refresh failed, serving the previous one: {e}")
+
+
+def make_report_handler():
+    from http.server import BaseHTTPRequestHandler
+
+    class ReportHandler(BaseHTTPRequestHandler):
+        """Serves _report_snapshot: / (HTML), /summary.json, /sections.json, /sections/<name>.json, /healthz."""
+
+        def do_GET(self):
+            path = self.path.split('?', 1)[0]
+            snapshot = _report_snapshot
+            if path == '/healthz':
+                generated_at = snapshot.get('generated_at')
+                health = dict(_snapshot_status, ready=bool(snapshot),
+                              age_s=round(time.time() - generated_at, 1) if generated_at else None)
+                return self.reply(200 if snapshot else 503, json.dumps(health).encode('utf-8'), 'application/json')
+            if not snapshot:
+                return self.reply(503, b'Report not ready yet', 'text/plain', {'Retry-After': '5'})
+            if path not in snapshot['bodies']:
+                return self.reply(404, b'Not found', 'text/plain')
+
+            headers = {'ETag': snapshot['etag'], 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding',
+                       'Last-Modified': self.date_time_string(snapshot['generated_at'])}
+            if snapshot['etag'] in self.headers.get('If-None-Match', ''):
+                return self.reply(304, b'', None, headers)
+            body, gzipped, content_type = snapshot['bodies'][path]
+            if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                body, headers['Content-Encoding'] = gzipped, 'gzip'
+            self.reply(200, body, content_type, headers)
+
+        def reply(self, status: int, body: bytes, content_type: str = None, headers: dict = None):
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            if status != 304:
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if status != 304:
+                self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return ReportHandler
+
+
+def serve_report(address: str, interval: float, incremental: bool = False):
+    """Serve the live report over HTTP, refreshing it every `interval` seconds in the background.
+
+    `address` is [HOST:]PORT. Requests are answered from the in-memory snapshot only; with
+    incremental=True each refresh fetches just the studies changed since the last one.
+    """
+    from http.server import ThreadingHTTPServer
+
+    host, _, port = address.rpartition(':')
+    server = ThreadingHTTPServer((host or '127.0.0.1', int(port)), make_report_handler())
+    stop = threading.Event()
+
+    def refresh_loop():
+        while not stop.is_set():
+            started = time.time()
+            refresh_snapshot(incremental)
+            stop.wait(max(0.0, started + interval - time.time()))
+
+    def shutdown(*_):
+        stop.set()
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, shutdown)
+    threading.Thread(target=refresh_loop, name='report-refresh', daemon=True).start()
+    print(f"Serving the report on http://{server.server_address[0]}:{server.server_address[1]}/ "
+          f"(refresh every {interval:g}s{', incremental' if incremental else ''})")
+    server.serve_forever()
+    server.server_close()
+    print("Server stopped")
+
+
+# ---------------- DEMO CASE STATE ----------------
+def refresh_state_table(full: bool = False):
+    """Create the demo case state table if needed and bring it up to date.
+
+    Only studies changed since the latest refreshed_at (minus INCREMENTAL_OVERLAP_SECONDS) are
+    recomputed, using the same change detection as --incremental; an empty table, full=True
+    or a last full recompute older than DEMO_STATE_FULL_REFRESH_HOURS recomputes the whole
+    retention window.
+    """
+    source_window = dict(window_days=DEMO_STATE_RETENTION_DAYS, window_end='now()')
+    state_file = os.path.join(STATE_DIR, 'demo_state_refresh.json')
+    state_key = f"{CLICK_PARAMS['database']}.{DEMO_STATE_TABLE}"
+    try:
+        with open(state_file) as f:
+            full_refreshes = json.load(f)
+    except (OSError, ValueError):
+        full_refreshes = {}
+
+    with pooled_client() as client:
+        client.command(DEMO_STATE_DDL.format(state_rows=DEMO_STATE_ROWS.format(
+            demo_query=DEMO_QUERY_TEMPLATE.format(study_filter='', **source_window))))
+
+        # Server clock, as in fetch_incremental
+        last_refresh, server_epoch = client.query(
+            f"SELECT toUnixTimestamp(max(refreshed_at)), toUnixTimestamp(now()) FROM {DEMO_STATE_TABLE}").first_row
+        full = (full or not last_refresh
+                or server_epoch - full_refreshes.get(state_key, 0) > DEMO_STATE_FULL_REFRESH_HOURS * 3600)
+        if full:
+            print(f"Refreshing {DEMO_STATE_TABLE}: full recompute of the last {DEMO_STATE_RETENTION_DAYS} days...")
+            study_filter = ''
+        else:
+            watermark = last_refresh - INCREMENTAL_OVERLAP_SECONDS
+            print(f"Refreshing {DEMO_STATE_TABLE}: studies changed since {datetime.fromtimestamp(watermark)}...")
+            study_filter = INCREMENTAL_DEMO_FILTER.format(changed_studies=CHANGED_STUDIES_SQL.format(watermark=watermark))
+
+        start = time.perf_counter()
+        try:
+            client.command(DEMO_STATE_INSERT.format(state_rows=DEMO_STATE_ROWS.format(
+                demo_query=DEMO_QUERY_TEMPLATE.format(study_filter=study_filter, **source_window))))
+        except Exception as e:
+            if full:
+                raise
+            print(f"Incremental refresh failed, recomputing the whole table instead "
+                  f"(check TAT_METRICS_CHANGE_COLUMN / REWORKS_CHANGE_COLUMN): {e}")
+            full = True
+            client.command(DEMO_STATE_INSERT.format(state_rows=DEMO_STATE_ROWS.format(
+                demo_query=DEMO_QUERY_TEMPLATE.format(study_filter='', **source_window))))
+        print(f"{DEMO_STATE_TABLE} refreshed in {time.perf_counter() - start:.2f}s")
+
+    if full:
+        os.makedirs(STATE_DIR, exist_ok=True)
+        with open(state_file + '.tmp', 'w') as f:
+            json.dump(dict(full_refreshes, **{state_key: server_epoch}), f)
+        os.replace(state_file + '.tmp', state_file)
+
+
+def check_state_table(sample_days: int = 3) -> dict:
+    """Diff the state table against the ad-hoc demo query over the last `sample_days` days.
+
+    Compares the set of studies and, for studies in both, their full rows. Differences on
+    studies changed after the last refresh are expected; run it right after --refresh-state.
+    """
+    window = dict(study_filter='', window_days=sample_days, window_end='now()')
+    results = run_queries_concurrently({
+        'adhoc': DEMO_QUERY_TEMPLATE.format(**window),
+        'state': DEMO_STATE_QUERY_TEMPLATE.format(**window),
+    })
+    adhoc, state = results['adhoc'], results['state']
+
+    def rows_by_study(df: pd.DataFrame) -> dict:
+        rows = {}
+        for row in df[list(adhoc.columns)].astype(str).itertuples(index=False):
+            rows.setdefault(row[0], []).append(tuple(row))
+        return {study: sorted(study_rows) for study, study_rows in rows.items()}
+
+    adhoc_rows, state_rows = rows_by_study(adhoc), rows_by_study(state)
+    diff = {
+        'missing_from_state': sorted(adhoc_rows.keys() - state_rows.keys()),
+        'extra_in_state': sorted(state_rows.keys() - adhoc_rows.keys()),
+        'different': sorted(study for study in adhoc_rows.keys() & state_rows.keys()
+                            if adhoc_rows[study] != state_rows[study]),
+    }
+    if any(diff.values()):
+        print(f"⚠️  {DEMO_STATE_TABLE} differs from the ad-hoc query over the last {sample_days} days:")
+        for kind, studies in diff.items():
+            print(f"  {kind}: {len(studies)} studies {studies[:20]}")
+    else:
+        print(f"✅ {DEMO_STATE_TABLE} matches the ad-hoc query over the last {sample_days} days ({len(adhoc_rows)} studies)")
+    return diff
+
+
+def add_modality_column(column: str = 'modality'):
+    """Add the precomputed modality column to Studies and backfill existing parts.
+
+    The backfill runs as a mutation in the background; once it has finished, set
+    MODALITY_COLUMN=<column> so the report queries read it.
+    """
+    with pooled_client() as client:
+        client.command(MODALITY_COLUMN_DDL.format(column=column))
+        client.command(MODALITY_COLUMN_BACKFILL.format(column=column))
+    print(f"Studies.{column} added; backfill mutation started (see system.mutations). "
+          f"Set MODALITY_COLUMN={column} once it is done.")
+
+
+# ---------------- STREAMING ----------------
+def stream_query_blocks(client, sql: str):
+    """Yield the result of `sql` as one DataFrame per ClickHouse block of at most STREAM_BLOCK_ROWS rows."""
+    settings = {'max_block_size': STREAM_BLOCK_ROWS}
+    if FETCH_FORMAT == 'arrow':
+        with client.query_arrow_stream(sql, settings=settings, use_strings=True) as stream:
+            for batch in stream:
+                yield arrow_to_frame(batch, client.server_tz)
+    else:
+        with client.query_df_stream(sql, settings=settings) as stream:
+            yield from stream
+
+
+def stream_report(sink) -> dict:
+    """Build the report block by block and write it to the file-like `sink`.
+
+    Each block is classified and its section rows are rendered straight to a temporary spool
+    file per section, so memory stays bounded by the block size whatever the window length.
+    The summary cards precede the tables in the document, so the head is written once all
+    blocks have been counted and the spools are then copied to the sink in order.
+    Returns the summary counts and the number of rows written per section.
+    """
+    summary = {}
+    section_counts = dict.fromkeys(TABLE_SPECS, 0)
+    with ExitStack() as stack:
+        spools = {name: stack.enter_context(tempfile.TemporaryFile('w+', encoding='utf-8')) for name in TABLE_SPECS}
+
+        def spool_sections(sections: dict):
+            for name, df in sections.items():
+                if not df.empty:
+                    spools[name].write(render_table_rows(df, TABLE_SPECS[name]['columns']))
+                    section_counts[name] += len(df)
+
+        dims = load_dimensions() if DIMENSION_CACHE else None
+        with pooled_client() as client:
+            print("Streaming demo cases query...")
+            for block in stream_query_blocks(client, QUERY):
+                if dims:
+                    block = enrich_frame(block, dims)
+                block_summary, sections = classify_demo(block)
+                for key, value in block_summary.items():
+                    summary[key] = summary.get(key, 0) + value
+                spool_sections(sections)
+
+            print("Streaming non-demo cases query...")
+            for block in stream_query_blocks(client, NON_DEMO_QUERY):
+                if dims:
+                    block = enrich_frame(block, dims)
+                spool_sections(classify_non_demo(block))
+
+        if not summary:
+            summary, _ = classify_demo(pd.DataFrame())
+
+        section_rows = {}
+        for name, spool in spools.items():
+            spool.seek(0)
+            section_rows[name] = iter(lambda spool=spool: spool.read(1 << 16), '')
+        for chunk in iter_html_chunks(summary, section_rows):
+            sink.write(chunk)
+
+    print(f"Streamed report: {summary}, section rows: {section_counts}")
+    return {'summary': summary, 'section_rows': section_counts}
+
+
+# ---------------- BENCHMARKS ----------------
+QUERY_LOG_STATS_SQL = """
+SELECT
+    query_id,
+    read_rows,
+    read_bytes,
+    result_rows,
+    query_duration_ms,
+    memory_usage
+FROM system.query_log
+WHERE type = 'QueryFinish'
+  AND event_date >= yesterday()
+  AND query_id IN ({query_ids})
+"""
+
+
+def fetch_query_log_stats(client, query_ids: list) -> pd.DataFrame:
+    """Read server-side cost (rows/bytes read, duration, memory) of finished queries from system.query_log."""
+    try:
+        client.command('SYSTEM FLUSH LOGS')
+    except Exception as e:
+        print(f"SYSTEM FLUSH LOGS not permitted ({e}), waiting for the query log to flush...")
+
+    sql = QUERY_LOG_STATS_SQL.format(query_ids=', '.join(f"'{qid}'" for qid in query_ids))
+    # query_log is flushed asynchronously (every 7.5s by default)
+    for _ in range(10):
+        stats = client.query_df(sql)
+        if len(stats) >= len(query_ids):
+            break
+        time.sleep(2)
+    return stats.set_index('query_id')
+
+
+# Modules a no-op run must not load (they are imported inside the functions that render or send).
+HEAVY_MODULES = ('pandas', 'numpy', 'pyarrow', 'sendgrid', 'clickhouse_connect', 'certifi', 'ssl')
+IMPORT_TIME_BUDGET_MS = float(os.getenv('IMPORT_TIME_BUDGET_MS', '150'))
+
+
+def benchmark_imports(budget_ms: float = IMPORT_TIME_BUDGET_MS, repeat: int = 5) -> bool:
+    """Measure the cost of importing this script with `python -X importtime`.
+
+    Runs a fresh interpreter `repeat` times, takes the best total and checks it against the
+    budget, lists the slowest top-level imports, and fails if a heavy module gets imported.
+    """
+    import subprocess
+    import sys
+
+    def importtime(code: str) -> dict:
+        """Cumulative microseconds of each import made by a fresh interpreter running `code`."""
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=script_dir,
+                              env=os.environ.copy(), capture_output=True, text=True, check=True)
+        # stderr lines: "import time: <self us> | <cumulative us> | <module>", with nested
+        # imports indented by two extra spaces per level.
+        imports = {}
+        for line in proc.stderr.splitlines():
+            if line.startswith('import time:') and 'self [us]' not in line:
+                _, cumulative, name = line.split('|')
+                imports[name.rstrip()] = int(cumulative)
+        return imports
+
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    module = os.path.splitext(os.path.basename(__file__))[0]
+    # Interpreter startup (site, .pth hooks) is paid by every Python process; leave it out.
+    startup = {name.strip() for name in importtime('pass')}
+    best_total, best_imports = None, None
+    for _ in range(repeat):
+        imports = {name: us for name, us in importtime(f'import {module}').items()
+                   if name.strip() not in startup}
+        total = sum(us for name, us in imports.items() if not name.startswith('  '))
+        if best_total is None or total < best_total:
+            best_total, best_imports = total, {name.strip(): us for name, us in imports.items()}
+
+    print(f"import {module}: {best_total / 1000:.1f} ms (best of {repeat}, budget {budget_ms:.0f} ms)")
+    for name, cumulative in sorted(best_imports.items(), key=lambda item: -item[1])[:10]:
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+
+    loaded_heavy = [name for name in HEAVY_MODULES if name in best_imports]
+    ok = best_total / 1000 <= budget_ms and not loaded_heavy
+    if loaded_heavy:
+        print(f"⚠️  heavy modules imported at startup: {', '.join(loaded_heavy)}")
+    print("✅ import budget met" if ok else "❌ import budget exceeded")
+    return ok
+
+
+# Synthetic result sets for --benchmark-report: same columns as QUERY / NON_DEMO_QUERY, with
+# roughly production-like mixes of statuses, buckets and modalities.
+SYNTHETIC_DEMO_STATUSES = {'Completed': 0.60, 'Pending': 0.22, 'Rework Completed': 0.08, 'DELETED': 0.07, None: 0.03}
+SYNTHETIC_NON_DEMO_STATUSES = {'COMPLETED': 0.55, 'NEW': 0.10, 'ASSIGNED': 0.10, 'REPORTED': 0.10,
+                               'IQC_REVIEW': 0.05, 'MERGED': 0.05, 'DELETED': 0.05}
+SYNTHETIC_MODALITIES = {'XRAY': 0.50, 'CT': 0.25, 'MRI': 0.15, 'NM': 0.05, '': 0.05}
+SYNTHETIC_BUCKETS = {'Radiologist': 0.40, 'HIL': 0.30, 'Preread': 0.10, None: 0.20}
+
+
+def synthetic_frames(rows: int, seed: int = 0) -> tuple:
+    """Generate (df_demo, df_non_demo) of `rows` rows each, shaped like query_df's results.
+
+    Text columns are object arrays with None for NULL, times are naive datetime64, and
+    tat_min is only set on completed cases; TAT_Flag follows TAT_LIMITS_MIN.
+    """
+    rng = np.random.default_rng(seed)
+    now = pd.Timestamp.now().floor('s')
+    window_minutes = REPORT_WINDOW_DAYS * 24 * 60
+
+    def choice(weights: dict, size: int = rows) -> np.ndarray:
+        values = np.empty(len(weights), dtype=object)
+        values[:] = list(weights)
+        return rng.choice(values, size, p=np.array(list(weights.values())) / sum(weights.values()))
+
+    def names(prefix: str, count: int, size: int = rows) -> np.ndarray:
+        return np.char.add(prefix, rng.integers(1, count + 1, size).astype(str)).astype(object)
+
+    def tat(modality: np.ndarray, done: np.ndarray) -> tuple:
+        limit = pd.Series(modality).map(TAT_LIMITS_MIN).to_numpy(dtype=float)
+        minutes = np.round(np.nan_to_num(limit, nan=120) * rng.lognormal(-0.4, 0.6, rows))
+        minutes = np.where(done, minutes, np.nan)
+        flag = np.where(minutes <= limit, 'Green', 'Red').astype(object)  # NaN compares False -> Red
+        return minutes, flag
+
+    def links(study_ids: np.ndarray) -> np.ndarray:
+        return np.char.add('https://admin.5cnetwork.com/cases/', study_ids.astype(str)).astype(object)
+
+    client_ids = rng.integers(1, max(rows // 4, 2), rows)
+    created = now - pd.to_timedelta(rng.integers(0, window_minutes, rows), unit='min')
+
+    study_ids = np.arange(1, rows + 1) + 10_000_000
+    status = choice(SYNTHETIC_DEMO_STATUSES)
+    modality = choice(SYNTHETIC_MODALITIES)
+    tat_min, tat_flag = tat(modality, np.isin(status, ['Completed', 'Rework Completed']))
+    df_demo = pd.DataFrame({
+        'Study_Id': study_ids,
+        'Client_Id': client_ids,
+        'Client_Name': np.char.add('Client ', client_ids.astype(str)).astype(object),
+        'Study_Created_Time': created,
+        'Activated_Time': created + pd.to_timedelta(rng.integers(0, 30, rows), unit='min'),
+        'Activated_DemoCases': np.ones(rows, np.uint8),
+        'Active_DemoCases': np.isin(status, ['Pending']).astype(np.uint8),
+        'Completed_DemoCases': (status == 'Completed').astype(np.uint8),
+        'Final_Status': status,
+        'Current_Bucket': choice(SYNTHETIC_BUCKETS),
+        'Study_Link': links(study_ids),
+        'modality': modality,
+        'tat_min': tat_min,
+        'TAT_Flag': tat_flag,
+        'Clinet_source': choice({'Sales': 0.5, 'Referral': 0.2, 'Inbound': 0.2, None: 0.1}),
+        'assigned_to': names('Owner ', 12),
+        'pod_name': names('Pod ', 6),
+        'Case_Tag': names('Demo Case #', 3),
+        'category_manager': choice({'Keerthana R': 0.3, 'Ruksana': 0.3, 'Santosh Kumar': 0.15,
+                                    'Bhuvaneswaran': 0.15, None: 0.1}),
+    }).sort_values(['Final_Status', 'Activated_Time'], ignore_index=True)
+
+    study_ids = study_ids + rows
+    status = choice(SYNTHETIC_NON_DEMO_STATUSES)
+    modality = choice(SYNTHETIC_MODALITIES)
+    tat_min, tat_flag = tat(modality, status == 'COMPLETED')
+    rank = rng.integers(1, 6, rows)
+    df_non_demo = pd.DataFrame({
+        'Study_Id': study_ids,
+        'Client_Id': client_ids,
+        'Client_Name': np.char.add('Client ', client_ids.astype(str)).astype(object),
+        'Study_Created_Time': created,
+        'Final_Status': status,
+        'modality': modality,
+        'tat_min': tat_min,
+        'TAT_Flag': tat_flag,
+        'Study_Link': links(study_ids),
+        'assigned_to': names('Owner ', 12),
+        'pod_name': names('Pod ', 6),
+        'Tag': np.array(['1st Real Case', '2nd Real Case', '3rd Real Case', '4th Real Case', '5th Real Case'],
+                        dtype=object)[rank - 1],
+    }).sort_values(['Client_Id', 'Study_Created_Time'], ignore_index=True)
+    return df_demo, df_non_demo
+
+
+class FakeClickHouseClient:
+    """Serves fixed DataFrames for the report queries in place of a clickhouse_connect client."""
+
+    server_tz = 'UTC'
+
+    def __init__(self, df_demo: pd.DataFrame, df_non_demo: pd.DataFrame):
+        self.frames = {QUERY: df_demo, NON_DEMO_QUERY: df_non_demo}
+
+    def query_df(self, sql: str, settings: dict = None) -> pd.DataFrame:
+        return self.frames[sql]
+
+    def query_arrow(self, sql: str, settings: dict = None, use_strings: bool = True):
+        import pyarrow as pa
+
+        return pa.Table.from_pandas(self.frames[sql], preserve_index=False)
+
+    def command(self, sql: str, settings: dict = None):
+        return None
+
+    def close(self):
+        pass
+
+
+def benchmark_report(sizes: list, repeat: int = 3, output: str = None, baseline: str = None) -> dict:
+    """Time each report stage on synthetic data with no ClickHouse or SendGrid access.
+
+    For every size the frames are served by FakeClickHouseClient through the normal fetch
+    path, then classification, HTML rendering (within the email size budget, attachments
+    included) and message construction (the SendGrid request body, without sending) are timed; the best of `repeat` runs is kept. Results
+    are written as JSON (STATE_DIR/benchmarks/ by default) and, given a `baseline` file from
+    an earlier version, compared with it stage by stage. The result cache, query stats and
+    metrics export are off while it runs, so synthetic frames never reach a real run.
+    """
+    global create_clickhouse_client, RESULT_CACHE_ENABLED, QUERY_STATS, METRICS_TEXTFILE, METRICS_LOG
+    real_client_factory = create_clickhouse_client
+    saved_settings = RESULT_CACHE_ENABLED, QUERY_STATS, METRICS_TEXTFILE, METRICS_LOG
+    RESULT_CACHE_ENABLED, QUERY_STATS, METRICS_TEXTFILE, METRICS_LOG = False, False, None, None
+
+    def drain_pool():
+        while not _client_pool.empty():
+            _client_pool.get_nowait().close()
+
+    results = []
+    try:
+        for rows in sizes:
+            df_demo, df_non_demo = synthetic_frames(rows)
+            drain_pool()
+            create_clickhouse_client = lambda: FakeClickHouseClient(df_demo, df_non_demo)
+
+            best = {}
+            for _ in range(repeat):
+                timings = {}
+                start = time.perf_counter()
+                frames = run_queries_concurrently({'demo': QUERY, 'non_demo': NON_DEMO_QUERY})
+                timings['fetch'] = time.perf_counter() - start
+
+                start = time.perf_counter()
+                report = classify_cases(frames['demo'], frames['non_demo'])
+                timings['classify'] = time.perf_counter() - start
+
+                start = time.perf_counter()
+                html_content, attachments = render_email(report)
+                timings['render'] = time.perf_counter() - start
+
+                start = time.perf_counter()
+                body = json.dumps(build_email_message(html_content, RECIPIENT_EMAILS, attachments=attachments).get())
+                timings['message'] = time.perf_counter() - start
+
+                best = {stage: min(seconds, best.get(stage, seconds)) for stage, seconds in timings.items()}
+
+            results.append({
+                'rows': rows,
+                'sections': {name: len(df) for name, df in report['sections'].items()},
+                'html_bytes': len(html_content.encode('utf-8')),
+                'message_bytes': len(body.encode('utf-8')),
+                'stages_s': {stage: round(seconds, 6) for stage, seconds in best.items()},
+                'total_s': round(sum(best.values()), 6),
+            })
+    finally:
+        create_clickhouse_client = real_client_factory
+        RESULT_CACHE_ENABLED, QUERY_STATS, METRICS_TEXTFILE, METRICS_LOG = saved_settings
+        drain_pool()
+
+    run = {
+        'generated_at': datetime.now().isoformat(timespec='seconds'),
+        'fetch_format': FETCH_FORMAT,
+        'repeat': repeat,
+        'versions': {'pandas': pd.__version__, 'numpy': np.__version__},
+        'results': results,
+    }
+    if output is None:
+        output = os.path.join(STATE_DIR, 'benchmarks', f"report-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(run, f, indent=2)
+
+    previous = {}
+    if baseline:
+        with open(baseline) as f:
+            previous = {r['rows']: r['stages_s'] for r in json.load(f)['results']}
+
+    stages = list(results[0]['stages_s']) if results else []
+    width = 18 if previous else 10
+    print(f"{'rows':>9}  " + "  ".join(f"{stage:>{width}}" for stage in stages) + f"  {'email MB':>8}")
+    for r in results:
+        cells = []
+        for stage in stages:
+            cell = f"{r['stages_s'][stage] * 1000:8.1f}ms"
+            if r['rows'] in previous and previous[r['rows']].get(stage):
+                cell += f" ({r['stages_s'][stage] / previous[r['rows']][stage]:.2f}x)"
+            cells.append(f"{cell:>{width}}")
+        print(f"{r['rows']:>9}  " + "  ".join(cells) + f"  {r['message_bytes'] / 1e6:8.2f}")
+    print(f"Benchmark results written to {output}")
+    return run
+
+
 # ---------------- MAIN ----------------
 if __name__ == "__main__":
-    execute_query_and_send_email()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Demo cases report: query ClickHouse and email the active cases.")
+    parser.add_argument('--incremental', action='store_true',
+                        help="fetch only studies changed since the last run and merge them into the local snapshot")
+    parser.add_argument('--benchmark-imports', action='store_true',
+                        help="measure the script's import time with -X importtime and check it against the budget")
+    parser.add_argument('--benchmark-report', metavar='SIZES', nargs='?', const='100,1000,10000,100000',
+                        help="time classification, rendering and message building on synthetic data "
+                             "(comma-separated row counts, default 100,1000,10000,100000)")
+    parser.add_argument('--benchmark-output', metavar='PATH', help="JSON file for --benchmark-report results")
+    parser.add_argument('--baseline', metavar='PATH', help="earlier --benchmark-report JSON to compare against")
+    parser.add_argument('--arrow', action='store_true',
+                        help="fetch results over Arrow with dictionary-encoded columns (same as FETCH_FORMAT=arrow)")
+    parser.add_argument('--server-summary', action='store_true',
+                        help="aggregate the summary cards in ClickHouse and fetch only demo rows shown in a table "
+                             "(full scans only; ignored with --incremental)")
+    parser.add_argument('--cache', action='store_true',
+                        help="reuse query results cached on disk within RESULT_CACHE_TTL_SECONDS "
+                             "(window end is rounded to RESULT_CACHE_GRANULARITY_SECONDS)")
+    parser.add_argument('--source', choices=['query', 'state'], default=DEMO_SOURCE,
+                        help=f"read demo cases from the ad-hoc query or the {DEMO_STATE_TABLE} table "
+                             "(default from DEMO_SOURCE; --incremental always uses the query)")
+    parser.add_argument('--refresh-state', action='store_true',
+                        help=f"create/refresh the {DEMO_STATE_TABLE} table with studies changed since its last refresh and exit")
+    parser.add_argument('--full', action='store_true', help="with --refresh-state, recompute the whole retention window")
+    parser.add_argument('--add-modality-column', metavar='COLUMN', nargs='?', const='modality',
+                        help="add a precomputed LowCardinality modality column (default 'modality') to Studies, "
+                             "backfill it and exit; then set MODALITY_COLUMN")
+    parser.add_argument('--check-state', type=int, metavar='DAYS', nargs='?', const=3,
+                        help=f"diff {DEMO_STATE_TABLE} against the ad-hoc query over the last DAYS days (default 3) and exit")
+    parser.add_argument('--daemon', action='store_true',
+                        help="keep running and send the report every --interval seconds, reusing connections")
+    parser.add_argument('--interval', type=float, default=float(os.getenv('REPORT_INTERVAL_SECONDS', '900')),
+                        help="seconds between runs in --daemon mode / refreshes in --serve mode "
+                             "(default 900, env REPORT_INTERVAL_SECONDS)")
+    parser.add_argument('--serve', metavar='[HOST:]PORT', nargs='?', const='127.0.0.1:8080',
+                        help="serve the report as HTML / per-section JSON over HTTP (default 127.0.0.1:8080), "
+                             "refreshed in the background every --interval seconds (with --incremental: incrementally)")
+    parser.add_argument('--windows', metavar='DAYS', nargs='?', const='1,7,20,90',
+                        help="one report with summary cards for several windows (comma-separated days, "
+                             "default 1,7,20,90); each report query runs once, over the largest one")
+    parser.add_argument('--fanout', action='store_true',
+                        help="send each pod / owner in ROUTING_FILE a report of only their rows (one query pass)")
+    parser.add_argument('--skip-unchanged', action='store_true',
+                        help="don't render or send a report whose sections match the last one sent")
+    parser.add_argument('--delta', action='store_true',
+                        help="send only cases that are new to their section since the last email (implies --skip-unchanged)")
+    parser.add_argument('--attachment-format', choices=sorted(ATTACHMENT_TYPES), default=ATTACHMENT_FORMAT,
+                        help="file format of sections too long to inline (default from ATTACHMENT_FORMAT: csv = gzip CSV)")
+    parser.add_argument('--outbox', action='store_true',
+                        help="spool emails to OUTBOX_DIR and deliver them with retries and backoff instead of "
+                             "sending inline (a background sender drains it in --daemon mode)")
+    parser.add_argument('--drain-outbox', action='store_true',
+                        help="send the outbox emails that are due and exit (e.g. from cron)")
+    parser.add_argument('--history', action='store_true',
+                        help="append each run's classified rows to the Parquet history under HISTORY_DIR "
+                             "(same as RUN_HISTORY=1)")
+    parser.add_argument('--history-trend', type=int, metavar='DAYS', nargs='?', const=30,
+                        help="print rows per recorded run over the last DAYS days (default 30) and exit")
+    parser.add_argument('--history-section', metavar='SECTION',
+                        help="with --history-trend, count only this section (e.g. tat_breach_demo)")
+    parser.add_argument('--history-by', metavar='COLUMN',
+                        help="with --history-trend, one column per value of COLUMN (e.g. Client_Name) "
+                             "instead of per section")
+    parser.add_argument('--history-diff', metavar='RUN_ID',
+                        help="print the studies added to / removed from / changed in each section since "
+                             "recorded run RUN_ID and exit")
+    parser.add_argument('--history-against', metavar='RUN_ID',
+                        help="with --history-diff, compare with this run instead of the latest one")
+    parser.add_argument('--metrics-textfile', metavar='PATH', default=METRICS_TEXTFILE,
+                        help="write per-run metrics for the Prometheus node_exporter textfile collector")
+    parser.add_argument('--metrics-log', metavar='PATH', default=METRICS_LOG,
+                        help="append one JSON metrics line per run to PATH ('-' for stdout)")
+    parser.add_argument('--profile', action='store_true',
+                        help="also save EXPLAIN PIPELINE / EXPLAIN indexes = 1 of the report queries under PROFILE_DIR")
+    parser.add_argument('--query-stats', action='store_true',
+                        help="record the queries' server-side cost (from each query's summary, or from "
+                             "system.query_log with --arrow; same as QUERY_STATS=1; implied by --profile)")
+    parser.add_argument('--no-query-stats', action='store_true',
+                        help="don't read query stats even with QUERY_STATS=1 or --profile")
+    parser.add_argument('--dimension-cache', action='store_true',
+                        help="look up client / QC roster dimensions from a local cache instead of joining them in the report queries")
+    parser.add_argument('--no-probe', action='store_true',
+                        help="always run the report queries, even when the fast-path probe finds no active cases")
+    parser.add_argument('--window-days', type=int,
+                        help=f"report window length in days (default {REPORT_WINDOW_DAYS}, env REPORT_WINDOW_DAYS)")
+    parser.add_argument('--stream', metavar='OUTPUT',
+                        help="stream the report block by block into the HTML file OUTPUT instead of emailing it; "
+                             "memory stays bounded for long (e.g. 90/180-day) windows")
+    args = parser.parse_args()
+    if args.arrow:
+        FETCH_FORMAT = 'arrow'
+    DEMO_SOURCE = args.source
+    DIMENSION_CACHE = DIMENSION_CACHE or args.dimension_cache
+    set_report_window()
+    if args.window_days:
+        set_report_window(args.window_days)
+    windows = sorted({int(days) for days in args.windows.split(',')}) if args.windows else None
+    if windows and (args.incremental or args.fanout):
+        print("--windows is ignored with --incremental / --fanout")
+        windows = None
+    if windows:
+        set_report_window(windows[-1])
+    if args.cache:
+        enable_result_cache()
+    METRICS_TEXTFILE, METRICS_LOG = args.metrics_textfile, args.metrics_log
+    if args.no_probe:
+        FAST_PATH_PROBE = False
+    PROFILE_QUERIES = args.profile
+    if args.query_stats or args.profile:
+        QUERY_STATS = True
+    if args.no_query_stats:
+        QUERY_STATS = False
+    ATTACHMENT_FORMAT = args.attachment_format
+    if args.outbox:
+        OUTBOX_ENABLED = True
+    if args.history:
+        HISTORY_ENABLED = True
+    if args.delta:
+        DELTA_MODE = True
+    if args.skip_unchanged or args.delta:
+        CHANGE_DETECTION = True
+    if args.delta and args.server_summary:
+        # Newly completed cases need every Completed row, not just the detail rows
+        print("--server-summary is ignored with --delta")
+        args.server_summary = False
+    if args.fanout and args.server_summary:
+        # Per-group summary cards need every demo row, not just the detail rows
+        print("--server-summary is ignored with --fanout")
+        args.server_summary = False
+
+    if args.benchmark_imports:
+        exit(0 if benchmark_imports() else 1)
+    elif args.benchmark_report:
+        benchmark_report([int(size) for size in args.benchmark_report.split(',')],
+                         output=args.benchmark_output, baseline=args.baseline)
+    elif args.history_trend:
+        with pd.option_context('display.max_rows', None, 'display.width', 200):
+            print(history_trend(args.history_trend, section=args.history_section, by=args.history_by))
+    elif args.history_diff:
+        with pd.option_context('display.max_rows', None, 'display.width', 200):
+            print(history_diff(args.history_diff, against=args.history_against).to_string(index=False))
+    elif args.drain_outbox:
+        print(f"Outbox drained: {drain_outbox()}, {outbox_backlog()} email(s) still pending")
+    elif args.refresh_state:
+        refresh_state_table(full=args.full)
+    elif args.check_state:
+        check_state_table(args.check_state)
+    elif args.add_modality_column:
+        add_modality_column(args.add_modality_column)
+    elif args.stream:
+        with open(args.stream, 'w', encoding='utf-8') as sink:
+            stream_report(sink)
+        print(f"Report written to {args.stream}")
+    elif args.serve:
+        serve_report(args.serve, args.interval, incremental=args.incremental)
+    elif args.daemon:
+        run_daemon(args.interval, {'incremental': args.incremental, 'server_summary': args.server_summary,
+                                   'fanout': args.fanout, 'windows': windows})
+    else:
+        execute_query_and_send_email(incremental=args.incremental, server_summary=args.server_summary,
+                                     fanout=args.fanout, windows=windows)
+        if OUTBOX_ENABLED:
+            # First delivery attempt; anything left is retried by the next run or --drain-outbox
+            print(f"Outbox drained: {drain_outbox()}, {outbox_backlog()} email(s) still pending")
\ No newline at end of file
@@ -0,0 +1,20 @@
+import os
+import sys
+import tempfile
+
+# demo.py reads its connection settings at import time and exits without them; the tests never
+# reach ClickHouse or SendGrid, so placeholders are enough.
+for name, value in {
+    'CLICKHOUSE_HOST': 'localhost',
+    'CLICKHOUSE_PORT': '8123',
+    'CLICKHOUSE_USER': 'default',
+    'CLICKHOUSE_PASSWORD': 'unused',
+    'CLICKHOUSE_DB': 'default',
+    'RECIPIENT_EMAILS': 'check@example.com',
+    'SENDER_EMAIL': 'check@example.com',
+    'SENDGRID_API_KEY': 'unused',
+}.items():
+    os.environ.setdefault(name, value)
+os.environ.setdefault('REPORT_STATE_DIR', tempfile.mkdtemp(prefix='demo-report-tests-'))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,315 @@
+"""Regression tests for demo.py; none of them reach ClickHouse or SendGrid."""
+import numpy as np
+import pandas as pd
+import pytest
+
+import demo
+
+
+@pytest.fixture
+def fake_clickhouse(monkeypatch):
+    """Serve report queries from `fake.frames` (SQL -> DataFrame) instead of ClickHouse."""
+    fake = demo.FakeClickHouseClient(pd.DataFrame(), pd.DataFrame())
+    monkeypatch.setattr(demo, 'create_clickhouse_client', lambda: fake)
+    monkeypatch.setattr(demo, 'RESULT_CACHE_ENABLED', False)
+    # set_report_window rewrites these
+    for name in ('REPORT_WINDOW_DAYS', 'REPORT_WINDOW_END', 'QUERY', 'NON_DEMO_QUERY'):
+        monkeypatch.setattr(demo, name, getattr(demo, name))
+    yield fake
+    drain_client_pool()
+
+
+@pytest.fixture
+def chdb_client(monkeypatch):
+    """An embedded ClickHouse (chdb) clickhouse_connect client behind pooled_client()."""
+    pytest.importorskip('chdb')
+    import clickhouse_connect
+
+    client = clickhouse_connect.get_client(interface='chdb')
+    monkeypatch.setattr(demo, 'create_clickhouse_client', lambda: client)
+    yield client
+    drain_client_pool()
+
+
+def drain_client_pool():
+    while not demo._client_pool.empty():
+        demo._client_pool.get_nowait().close()
+
+
+def test_windowed_report_with_dimension_cache(fake_clickhouse, monkeypatch):
+    """A --windows report with --dimension-cache keeps Report_Window and restores the dimensions.
+
+    The windowed queries are answered with dimension-free frames shaped like the fact queries
+    (synthetic_frames without the dimension columns, plus their inputs and the window function
+    columns), and the dimension lookups come from the same synthetic rows.
+    """
+    windows = [1, 7, 20]
+    rng = np.random.default_rng(0)
+    df_demo, df_non_demo = demo.synthetic_frames(500)
+    df_demo['Report_Window'] = rng.choice(windows, len(df_demo))
+    df_non_demo['Report_Window'] = rng.choice(windows, len(df_non_demo))
+
+    bucket = df_demo['Current_Bucket']
+    fact_demo = df_demo.drop(columns=[*demo.CLIENT_DIMENSION_COLUMNS, 'Current_Bucket', 'category_manager']).assign(
+        study_status='ASSIGNED',
+        latest_status=np.where(bucket == 'Preread', 'IQC_REVIEW', 'REPORTED').astype(object),
+        rad_fk=np.select([bucket == 'HIL', bucket == 'Radiologist'], [float(demo.HIL_RADIOLOGIST_IDS[0]), 1.0], np.nan),
+        iqca_fk=np.nan,
+        **{f"{name}_{days}": value for days in windows for name, value in demo.classify_demo(
+            df_demo[df_demo['Report_Window'] <= days])[0].items() if name != 'exceeding_tat'},
+        Client_Window=df_demo.groupby('Client_Id')['Report_Window'].transform('min').to_numpy(),
+        Summary_Only=0)
+    fact_non_demo = df_non_demo.drop(columns=[c for c in demo.CLIENT_DIMENSION_COLUMNS if c in df_non_demo.columns])
+    clients = df_demo.drop_duplicates('Client_Id')
+    monkeypatch.setattr(demo, '_dimensions', {
+        'database': demo.CLICK_PARAMS['database'],
+        'loaded_at': demo.time.time(),
+        'client_ids': pd.Index(clients['Client_Id'].to_numpy()),
+        'client_columns': {column: clients[column].to_numpy(dtype=object) for column in demo.CLIENT_DIMENSION_COLUMNS},
+        'qc_roster': np.empty(0, np.int64),
+    })
+    monkeypatch.setattr(demo, 'DIMENSION_CACHE', True)
+    demo.set_report_window(windows[-1])
+    queries = demo.windowed_queries(windows)
+    fake_clickhouse.frames = {queries['demo']: fact_demo, queries['non_demo']: fact_non_demo}
+
+    results = demo.run_queries_concurrently(queries)
+    windowed_demo, windowed_non_demo, window_summaries = demo.split_windowed_results(
+        results['demo'], results['non_demo'], windows)
+    enriched_demo, enriched_non_demo = demo.enrich_frames(windowed_demo, windowed_non_demo)
+    report = demo.classify_cases(enriched_demo, enriched_non_demo, window_summaries[windows[-1]])
+    report['window_summaries'] = window_summaries
+    html_content, _ = demo.render_email(report)
+
+    assert 'Report_Window' in enriched_demo.columns
+    assert 'Report_Window' in enriched_non_demo.columns
+    for column in ('Client_Name', 'Current_Bucket'):
+        pd.testing.assert_series_equal(enriched_demo[column].fillna(''), df_demo[column].fillna('').astype(object),
+                                       check_names=False, check_index=False)
+    assert window_summaries[7]['total_demo'] == (df_demo['Report_Window'] <= 7).sum() - (
+        (df_demo['Report_Window'] <= 7) & (df_demo['Final_Status'] == 'DELETED')).sum()
+    assert demo.WINDOW_COLUMN['header'] in html_content
+
+
+def test_query_stats_from_query_summary(chdb_client, monkeypatch):
+    """With QUERY_STATS on, the pandas path takes each query's cost from the summary returned
+    with its result; system.query_log is not read."""
+    def no_query_log(client, query_ids):
+        raise AssertionError(f"system.query_log read for {query_ids}")
+
+    monkeypatch.setattr(demo, 'QUERY_STATS', True)
+    monkeypatch.setattr(demo, 'FETCH_FORMAT', 'pandas')
+    monkeypatch.setattr(demo, 'RESULT_CACHE_ENABLED', False)
+    monkeypatch.setattr(demo, 'fetch_query_log_stats', no_query_log)
+    monkeypatch.setattr(demo, 'run_metrics', {})
+    demo.start_run_metrics()
+    sql = "SELECT number, toString(number) AS label FROM numbers(100000) WHERE number % 7 = 0"
+
+    results = demo.run_queries_concurrently({'numbers': sql})
+    demo.collect_query_stats()
+
+    pd.testing.assert_frame_equal(results['numbers'], chdb_client.query_df(sql))
+    stats = demo.run_metrics['query_stats']['numbers']
+    assert stats['read_rows'] > 0 and stats['read_bytes'] > 0
+    assert 'query_summaries' not in demo.run_metrics
+
+
+@pytest.fixture
+def sendgrid_stand_in(monkeypatch):
+    """A local stand-in for the SendGrid API: 503 to each message's first attempt, 202 to the
+    retry and 400 to a message scoped 'rejected'. It releases stale claims while it answers,
+    as a concurrent sender would mid-send."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    calls = dict(attempts={}, delivered=[], request_times=[])
+    lock = demo.threading.Lock()
+
+    class SendGridStandIn(BaseHTTPRequestHandler):
+        def do_POST(self):
+            demo.release_stale_claims()
+            subject = demo.json.loads(self.rfile.read(int(self.headers['Content-Length'])))['subject']
+            with lock:
+                calls['request_times'].append(demo.time.monotonic())
+                attempt = calls['attempts'][subject] = calls['attempts'].get(subject, 0) + 1
+                status = 400 if 'rejected' in subject else 503 if attempt == 1 else 202
+                if status == 202:
+                    calls['delivered'].append(subject)
+            self.send_response(status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SendGridStandIn)
+    demo.threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(demo, 'SENDGRID_HOST', f"http://127.0.0.1:{server.server_port}")
+    monkeypatch.setattr(demo, '_sendgrid_client', None)
+    yield calls
+    server.shutdown()
+
+
+def test_outbox_delivers_each_message_once(sendgrid_stand_in, monkeypatch, tmp_path):
+    """Every message is delivered exactly once after one retry, a rejected message and an
+    unreadable entry end up in failed/, and sends keep to OUTBOX_RATE_PER_SECOND.
+
+    Messages are enqueued as if long ago, so a claim mistaken for stale would show up as a
+    duplicate send.
+    """
+    messages = 6
+    monkeypatch.setattr(demo, 'OUTBOX_DIR', str(tmp_path))
+    monkeypatch.setattr(demo, 'OUTBOX_BACKOFF_SECONDS', 0.1)
+    for i in range(messages):
+        demo.enqueue_email('<p>outbox check</p>', ['check@example.com'], scope=f"check {i}")
+    demo.enqueue_email('<p>outbox check</p>', ['check@example.com'], scope='rejected')
+    with open(demo.outbox_path('pending', f"{0:010d}-unreadable.json.gz"), 'wb') as f:
+        f.write(b'not gzip')
+    enqueued_long_ago = demo.time.time() - 2 * demo.OUTBOX_STALE_CLAIM_SECONDS
+    for name in demo.outbox_files('pending'):
+        demo.os.utime(demo.outbox_path('pending', name), (enqueued_long_ago, enqueued_long_ago))
+
+    deadline = demo.time.time() + 60
+    while demo.outbox_backlog() and demo.time.time() < deadline:
+        demo.drain_outbox()
+        demo.time.sleep(0.05)
+
+    attempts, delivered, request_times = (sendgrid_stand_in[k] for k in ('attempts', 'delivered', 'request_times'))
+    failed = demo.outbox_files('failed')
+    assert sorted(delivered) == sorted(set(delivered)) and len(delivered) == messages
+    assert sorted(n for s, n in attempts.items() if 'rejected' not in s) == [2] * messages
+    assert [n for s, n in attempts.items() if 'rejected' in s] == [1]
+    assert len(failed) == 2 and sum('unreadable' in name for name in failed) == 1
+    # Requests arrive with some network jitter, so check the average rate rather than each gap
+    span = request_times[-1] - request_times[0]
+    assert span >= (len(request_times) - 1) / demo.OUTBOX_RATE_PER_SECOND * 0.95
+
+
+# Status CTEs the demo query used before STUDY_STATUSES_SQL: a row_number() ranking for the
+# latest status and a self-join against the first COMPLETED time per study for the reporting
+# radiologist.
+STATUS_CTES_ROW_NUMBER = """
+latest_status AS (
+    SELECT 
+        ss.study_fk,
+        ss.status,
+        row_number() OVER (
+            PARTITION BY ss.study_fk
+            ORDER BY ss.created_at DESC
+        ) AS rn
+    FROM StudyStatuses ss
+    WHERE ss.study_fk IN (SELECT study_id FROM window_demo_studies)
+),
+correct_rad AS (
+    SELECT
+        r.study_fk,
+        r.by_user_fk AS rad_fk
+    FROM StudyStatuses r
+    INNER JOIN (
+        SELECT study_fk, MIN(created_at) AS first_completed_time
+        FROM StudyStatuses
+        WHERE status = 'COMPLETED'
+          AND study_fk IN (SELECT study_id FROM window_demo_studies)
+        GROUP BY study_fk
+    ) AS f ON r.study_fk = f.study_fk
+    WHERE r.status = 'REPORTED' AND r.created_at <= f.first_completed_time
+      AND r.study_fk IN (SELECT study_id FROM window_demo_studies)
+)
+"""
+
+# Fixture status histories (study_fk, status, created_at, by_user_fk) covering: reports before
+# and after completion, several reporting radiologists, a report at the completion time, a NULL
+# radiologist, no completion, no statuses at all (study 8) and a study outside the window (99).
+STATUS_FIXTURE_WINDOW = (1, 2, 3, 4, 5, 6, 7, 8)
+STATUS_FIXTURE_ROWS = (
+    (1, 'NEW', '2024-01-01 10:00:00', None),
+    (1, 'REPORTED', '2024-01-01 10:30:00', 2231),
+    (1, 'COMPLETED', '2024-01-01 11:00:00', None),
+    (1, 'REPORTED', '2024-01-01 12:00:00', 999),
+    (2, 'NEW', '2024-01-01 10:00:00', None),
+    (2, 'REPORTED', '2024-01-01 10:20:00', 2231),
+    (2, 'REPORTED', '2024-01-01 10:40:00', 1506),
+    (2, 'COMPLETED', '2024-01-01 11:00:00', None),
+    (2, 'COMPLETED', '2024-01-01 11:30:00', None),
+    (3, 'NEW', '2024-01-01 10:00:00', None),
+    (3, 'REPORTED', '2024-01-01 10:30:00', 999),
+    (4, 'REPORTED', '2024-01-01 10:30:00', None),
+    (4, 'COMPLETED', '2024-01-01 11:00:00', None),
+    (5, 'REPORTED', '2024-01-01 11:00:00', 1505),
+    (5, 'COMPLETED', '2024-01-01 11:00:00', None),
+    (5, 'IQC_REVIEW', '2024-01-01 12:00:00', None),
+    (6, 'IQC_REVIEW', '2024-01-01 10:00:00', None),
+    (7, 'COMPLETED', '2024-01-01 10:00:00', None),
+    (7, 'REPORTED', '2024-01-01 10:30:00', 777),
+    (99, 'REPORTED', '2024-01-01 10:30:00', 2231),
+    (99, 'COMPLETED', '2024-01-01 11:00:00', None),
+)
+# (study, latest status, reporting radiologist) per window study; '' for a missing value
+STATUS_EXPECTED_ROWS = [
+    ('1', 'REPORTED', '2231'),
+    ('2', 'COMPLETED', '1506'),
+    ('2', 'COMPLETED', '2231'),
+    ('3', 'REPORTED', ''),
+    ('4', 'COMPLETED', ''),
+    ('5', 'IQC_REVIEW', '1505'),
+    ('6', 'IQC_REVIEW', ''),
+    ('7', 'REPORTED', ''),
+    ('8', '', ''),
+]
+
+STATUS_CHECK_QUERY_TEMPLATE = """
+WITH status_fixture AS (
+    SELECT *
+    FROM values('study_fk UInt64, status String, created_at DateTime, by_user_fk Nullable(UInt64)',
+        {fixture_rows})
+),
+window_demo_studies AS (
+    SELECT arrayJoin([{window_studies}]) AS study_id
+),
+{status_ctes}
+SELECT
+    w.study_id AS study_id,
+    {latest_status} AS latest_status,
+    {rad_fk} AS rad_fk
+FROM window_demo_studies AS w
+{status_joins}
+"""
+
+
+def status_check_query(status_ctes: str, latest_status: str, rad_fk: str, status_joins: str) -> str:
+    def sql_value(value):
+        return 'NULL' if value is None else str(value) if isinstance(value, int) else f"'{value}'"
+
+    sql = STATUS_CHECK_QUERY_TEMPLATE.format(
+        fixture_rows=',\n        '.join('(' + ', '.join(map(sql_value, row)) + ')' for row in STATUS_FIXTURE_ROWS),
+        window_studies=', '.join(map(str, STATUS_FIXTURE_WINDOW)),
+        status_ctes=status_ctes, latest_status=latest_status, rad_fk=rad_fk, status_joins=status_joins)
+    return sql.replace('FROM StudyStatuses', 'FROM status_fixture')
+
+
+@pytest.mark.parametrize('status_ctes, latest_status, rad_fk, status_joins', [
+    pytest.param(STATUS_CTES_ROW_NUMBER.strip(), 'ls.status', 'cr.rad_fk',
+                 "LEFT JOIN latest_status AS ls ON w.study_id = ls.study_fk AND ls.rn = 1\n"
+                 "LEFT JOIN correct_rad AS cr ON w.study_id = cr.study_fk", id='row_number'),
+    pytest.param(f"study_statuses AS ({demo.STUDY_STATUSES_SQL})", 'sst.latest_status', 'sst.rad_fk',
+                 "LEFT JOIN study_statuses AS sst ON w.study_id = sst.study_fk", id='single_scan'),
+])
+def test_status_aggregation(status_ctes, latest_status, rad_fk, status_joins):
+    """STUDY_STATUSES_SQL returns the same rows as the old CTEs on the fixture histories.
+
+    Runs on embedded ClickHouse (chdb); no server or tables are needed. Rows are compared as
+    sorted multisets, so a study reported by several radiologists must come back once per
+    radiologist.
+    """
+    chdb = pytest.importorskip('chdb')
+    sql = status_check_query(status_ctes, latest_status, rad_fk, status_joins)
+    rows = sorted(tuple('' if v == '\\N' else v for v in line.split('\t'))
+                  for line in str(chdb.query(sql, 'TabSeparated')).splitlines())
+    assert rows == sorted(STATUS_EXPECTED_ROWS)
+
+
+def test_history_trend_without_history(monkeypatch, tmp_path):
+    """No history recorded yet (HISTORY_DIR missing or empty) gives an empty trend, not an error."""
+    for history_dir in (tmp_path / 'missing', tmp_path):
+        monkeypatch.setattr(demo, 'HISTORY_DIR', str(history_dir))
+        trend = demo.history_trend(30, 'tat_breach_demo')
+        assert trend.empty and list(trend.columns) == ['run_id'] and trend.index.name == 'run_at'